@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+import asyncio
+import struct
+from dnslib import QTYPE
+from dns_cache import HIT, HIT_PREFETCH, PREFETCH, cache_key
+import resolver_core
+from resolver_core import (CLIENT_TCP_IDLE_TIMEOUT, MAX_PIPELINED, answer_cache, server_selector, logger,
+                           new_log_data, NSLookup, cache_or_stale, iterative_walk, ClientQuery)
+from singleflight import AsyncSingleFlight
+import metrics
+from upstream_pool import AsyncUpstreamPool, register_pool_metrics
+
+# --- Server Limits ---
+MAX_OUTSTANDING = 5000   # Client queries being resolved at once; beyond this we drop
+
+
+# --- In-flight Resolutions (identical concurrent queries share one walk) ---
+in_flight = AsyncSingleFlight()
+
+# --- Upstream Sockets (shared by every task on the loop) ---
+upstream_pool = AsyncUpstreamPool()
+
+
+async def run_walk(walk):
+    """Drives an iterative_walk() generator to completion without blocking the loop."""
+    try:
+        op = next(walk)
+        while True:
+            if isinstance(op, NSLookup):
+                op = walk.send(await lookup_nameservers(op.lookups))
+                continue
+            servers, packet, time_left = op
+            try:
+                reply = await upstream_pool.query_any(server_selector.order(servers), packet, time_left,
+                                                      server_selector)
+            except OSError as e: # Includes socket.timeout
+                op = walk.throw(e)
+                continue
+            op = walk.send(reply)
+    except StopIteration as done:
+        return done.value
+
+
+async def resolve_iterative(query_domain, log_data, qtype=QTYPE.A):
+    """Performs iterative DNS resolution, driving iterative_walk() without blocking."""
+    return await run_walk(iterative_walk(query_domain, log_data, qtype))
+
+
+async def lookup_address(ns_name, budget):
+    """Resolves the IPv4 addresses of a nameserver named in a glueless referral."""
+    cache_status, response = answer_cache.get(ns_name, QTYPE.A)
+    if cache_status not in (HIT, HIT_PREFETCH):
+        response = await run_walk(iterative_walk(ns_name, new_log_data(ns_name), QTYPE.A, budget))
+        if response is None:
+            return []
+        answer_cache.put(ns_name, QTYPE.A, response)
+    return [str(rr.rdata) for rr in response.rr if rr.rtype == QTYPE.A]
+
+
+async def lookup_nameservers(lookups):
+    """Resolves several nameserver names concurrently."""
+    results = await asyncio.gather(*(lookup_address(ns_name, budget) for ns_name, budget in lookups))
+    return {ns_name: ips for (ns_name, _), ips in zip(lookups, results)}
+
+
+class AsyncDNSServer(asyncio.DatagramProtocol):
+    """
+    Handles incoming DNS queries via UDP (and, through serve_tcp(), TCP)
+    on a single asyncio event loop. Each query becomes a task; at most
+    MAX_OUTSTANDING UDP queries run at once.
+    """
+
+    def __init__(self, max_outstanding=MAX_OUTSTANDING):
+        self.max_outstanding = max_outstanding
+        self.outstanding = 0
+        self.dropped = 0
+        self.prefetching = set() # Background refresh tasks (kept referenced until done)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.outstanding >= self.max_outstanding:
+            self.dropped += 1 # The client will retry
+            return
+        self.outstanding += 1
+        task = asyncio.get_running_loop().create_task(
+            self.handle(data, lambda reply: self.transport.sendto(reply, addr), client=addr[0]))
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self.outstanding -= 1
+
+    async def serve_tcp(self, reader, writer):
+        """
+        Serves one client TCP connection (RFC 7766): length-prefixed queries
+        are answered concurrently and each reply is written when ready, so
+        pipelined queries do not wait behind a slow one. At most
+        MAX_PIPELINED are answered at once; the connection is closed after
+        CLIENT_TCP_IDLE_TIMEOUT seconds with nothing outstanding.
+        """
+        def send(reply):
+            if not writer.is_closing():
+                writer.write(struct.pack("!H", len(reply)) + reply)
+
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if peer else None
+        tasks = set()
+        try:
+            while True:
+                if len(tasks) >= MAX_PIPELINED:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                try:
+                    size = await asyncio.wait_for(reader.readexactly(2), CLIENT_TCP_IDLE_TIMEOUT)
+                    client_data = await asyncio.wait_for(reader.readexactly(struct.unpack("!H", size)[0]),
+                                                         CLIENT_TCP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if tasks:
+                        continue
+                    break
+                except (asyncio.IncompleteReadError, OSError): # Client closed its side
+                    break
+                self.outstanding += 1
+                task = asyncio.get_running_loop().create_task(self.handle(client_data, send, udp=False,
+                                                                         client=client))
+                task.add_done_callback(self._finished)
+                task.add_done_callback(tasks.discard)
+                tasks.add(task)
+            if tasks:
+                await asyncio.wait(tasks) # A client that half-closes still gets its answers
+        finally:
+            writer.close()
+
+    async def resolve_and_cache(self, query_domain, log_data, qtype, qclass):
+        """Resolves a question and caches the answer (or a stale fallback). Returns it in wire format."""
+        response = await resolve_iterative(query_domain, log_data, qtype)
+        return cache_or_stale(query_domain, qtype, qclass, response, log_data)
+
+    def prefetch(self, query_domain, qtype, qclass):
+        """Refreshes a popular cached answer in a background task before it expires."""
+        log_data = new_log_data(query_domain)
+        log_data["cache_status"] = PREFETCH
+        key = cache_key(query_domain, qtype, qclass)
+        task = asyncio.get_running_loop().create_task(self._refresh(key, log_data))
+        self.prefetching.add(task)
+        task.add_done_callback(self.prefetching.discard)
+
+    async def _refresh(self, key, log_data):
+        query_domain, qtype, qclass = key
+        try:
+            await in_flight.do(key, self.resolve_and_cache, query_domain, log_data, qtype, qclass)
+        except Exception as e:
+            answer_cache.refresh_failed(query_domain, qtype, qclass)
+            logger.warning(f"Prefetch of {query_domain} failed: {e}")
+
+    async def handle(self, client_data, send, udp=True, client=None):
+        """
+        Answers one client query and passes the reply to send(). udp limits
+        the reply to what the client can receive in a datagram; client (its
+        address) lets repeats of a failing query be limited.
+        """
+        try:
+            query = ClientQuery(client_data, udp, client)
+            question = query.question
+            if query.prefetch:
+                self.prefetch(question.name, question.qtype, question.qclass)
+            if query.key is not None:
+                # Only one resolution walks the hierarchy for a given question;
+                # the rest wait for it and reuse its answer.
+                query.resolved(*await in_flight.do(query.key, self.resolve_and_cache, question.name, query.log_data,
+                                                   question.qtype, question.qclass))
+            query.finish(send)
+        except Exception as e:
+            print(f"Error handling request: {e}")
+
+
+async def run_server(host, port, reuse_port=False):
+    loop = asyncio.get_running_loop()
+    server = AsyncDNSServer()
+    transport, _ = await loop.create_datagram_endpoint(lambda: server, local_addr=(host, port),
+                                                       reuse_port=reuse_port or None)
+    tcp_server = None
+    if resolver_core.SERVE_TCP:
+        tcp_server = await asyncio.start_server(server.serve_tcp, host, port, reuse_port=reuse_port or None)
+    register_pool_metrics(upstream_pool)
+    metrics.counter("dns_coalesced_total", "Client queries that joined a resolution already under way",
+                    lambda: in_flight.coalesced)
+    metrics.gauge("dns_outstanding_queries", "Client queries being resolved", lambda: server.outstanding)
+    metrics.counter("dns_dropped_queries_total", "Client queries dropped at MAX_OUTSTANDING",
+                    lambda: server.dropped)
+    try:
+        await asyncio.Event().wait() # Serve until cancelled
+    finally:
+        transport.close()
+        if tcp_server is not None:
+            tcp_server.close()
+
+
+def serve_async(host, port, reuse_port=False):
+    """Runs the asyncio resolver until interrupted."""
+    try:
+        asyncio.run(run_server(host, port, reuse_port))
+    except KeyboardInterrupt:
+        pass
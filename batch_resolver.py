@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+"""
+Batch resolution of whole query lists, for bulk cache pre-warming and
+offline measurement.
+
+The names of a batch are put in a trie of their labels, TLD first, and
+every branch is entered through a single "scout" question: its walk
+leaves the branch's zone cuts in the delegation cache, and only then are
+the rest of the branch's names and sub-branches resolved, concurrently,
+each starting at the deepest cut already known. The root and each TLD
+or zone server are therefore asked about a shared ancestor once instead
+of once per name. Duplicate questions are resolved once.
+
+Results are streamed back as they complete. Names read from a stream
+(stdin) are taken BATCH_SIZE at a time; the caches carry over from one
+batch to the next.
+
+  python3 batch_resolver.py queries1.txt                     # one line per name as it resolves
+  python3 batch_resolver.py - --quiet --snapshot warm.snap   # pre-warm a snapshot for the resolver
+  python3 batch_resolver.py queries1.txt --no-trie           # baseline: every name walked on its own
+"""
+import argparse
+import asyncio
+import sys
+import time
+from dnslib import QTYPE
+from dns_cache import HIT, HIT_PREFETCH, cache_key
+from resolver_core import (answer_cache, delegation_cache, server_selector, new_log_data, cache_or_stale,
+                           iterative_walk, negative_answer)
+from resolver_logging import VERBOSITY, setup_logging, log_final
+from async_resolver import run_walk
+from cache_snapshot import load_snapshot, write_snapshot
+from load_generator import parse_query_line, read_queries
+
+# --- Batch Settings ---
+DEFAULT_CONCURRENCY = 100   # Questions being resolved at once
+BATCH_SIZE = 5000           # Questions taken from a stream per trie
+
+
+class NameTrie:
+    """The labels of a batch of names, TLD first; each node holds the questions for exactly its name."""
+    __slots__ = ("children", "questions")
+
+    def __init__(self):
+        self.children = {}
+        self.questions = []
+
+    def add(self, qname, qtype):
+        """Adds a question (qname normalised as by cache_key())."""
+        node = self
+        for label in reversed(qname.rstrip(".").split(".")) if qname != "." else ():
+            node = node.children.setdefault(label, NameTrie())
+        node.questions.append((qname, qtype))
+
+    def scout(self):
+        """The first question in this subtree, depth first (None if it is empty)."""
+        node = self
+        while not node.questions:
+            if not node.children:
+                return None
+            node = next(iter(node.children.values()))
+        return node.questions[0]
+
+
+class BatchResult:
+    """How one question of a batch was answered."""
+    __slots__ = ("qname", "qtype", "cache_status", "response", "ms")
+
+    def __init__(self, qname, qtype, cache_status, response, ms):
+        self.qname = qname
+        self.qtype = qtype
+        self.cache_status = cache_status
+        self.response = response
+        self.ms = ms
+
+
+class BatchResolver:
+    """
+    Resolves batches of questions on the asyncio engine, at most
+    concurrency at a time, entering each branch of the name trie through
+    one scout (see module docstring). trie=False resolves every question
+    straight away instead, as a baseline to compare against.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, trie=True):
+        self.concurrency = concurrency
+        self.trie = trie
+
+    async def resolve(self, questions):
+        """Async generator: yields a BatchResult for every distinct (qname, qtype) as it completes."""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._results = asyncio.Queue()
+        self._started = set()
+        root = NameTrie()
+        unique = []
+        for qname, qtype in questions:
+            qname, qtype, _ = cache_key(qname, qtype)
+            if (qname, qtype) not in self._started:
+                self._started.add((qname, qtype))
+                root.add(qname, qtype)
+                unique.append((qname, qtype))
+        self._started.clear()
+
+        if self.trie:
+            work = asyncio.ensure_future(self._branch(root))
+        else:
+            work = asyncio.ensure_future(asyncio.gather(*(self._question(*question) for question in unique)))
+        while True:
+            getter = asyncio.ensure_future(self._results.get())
+            await asyncio.wait((getter, work), return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            yield getter.result()
+        while not self._results.empty():
+            yield self._results.get_nowait()
+        work.result() # Re-raise anything that went wrong
+
+    async def _branch(self, node):
+        """Resolves a subtree: its scout first, then everything else in it concurrently."""
+        scout = node.scout()
+        if scout is None:
+            return
+        await self._question(*scout)
+        await asyncio.gather(*(self._question(*question) for question in node.questions),
+                             *(self._branch(child) for child in node.children.values()))
+
+    async def _question(self, qname, qtype):
+        """Resolves (or finds in the cache) one question, unless already done, and queues its result."""
+        if (qname, qtype) in self._started:
+            return
+        self._started.add((qname, qtype))
+        async with self._slots:
+            start = time.perf_counter()
+            log_data = new_log_data(qname)
+            cache_status, _, summary = answer_cache.get_packed(qname, qtype)
+            log_data["cache_status"] = cache_status
+            if cache_status in (HIT, HIT_PREFETCH):
+                log_data["resolution_mode"] = "cache"
+                log_data["response"] = summary
+            else:
+                negative = negative_answer(qname, qtype)
+                if negative is not None: # Junk name, or known not to exist
+                    log_data["cache_status"] = negative[0]
+                    log_data["resolution_mode"] = "negative"
+                    log_data["response"] = "NXDOMAIN"
+                else:
+                    response = await run_walk(iterative_walk(qname, log_data, qtype))
+                    if cache_or_stale(qname, qtype, 1, response, log_data) is None:
+                        log_data["response"] = "SERVFAIL"
+            ms = (time.perf_counter() - start) * 1000
+        log_data["total_time"] = ms
+        log_data["step"] = "FINAL"
+        log_final(log_data)
+        self._results.put_nowait(BatchResult(qname, qtype, log_data["cache_status"], log_data["response"], ms))
+
+
+def read_stream(f, size=BATCH_SIZE):
+    """Yields lists of up to size (domain, qtype) questions from queriesN.txt-style lines."""
+    batch = []
+    for line in f:
+        question = parse_query_line(line)
+        if question is not None:
+            batch.append(question)
+            if len(batch) == size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def run_batches(batches, resolver, quiet=False):
+    """Resolves each batch in turn, printing results as they arrive. Returns the number of questions."""
+    count = 0
+    for batch in batches:
+        async for result in resolver.resolve(batch):
+            count += 1
+            if not quiet:
+                print(f"{result.qname}\t{QTYPE.get(result.qtype, result.qtype)}\t{result.cache_status}\t"
+                      f"{result.response}\t{result.ms:.1f} ms", flush=True)
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Resolve a whole list of names, sharing zone cuts")
+    parser.add_argument("queries", help="queriesN.txt file or pcap ('-': names on stdin)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Questions being resolved at once")
+    parser.add_argument("--no-trie", action="store_true",
+                        help="Resolve every name independently (baseline for the upstream query count)")
+    parser.add_argument("--quiet", action="store_true", help="Only print the summary")
+    parser.add_argument("--snapshot", default=None, metavar="FILE",
+                        help="Start from this cache snapshot if it exists and save the warmed caches to it")
+    parser.add_argument("--max-entries", type=int, default=None,
+                        help="Answer cache size (raise it to pre-warm long lists)")
+    parser.add_argument("--log-file", default="resolver.log", help="Where to write query records")
+    parser.add_argument("--log-level", choices=list(VERBOSITY), default="final",
+                        help="hops: every upstream hop; final: one record per query; warnings; off")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_file, verbosity=args.log_level)
+    if args.max_entries:
+        answer_cache.max_entries = args.max_entries
+        answer_cache.max_bytes = max(answer_cache.max_bytes, args.max_entries * 512)
+    if args.snapshot:
+        load_snapshot(args.snapshot, answer_cache, delegation_cache)
+
+    batches = read_stream(sys.stdin) if args.queries == "-" else [read_queries(args.queries)]
+    resolver = BatchResolver(args.concurrency, trie=not args.no_trie)
+    sent = server_selector.sent
+    start = time.perf_counter()
+    count = asyncio.run(run_batches(batches, resolver, args.quiet))
+    elapsed = time.perf_counter() - start
+    sent = server_selector.sent - sent
+    print(f"{count} questions in {elapsed:.2f} s, {sent} upstream queries "
+          f"({sent / count if count else 0:.2f} per question)", file=sys.stderr)
+
+    if args.snapshot:
+        written = write_snapshot(args.snapshot, answer_cache, delegation_cache)
+        print(f"Saved {written} answers to {args.snapshot}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+#!/usr/bin/python3
+"""
+Offline resolver benchmark: no Mininet, no NAT, no internet.
+
+A small DNS hierarchy (root, com/net TLDs and a few authoritative
+servers; com. is served by a nameserver named under net., as in the real
+root zone) is served from 127.0.0.x by in-process dnslib servers with a
+configurable per-hop delay and loss. The resolver runs in this process
+with its root hints pointed at the fake root, and load_generator.py (in a
+separate process, so it does not compete for the GIL) replays scripted
+scenarios against it:
+
+  cold            unique names, empty caches
+  warm            the same names again, caches kept
+  glueless        names whose zone is delegated without glue
+  timeouts        a zone with one dead nameserver out of two
+  nxdomain_flood  random non-existent names and TLDs (the root sends NSEC
+                  records to DO queries, like a signed zone)
+
+Each scenario reports throughput, latency percentiles, upstream queries
+sent and memory. Before them, one name is resolved with empty caches to
+check that a cold lookup costs one upstream query per zone cut. The whole report is written as JSON so two runs
+(e.g. before and after a change) can be compared with --compare.
+
+Needs Linux (any 127.0.0.0/8 address is usable on loopback).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from dnslib import DNSRecord, RR, QTYPE, RCODE, A, NS, NSEC, SOA
+
+# --- Fake Hierarchy ---
+FAKE_PORT = 5300          # Every fake server listens here (no root needed)
+RESOLVER_PORT = 5353
+ANSWER_TTL = 300
+NEGATIVE_TTL = 60
+DELEGATION_TTL = 3600
+
+ROOT_IP = '127.0.0.2'
+# ip -> {zone: {"ns": {child zone: [(ns name, glue ip or None)]}, "hosts": {name: ip},
+#              "wildcard": answer any other name in the zone}}
+HIERARCHY = {
+    ROOT_IP: {".": {"ns": {"com.": [("a.gtld-servers.net.", "127.0.0.3")], # Glue from a sibling TLD
+                           "net.": [("a.gtld.net.", "127.0.0.4")]}}},
+    '127.0.0.3': {"com.": {"ns": {"bench.com.": [("ns1.bench.com.", "127.0.0.10")],
+                                  "glueless.com.": [("ns1.dnshost.net.", None)],
+                                  "lossy.com.": [("ns1.lossy.com.", "127.0.0.11"),
+                                                 ("ns2.lossy.com.", "127.0.0.12")]}}},
+    '127.0.0.4': {"net.": {"ns": {"dnshost.net.": [("ns1.dnshost.net.", "127.0.0.13")]},
+                           "hosts": {"a.gtld-servers.net.": "127.0.0.3"}}},
+    '127.0.0.10': {"bench.com.": {"wildcard": True}},
+    '127.0.0.11': {"lossy.com.": {"wildcard": True}},
+    '127.0.0.12': {"lossy.com.": {"wildcard": True}},
+    '127.0.0.13': {"dnshost.net.": {"hosts": {"ns1.dnshost.net.": "127.0.0.13"}},
+                   "glueless.com.": {"wildcard": True}},
+}
+DEAD_SERVERS = {'127.0.0.11'}   # Drops everything in the "timeouts" scenario
+COLD_PROBE = "probe.bench.com."  # Resolved alone with empty caches: one query per zone cut
+
+
+def _in_zone(name, zone):
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+
+def _canonical(name):
+    return tuple(reversed(name.rstrip(".").split("."))) if name != "." else ()
+
+
+def _nsec(zone, data, name):
+    """The NSEC record whose range holds name, for a zone without a wildcard (a signed zone's chain)."""
+    names = sorted({zone, *data.get("ns", {}), *data.get("hosts", {})}, key=_canonical)
+    owner = max((n for n in names if _canonical(n) < _canonical(name)), key=_canonical)
+    following = names[(names.index(owner) + 1) % len(names)]
+    types = ["NS", "SOA", "NSEC"] if owner == zone else ["NS"] if owner in data.get("ns", {}) else ["A"]
+    return RR(owner, QTYPE.NSEC, ttl=NEGATIVE_TTL, rdata=NSEC(following, types))
+
+
+def zone_cuts(name):
+    """Number of zones (root included) a resolver must ask to resolve name in HIERARCHY."""
+    return len({zone for zones in HIERARCHY.values() for zone in zones if _in_zone(name, zone)})
+
+
+def synthetic_address(name):
+    """A stable, made-up IPv4 address for a wildcard answer."""
+    h = zlib.crc32(name.encode())
+    return f"10.{h >> 16 & 0xFF}.{h >> 8 & 0xFF}.{h & 0xFF}"
+
+
+def answer_query(zones, request):
+    """Builds an authoritative answer or referral from a server's zones."""
+    reply = request.reply()
+    reply.header.ra = 0
+    qname = str(request.q.qname).lower()
+    zone = max((z for z in zones if _in_zone(qname, z)), key=len, default=None)
+    if zone is None:
+        reply.header.rcode = RCODE.REFUSED
+        return reply
+    data = zones[zone]
+
+    for child, nameservers in data.get("ns", {}).items():
+        if _in_zone(qname, child):
+            reply.header.aa = 0
+            for ns_name, glue in nameservers:
+                reply.add_auth(RR(child, QTYPE.NS, rdata=NS(ns_name), ttl=DELEGATION_TTL))
+                if glue:
+                    reply.add_ar(RR(ns_name, QTYPE.A, rdata=A(glue), ttl=DELEGATION_TTL))
+            return reply
+
+    reply.header.aa = 1
+    address = data.get("hosts", {}).get(qname)
+    if address is None and data.get("wildcard") and qname != zone and not qname.startswith("nx"):
+        address = synthetic_address(qname)
+    if address is None:
+        reply.header.rcode = RCODE.NXDOMAIN
+    elif request.q.qtype == QTYPE.A:
+        reply.add_answer(RR(qname, QTYPE.A, rdata=A(address), ttl=ANSWER_TTL))
+        return reply
+    # NXDOMAIN or NODATA: SOA for negative caching (RFC 2308)
+    reply.add_auth(RR(zone, QTYPE.SOA, ttl=NEGATIVE_TTL, rdata=SOA(
+        "ns." + zone.lstrip("."), "hostmaster." + zone.lstrip("."),
+        (1, 3600, 600, 86400, NEGATIVE_TTL))))
+    dnssec_ok = any(rr.rtype == QTYPE.OPT and rr.edns_do for rr in request.ar)
+    if address is None and dnssec_ok and not data.get("wildcard"):
+        # NSECs for the name and the zone's wildcard (RFC 4035 section 3.1.3.2)
+        proof = {str(rr.rname): rr for rr in (_nsec(zone, data, qname), _nsec(zone, data, "*." + zone.lstrip(".")))}
+        for owner in sorted(proof, key=_canonical):
+            reply.add_auth(proof[owner])
+    return reply
+
+
+class FakeServer(socketserver.ThreadingUDPServer):
+    """One fake authoritative server, answering from its HIERARCHY zones."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ip, zones, port=FAKE_PORT):
+        self.zones = zones
+        self.delay = 0.0
+        self.loss = 0.0
+        self.queries = 0
+        super().__init__((ip, port), FakeHandler)
+
+
+class FakeHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        server.queries += 1
+        if server.loss and random.random() < server.loss:
+            return
+        try:
+            request = DNSRecord.parse(self.request[0])
+        except Exception:
+            return
+        reply = answer_query(server.zones, request)
+        if server.delay:
+            time.sleep(server.delay * random.uniform(0.8, 1.2))
+        self.request[1].sendto(reply.pack(), self.client_address)
+
+
+class FakeHierarchy:
+    """Starts every server in HIERARCHY and lets scenarios tune them."""
+
+    def __init__(self, port=FAKE_PORT):
+        self.servers = {ip: FakeServer(ip, zones, port) for ip, zones in HIERARCHY.items()}
+        for server in self.servers.values():
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def configure(self, delay, loss, dead=()):
+        for ip, server in self.servers.items():
+            server.delay = delay
+            server.loss = 1.0 if ip in dead else loss
+
+    def reset_counts(self):
+        for server in self.servers.values():
+            server.queries = 0
+
+    def queries(self):
+        return sum(server.queries for server in self.servers.values())
+
+    def shutdown(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+# --- Scenarios ---
+def _names(zone, count, seed):
+    rng = random.Random(seed)
+    return [f"host{i}-{rng.getrandbits(24):06x}.{zone}" for i in range(count)]
+
+
+def _nx_names(count, seed):
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        label = f"{rng.getrandbits(32):08x}"
+        names.append(f"nx{label}.bench.com" if i % 2 else f"www.{label}")
+    return names
+
+
+# name -> (query names, keep caches from the previous scenario, dead servers)
+def scenarios(count, seed):
+    bench = _names("bench.com", count, seed)
+    return {
+        "cold": (bench, False, ()),
+        "warm": (bench, True, ()),
+        "glueless": (_names("glueless.com", count, seed + 1), False, ()),
+        "timeouts": (_names("lossy.com", count, seed + 2), False, DEAD_SERVERS),
+        "nxdomain_flood": (_nx_names(count, seed + 3), False, ()),
+    }
+
+
+# --- Resolver Under Test ---
+def start_resolver(engine, port, log_path, log_level):
+    """Starts the resolver in this process, pointed at the fake root."""
+    import resolver_logging
+    resolver_logging.setup_logging(log_path, verbosity=log_level)
+    import resolver_core
+    resolver_core.ROOT_SERVERS[:] = [ROOT_IP]
+    if engine == "asyncio":
+        import async_resolver
+        async_resolver.upstream_pool.port = FAKE_PORT
+        threading.Thread(target=async_resolver.serve_async, args=('127.0.0.1', port),
+                         daemon=True).start()
+    else:
+        import custom_resolver_multithreaded as threaded
+        threaded.upstream_pool.port = FAKE_PORT
+        threading.Thread(target=threaded.serve_threaded, args=('127.0.0.1', port),
+                         daemon=True).start()
+    _wait_for_resolver(port)
+
+
+def _wait_for_resolver(port, timeout=5.0):
+    probe = DNSRecord.question("ns1.dnshost.net").pack()
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            try:
+                sock.sendto(probe, ('127.0.0.1', port))
+                sock.recv(4096)
+                return
+            except OSError:
+                time.sleep(0.1)
+    raise RuntimeError(f"resolver did not start on port {port}")
+
+
+def cold_lookup(hierarchy, name, port, timeout):
+    """Resolves name with empty caches; returns what it cost against the zone cuts it crosses."""
+    reset_resolver()
+    hierarchy.reset_counts()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(DNSRecord.question(name).pack(), ('127.0.0.1', port))
+        reply = DNSRecord.parse(sock.recv(4096))
+    return {"name": name, "rcode": RCODE[reply.header.rcode], "upstream_queries": hierarchy.queries(),
+            "zone_cuts": zone_cuts(name)}
+
+
+def reset_resolver():
+    """Empties the answer and delegation caches and the RTT history."""
+    import resolver_core
+    resolver_core.answer_cache.clear()
+    resolver_core.delegation_cache.clear()
+    resolver_core.negative_cache.clear()
+    resolver_core.server_selector.clear()
+
+
+def upstream_counters(engine):
+    """The resolver's upstream counters, plus the client queries that joined a walk already under way."""
+    import resolver_core
+    if engine == "asyncio":
+        import async_resolver as server
+    else:
+        import custom_resolver_multithreaded as server
+    counters = resolver_core.server_selector.counters()
+    counters["coalesced"] = server.in_flight.coalesced
+    return counters
+
+
+def memory_stats():
+    import resolver_core
+    rss_kb = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss_kb = int(line.split()[1])
+    except OSError:
+        pass
+    cache = resolver_core.answer_cache
+    return {
+        "rss_mb": rss_kb / 1024 if rss_kb else None,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "answer_cache_entries": len(cache),
+        "answer_cache_bytes": cache._bytes,
+        "delegations": len(resolver_core.delegation_cache),
+    }
+
+
+def run_load(names, port, concurrency, qps, timeout):
+    """Replays names with load_generator.py in a child process; returns its summary."""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write("\n".join(names) + "\n")
+    try:
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_generator.py'),
+               f.name, '--server', '127.0.0.1', '--port', str(port), '--timeout', str(timeout), '--json']
+        cmd += ['--qps', str(qps)] if qps else ['--concurrency', str(concurrency)]
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        os.unlink(f.name)
+
+
+def run_benchmark(args):
+    log_path = os.path.join(tempfile.mkdtemp(prefix="resolver-bench-"), "resolver.log")
+    hierarchy = FakeHierarchy()
+    start_resolver(args.engine, args.port, log_path, args.log_level)
+
+    chosen = scenarios(args.queries, args.seed)
+    report = {
+        "config": {"engine": args.engine, "queries": args.queries, "concurrency": args.concurrency,
+                   "qps": args.qps, "delay_ms": args.delay * 1000, "loss": args.loss,
+                   "log_level": args.log_level, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "scenarios": {},
+    }
+    try:
+        hierarchy.configure(args.delay, 0.0)
+        report["cold_lookup"] = cold_lookup(hierarchy, COLD_PROBE, args.port, args.timeout)
+        if not args.json:
+            print_cold_lookup(report["cold_lookup"])
+        for name in args.scenarios:
+            names, keep_caches, dead = chosen[name]
+            if not keep_caches:
+                reset_resolver()
+            hierarchy.configure(args.delay, args.loss, dead)
+            hierarchy.reset_counts()
+            cpu = time.process_time()
+            before = upstream_counters(args.engine)
+            load = run_load(names, args.port, args.concurrency, args.qps, args.timeout)
+            after = upstream_counters(args.engine)
+            result = {
+                "load": load,
+                "upstream_queries": hierarchy.queries(),
+                "upstream_per_query": hierarchy.queries() / max(load["sent"], 1),
+                # As the resolver saw them: retries, timeouts, rate-limited sends, coalesced queries
+                "upstream": {name: after[name] - before[name] for name in after},
+                # Resolver and fake servers together; the client runs elsewhere
+                "cpu_s": time.process_time() - cpu,
+                "memory": memory_stats(),
+            }
+            report["scenarios"][name] = result
+            if not args.json:
+                print_scenario(name, result)
+    finally:
+        hierarchy.shutdown()
+    return report
+
+
+# --- Reporting ---
+def _fmt(value):
+    return "n/a" if value is None else f"{value:.2f}"
+
+
+def print_cold_lookup(result):
+    verdict = "ok" if result["upstream_queries"] <= result["zone_cuts"] else "MORE THAN ONE PER ZONE CUT"
+    print(f"{'cold lookup':<15} {result['name']} {result['rcode']}: {result['upstream_queries']} upstream "
+          f"queries for {result['zone_cuts']} zone cuts ({verdict})")
+
+
+def print_scenario(name, result):
+    load, latency = result["load"], result["load"]["latency_ms"]
+    print(f"{name:<15} {load['throughput_qps']:>9.1f} QPS  "
+          f"p50={_fmt(latency['p50'])} p99={_fmt(latency['p99'])} ms  "
+          f"ok={load['noerror']}/{load['sent']} timeouts={load['timeouts']}  "
+          f"upstream/query={result['upstream_per_query']:.2f} "
+          f"(retries={result['upstream']['retries']} timeouts={result['upstream']['timeouts']} "
+          f"coalesced={result['upstream']['coalesced']})  "
+          f"rss={_fmt(result['memory']['rss_mb'])} MB")
+
+
+def compare(old, new):
+    """Prints how each scenario's key numbers moved between two reports."""
+    print(f"{'scenario':<15} {'metric':<12} {'before':>10} {'after':>10} {'change':>8}")
+    for name, after in new["scenarios"].items():
+        before = old["scenarios"].get(name)
+        if before is None:
+            continue
+        rows = [("qps", before["load"]["throughput_qps"], after["load"]["throughput_qps"]),
+                ("p50_ms", before["load"]["latency_ms"]["p50"], after["load"]["latency_ms"]["p50"]),
+                ("p99_ms", before["load"]["latency_ms"]["p99"], after["load"]["latency_ms"]["p99"]),
+                ("upstream/q", before["upstream_per_query"], after["upstream_per_query"])]
+        for metric, b, a in rows:
+            change = f"{(a - b) / b * 100:+.1f}%" if a is not None and b else "n/a"
+            print(f"{name:<15} {metric:<12} {_fmt(b):>10} {_fmt(a):>10} {change:>8}")
+
+
+def main():
+    names = list(scenarios(0, 0))
+    parser = argparse.ArgumentParser(description="Benchmark the resolver against a local fake DNS hierarchy")
+    parser.add_argument("--scenarios", default=",".join(names),
+                        help=f"Comma-separated, run in order (default: {','.join(names)})")
+    parser.add_argument("--queries", type=int, default=500, help="Queries per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="Closed-loop client concurrency")
+    parser.add_argument("--qps", type=float, default=None, help="Open-loop rate instead of --concurrency")
+    parser.add_argument("--delay", type=float, default=0.005, help="Seconds each fake server waits per reply")
+    parser.add_argument("--loss", type=float, default=0.0, help="Fraction of queries fake servers drop")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Client timeout per query")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--port", type=int, default=RESOLVER_PORT, help="Port the resolver listens on")
+    parser.add_argument("--log-level", default="hops", help="Resolver --log-level during the run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the JSON report here")
+    parser.add_argument("--compare", default=None, help="Earlier JSON report to compare against")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(names)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
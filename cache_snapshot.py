@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""
+On-disk snapshots of the answer and delegation caches, for warm restarts.
+
+A snapshot file is a read-only hash table: a header, an open-addressing
+bucket array of (key hash, record offset) and the records themselves,
+each holding an answer in wire format with its wall-clock stored and
+expiry times. Loading one only maps the file; nothing is parsed or
+copied up front, so even a million answers are ready at once. The
+AnswerCache looks a miss up in the mapped snapshot (as it does in a
+SharedTable), and a record that is still live moves into memory with the
+TTL it has left. Expired records are simply never used, and the next
+snapshot leaves them out. Zone cuts are few, so they are stored as a
+small JSON block and loaded straight into the DelegationCache.
+
+Snapshots are written every SNAPSHOT_INTERVAL seconds and on shutdown,
+to a temporary file that then replaces the old one. Each snapshot holds
+the live answers in memory, those in the SharedTable (pre-fork mode) and
+those from the loaded snapshot that were never asked for.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from dns_cache import Delegation
+from shared_cache import key_hash
+
+# --- Snapshot Settings ---
+SNAPSHOT_FILE = "resolver_cache.snap"
+SNAPSHOT_INTERVAL = 60.0     # Seconds between snapshots
+
+# --- File Layout ---
+MAGIC = b"DNSSNAP\0"
+VERSION = 1
+# magic, version, written (wall clock), buckets, records, delegations offset, delegations length
+FILE_HEADER = struct.Struct("<8sIdIIQQ")
+BUCKET = struct.Struct("<QQ")        # key hash, record offset (0: empty)
+RECORD = struct.Struct("<ddHHH")     # stored, expires, key length, summary length, data length
+
+WRITE_ERRORS = (OSError, ValueError, struct.error, UnicodeError) # Logged; the writer keeps running
+
+_state = {"path": None, "interval": SNAPSHOT_INTERVAL, "caches": None, "started": False}
+_write_lock = threading.Lock()
+
+
+class Snapshot:
+    """A mapped snapshot file: get() finds one answer without reading the rest."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.written, self.buckets, self.records,
+             delegations_at, delegations_len) = FILE_HEADER.unpack_from(self._mm)
+        except struct.error:
+            raise ValueError(f"{path}: not a cache snapshot")
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} cache snapshot")
+        if (self.buckets & (self.buckets - 1) or delegations_at + delegations_len > len(self._mm)
+                or FILE_HEADER.size + self.buckets * BUCKET.size > len(self._mm)):
+            raise ValueError(f"{path}: truncated cache snapshot")
+        self._delegations = (delegations_at, delegations_len)
+
+    def _record(self, offset):
+        stored, expires, key_len, summary_len, data_len = RECORD.unpack_from(self._mm, offset)
+        start = offset + RECORD.size
+        key = self._mm[start:start + key_len]
+        summary = self._mm[start + key_len:start + key_len + summary_len].decode()
+        data_at = start + key_len + summary_len
+        return key, self._mm[data_at:data_at + data_len], stored, expires, summary
+
+    def get(self, key):
+        """Returns (packed, stored, expires, summary) for an encoded key, or None."""
+        h = key_hash(key)
+        mask = self.buckets - 1
+        i = h & mask
+        try:
+            while True:
+                found, offset = BUCKET.unpack_from(self._mm, FILE_HEADER.size + i * BUCKET.size)
+                if not offset:
+                    return None
+                if found == h:
+                    record = self._record(offset)
+                    if record[0] == key:
+                        return record[1:]
+                i = (i + 1) & mask
+        except (struct.error, UnicodeDecodeError):
+            return None # Damaged file: treat as a miss
+
+    def items(self, now):
+        """Yields (key, packed, stored, expires, summary) for every record still live at now."""
+        for i in range(self.buckets):
+            found, offset = BUCKET.unpack_from(self._mm, FILE_HEADER.size + i * BUCKET.size)
+            if offset:
+                record = self._record(offset)
+                if record[3] > now:
+                    yield record
+
+    def delegations(self):
+        """The stored zone cuts as (zone, nameservers, addresses, expires) lists."""
+        start, length = self._delegations
+        return json.loads(self._mm[start:start + length]) if length else []
+
+
+def write_snapshot(path, answer_cache, delegation_cache):
+    """Writes both caches to path (atomically). Returns the number of answers written."""
+    with _write_lock:
+        now = time.time()
+        answers = answer_cache.export(now)
+        if answer_cache.snapshot is not None:
+            try:
+                for key, packed, stored, expires, summary in answer_cache.snapshot.items(now):
+                    answers.setdefault(key, (packed, stored, expires, summary))
+            except (struct.error, UnicodeDecodeError) as e:
+                print(f"Dropping damaged cache snapshot: {e}", file=sys.stderr)
+                answer_cache.snapshot = None # Keep what was read; stop consulting the rest
+
+        buckets = 1 << max(len(answers) * 2, 1).bit_length() # At most half full
+        mask = buckets - 1
+        table = array("Q", bytes(buckets * BUCKET.size)) # Hash, offset, hash, offset, ...
+        records = []
+        offset = FILE_HEADER.size + buckets * BUCKET.size
+        for key, (packed, stored, expires, summary) in answers.items():
+            summary = summary.encode()
+            h = key_hash(key)
+            i = h & mask
+            while table[2 * i + 1]:
+                i = (i + 1) & mask
+            table[2 * i] = h
+            table[2 * i + 1] = offset
+            record = RECORD.pack(stored, expires, len(key), len(summary), len(packed)) + key + summary + packed
+            records.append(record)
+            offset += len(record)
+        if sys.byteorder != "little":
+            table.byteswap()
+
+        delegations = json.dumps([[d.zone, d.nameservers, d.addresses, now + (d.expires - time.monotonic())]
+                                  for d in delegation_cache.export()]).encode()
+        header = FILE_HEADER.pack(MAGIC, VERSION, now, buckets, len(answers), offset, len(delegations))
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            f.write(table)
+            f.writelines(records)
+            f.write(delegations)
+        os.replace(path + ".tmp", path)
+        return len(answers)
+
+
+def load_snapshot(path, answer_cache, delegation_cache):
+    """
+    Maps a snapshot for answer_cache to fall back on and restores its live
+    zone cuts. Returns the Snapshot, or None if there is no usable file.
+    """
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring cache snapshot: {e}", file=sys.stderr)
+        return None
+    now, mono = time.time(), time.monotonic()
+    for zone, nameservers, addresses, expires in snapshot.delegations():
+        if expires > now:
+            delegation_cache.put(Delegation(zone, nameservers, addresses, mono + (expires - now)))
+    answer_cache.snapshot = snapshot
+    return snapshot
+
+
+def _write_periodically(path, interval, caches):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(path, *caches)
+        except WRITE_ERRORS as e:
+            print(f"Cache snapshot not written: {e}", file=sys.stderr)
+
+
+def configure_snapshots(path=SNAPSHOT_FILE, interval=SNAPSHOT_INTERVAL, answer_cache=None, delegation_cache=None):
+    """Sets where and how often the caches are saved; start_snapshots() does the rest."""
+    _state.update(path=path, interval=interval, caches=(answer_cache, delegation_cache))
+
+
+def start_snapshots(worker=None):
+    """
+    Starts the periodic snapshot writer as configured. Of pre-forked
+    workers only the first (index 0) writes.
+    """
+    if not _state["path"] or _state["started"] or worker not in (None, 0):
+        return
+    _state["started"] = True
+    threading.Thread(target=_write_periodically, args=(_state["path"], _state["interval"], _state["caches"]),
+                     name="cache-snapshot", daemon=True).start()
+
+
+def final_snapshot():
+    """Writes one last snapshot on shutdown, if this process is the one writing them."""
+    if _state["started"]:
+        try:
+            write_snapshot(_state["path"], *_state["caches"])
+        except WRITE_ERRORS as e:
+            print(f"Cache snapshot not written: {e}", file=sys.stderr)
+
+
+def _forget_in_child():
+    _state["started"] = False # The writer thread does not survive fork
+
+
+os.register_at_fork(after_in_child=_forget_in_child)
@@ -2,28 +2,96 @@
 #!/usr/bin/python3
 import socket
 import socketserver
-import logging
-from datetime import datetime
-import time
-from dnslib import DNSRecord, DNSHeader, RR, QTYPE, RCODE
-
-# --- Root DNS Servers ---
-ROOT_SERVERS = ['198.41.0.4'] # A-Root
-
-# --- Setup Logging (as required by Task D) ---
-def setup_logging():
-    """Configures the logger to write to resolver.log."""
-    logger = logging.getLogger('DNSResolver')
-    logger.setLevel(logging.INFO)
-    fh = logging.FileHandler('resolver.log', mode='w') # Overwrite log
-    fh.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(message)s')
-    fh.setFormatter(formatter)
-    if not logger.handlers:
-        logger.addHandler(fh)
-    return logger
-
-logger = setup_logging()
+import argparse
+import signal
+import struct
+import sys
+import threading
+from dnslib import QTYPE
+from dns_cache import HIT, HIT_PREFETCH, PREFETCH, PREFETCH_FRACTION, SERVE_STALE_WINDOW, cache_key
+import resolver_core
+from resolver_core import (QUERY_TIME_BUDGET, answer_cache, failure_limiter, local_zones,
+                           server_selector, NSLookup, logger, new_log_data, cache_or_stale, iterative_walk,
+                           ClientQuery, CLIENT_TCP_IDLE_TIMEOUT, MAX_PIPELINED)
+from singleflight import SingleFlight
+from resolver_logging import VERBOSITY, setup_logging
+import metrics
+from metrics import METRICS_HOST, METRICS_PORT, SNAPSHOT_INTERVAL, configure_metrics, start_metrics
+from cache_snapshot import (SNAPSHOT_FILE, SNAPSHOT_INTERVAL as CACHE_SNAPSHOT_INTERVAL, configure_snapshots,
+                            final_snapshot, load_snapshot, start_snapshots)
+from local_zones import HOSTS_FILE
+from negative_answers import FAILURE_LIMIT
+from server_selection import MAX_INFLIGHT_PER_SERVER, UPSTREAM_QPS
+from upstream_pool import UpstreamPool, recv_message, register_pool_metrics
+
+# --- In-flight Resolutions (identical concurrent queries share one walk) ---
+in_flight = SingleFlight()
+
+# --- Upstream Sockets (shared by all handler threads) ---
+upstream_pool = UpstreamPool()
+
+
+def run_walk(walk):
+    """Drives an iterative_walk() generator to completion, blocking this thread."""
+    try:
+        op = next(walk)
+        while True:
+            if isinstance(op, NSLookup):
+                op = walk.send(lookup_nameservers(op.lookups))
+                continue
+            servers, packet, time_left = op
+            try:
+                reply = upstream_pool.query_any(server_selector.order(servers), packet, time_left,
+                                                server_selector)
+            except OSError as e: # Includes socket.timeout
+                op = walk.throw(e)
+                continue
+            op = walk.send(reply)
+    except StopIteration as done:
+        return done.value
+
+
+def lookup_address(ns_name, budget):
+    """Resolves the IPv4 addresses of a nameserver named in a glueless referral."""
+    cache_status, response = answer_cache.get(ns_name, QTYPE.A)
+    if cache_status not in (HIT, HIT_PREFETCH):
+        response = run_walk(iterative_walk(ns_name, new_log_data(ns_name), QTYPE.A, budget))
+        if response is None:
+            return []
+        answer_cache.put(ns_name, QTYPE.A, response)
+    return [str(rr.rdata) for rr in response.rr if rr.rtype == QTYPE.A]
+
+
+def lookup_nameservers(lookups):
+    """Resolves several nameserver names at once, one thread each."""
+    found = {}
+    def worker(ns_name, budget):
+        found[ns_name] = lookup_address(ns_name, budget)
+    threads = [threading.Thread(target=worker, args=lookup) for lookup in lookups]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return found
+
+def prefetch(query_domain, qtype, qclass):
+    """
+    Refreshes a popular cached answer in a background thread before it
+    expires. Client queries that miss meanwhile join the same resolution.
+    """
+    def refresh():
+        log_data = new_log_data(query_domain)
+        log_data["cache_status"] = PREFETCH
+        key = cache_key(query_domain, qtype, qclass)
+        try:
+            in_flight.do(key, lambda: cache_or_stale(
+                query_domain, qtype, qclass,
+                run_walk(iterative_walk(query_domain, log_data, qtype)), log_data))
+        except Exception as e:
+            answer_cache.refresh_failed(query_domain, qtype, qclass)
+            logger.warning(f"Prefetch of {query_domain} failed: {e}")
+    threading.Thread(target=refresh, name="prefetch", daemon=True).start()
+
 
 class DNSRequestHandler(socketserver.BaseRequestHandler):
     """
@@ -32,134 +100,235 @@ class DNSRequestHandler(socketserver.BaseRequestHandler):
     """
     
     def send_response(self, response_packet, client_address, client_socket):
-        """Sends a DNS response packet back to the client."""
-        client_socket.sendto(response_packet.pack(), client_address)
+        """Sends a packed DNS response back to the client."""
+        client_socket.sendto(response_packet, client_address)
 
-    def resolve_iterative(self, query_domain, log_data):
+    def resolve_iterative(self, query_domain, log_data, qtype=QTYPE.A):
         """
-        Performs iterative DNS resolution.
+        Performs iterative DNS resolution, driving iterative_walk()
+        over the shared upstream socket pool.
         """
-        current_server_ip = ROOT_SERVERS[0]
-        log_data["resolution_mode"] = "iterative"
-        
-        for i in range(10): # Limit to 10 hops
-            if not current_server_ip:
-                logger.warning(f"Resolution failed for {query_domain}: No server to query.")
-                return None
-
-            query = DNSRecord.parse(DNSRecord.question(query_domain).pack())
-            
-            if i == 0: log_data["step"] = "Root"
-            log_data["server_ip"] = current_server_ip
-            
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(2.0)
-                
-                start_rtt = time.time()
-                sock.sendto(query.pack(), (current_server_ip, 53))
-                response_data, _ = sock.recvfrom(4096)
-                end_rtt = time.time()
-                
-                log_data["rtt"] = (end_rtt - start_rtt) * 1000 # RTT in ms
-                response = DNSRecord.parse(response_data)
-                
-            except socket.timeout:
-                log_data["response"] = "TIMEOUT"
-                logger.info(str(log_data))
-                current_server_ip = None
-                continue
-            except Exception as e:
-                logger.error(f"Error querying {current_server_ip}: {e}")
-                current_server_ip = None
-                continue
-            
-            # --- Process Response ---
-            if response.header.rcode == RCODE.NOERROR:
-                if response.rr: # Answer section
-                    for rr in response.rr:
-                        if rr.rtype == QTYPE.A:
-                            log_data["step"] = "Authoritative"
-                            log_data["response"] = f"RESPONSE: A={str(rr.rdata)}"
-                            logger.info(str(log_data))
-                            return response # Found it!
-                
-                if response.auth: # Authority section (Referral)
-                    log_data["response"] = "REFERRAL"
-                    new_ns_domain = str(response.auth[0].rdata)
-                    new_server_ip = None
-                    
-                    if response.ar: # Additional section
-                        for rr in response.ar:
-                            if rr.rtype == QTYPE.A:
-                                new_server_ip = str(rr.rdata)
-                                log_data["step"] = "TLD" if "tld" in new_ns_domain else "Authoritative"
-                                break
-                    
-                    if new_server_ip:
-                        current_server_ip = new_server_ip
-                    else:
-                        logger.warning(f"Got referral to {new_ns_domain} but no IP (Glue).")
-                        current_server_ip = None # Simplification: stop here
-                
-                logger.info(str(log_data))
-
-            elif response.header.rcode == RCODE.NXDOMAIN:
-                log_data["response"] = "NXDOMAIN"
-                logger.info(str(log_data))
-                return response # Domain doesn't exist
-            else:
-                log_data["response"] = f"RCODE_{response.header.rcode}"
-                logger.info(str(log_data))
-                return response # Other error
-
-        return None # Failed to resolve
+        return run_walk(iterative_walk(query_domain, log_data, qtype))
 
+    def resolve_and_cache(self, query_domain, log_data, qtype, qclass):
+        """
+        Resolves a question and caches the answer (or falls back to a stale
+        one). Returns the response in wire format so that coalesced waiters
+        each get their own copy.
+        """
+        response = self.resolve_iterative(query_domain, log_data, qtype)
+        return cache_or_stale(query_domain, qtype, qclass, response, log_data)
 
     def handle(self):
         client_data, client_socket = self.request
         client_address = self.client_address
-        
-        try:
-            query = DNSRecord.parse(client_data)
-            query_domain = str(query.q.qname)
-            
-            log_data = {
-                "timestamp": datetime.now().isoformat(),
-                "domain": query_domain,
-                "resolution_mode": "N/A", "server_ip": "N/A", "step": "N/A",
-                "response": "N/A", "rtt": 0.0, "total_time": 0.0,
-                "cache_status": "MISS"
-            }
-            
-            start_total_time = time.time()
-            response_packet = self.resolve_iterative(query_domain, log_data)
-            end_total_time = time.time()
-            
-            log_data["total_time"] = (end_total_time - start_total_time) * 1000 # Total ms
-            
-            if response_packet:
-                response_packet.header.qr = 1
-                response_packet.header.id = query.header.id
-                self.send_response(response_packet, client_address, client_socket)
-            else:
-                response_fail = query.reply()
-                response_fail.header.rcode = RCODE.SERVFAIL
-                self.send_response(response_fail, client_address, client_socket)
-
-            log_data["step"] = "FINAL"
-            logger.info(str(log_data))
+        self.answer(client_data, lambda reply: self.send_response(reply, client_address, client_socket),
+                    client=client_address[0])
 
+    def answer(self, client_data, send, udp=True, client=None):
+        """
+        Answers one client query and passes the reply to send(). udp limits
+        the reply to what the client can receive in a datagram; client (its
+        address) lets repeats of a failing query be limited.
+        """
+        try:
+            query = ClientQuery(client_data, udp, client)
+            question = query.question
+            if query.prefetch:
+                prefetch(question.name, question.qtype, question.qclass)
+            if query.key is not None:
+                # Only one resolution walks the hierarchy for a given question;
+                # the rest wait for it and reuse its answer.
+                query.resolved(*in_flight.do(query.key, self.resolve_and_cache, question.name, query.log_data,
+                                             question.qtype, question.qclass))
+            query.finish(send)
         except Exception as e:
             print(f"Error handling request: {e}")
 
-if __name__ == "__main__":
-    print("Starting MULTI-THREADED DNS resolver on 10.0.0.5:53...")
-    
+class DNSTCPRequestHandler(DNSRequestHandler):
+    """
+    Handles DNS queries over TCP (RFC 7766): length-prefixed messages on a
+    persistent connection. Each query is answered in a thread of its own
+    and replies are written as they are ready, so pipelined queries do not
+    wait behind a slow one. The connection is closed after
+    CLIENT_TCP_IDLE_TIMEOUT seconds with nothing outstanding.
+    """
+
+    def handle(self):
+        conn = self.request
+        write_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(MAX_PIPELINED)
+        workers = []
+
+        def send(reply):
+            try:
+                with write_lock:
+                    conn.sendall(struct.pack("!H", len(reply)) + reply)
+            except OSError:
+                pass # Client went away
+
+        def answer(client_data):
+            try:
+                self.answer(client_data, send, udp=False, client=self.client_address[0])
+            finally:
+                slots.release()
+
+        conn.settimeout(CLIENT_TCP_IDLE_TIMEOUT)
+        while True:
+            try:
+                client_data = recv_message(conn)
+            except socket.timeout:
+                workers = [worker for worker in workers if worker.is_alive()]
+                if workers:
+                    continue
+                break
+            except OSError: # Includes the client closing its side
+                break
+            slots.acquire() # Stop reading while MAX_PIPELINED queries are being answered
+            worker = threading.Thread(target=answer, args=(client_data,), daemon=True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join() # A client that half-closes still gets its answers
+
+
+class ReusePortThreadingUDPServer(socketserver.ThreadingUDPServer):
+    """ThreadingUDPServer that sets SO_REUSEPORT so several workers can share a port."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class DNSTCPServer(socketserver.ThreadingTCPServer):
+    """ThreadingTCPServer for client connections; handler threads do not block shutdown."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ReusePortDNSTCPServer(DNSTCPServer):
+    """DNSTCPServer that sets SO_REUSEPORT so several workers can share a port."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def start_tcp_listener(host, port, reuse_port=False):
+    """Serves client TCP connections on host:port from a background thread."""
+    server_class = ReusePortDNSTCPServer if reuse_port else DNSTCPServer
+    server = server_class((host, port), DNSTCPRequestHandler)
+    threading.Thread(target=server.serve_forever, name="tcp-listener", daemon=True).start()
+    return server
+
+
+def serve_threaded(host, port, reuse_port=False):
+    """Runs the multi-threaded resolver until interrupted."""
     #
     # --- THIS IS THE FIX ---
     # We are using ThreadingUDPServer instead of UDPServer.
     # This creates a new thread for every single request.
     #
-    with socketserver.ThreadingUDPServer(("10.0.0.5", 53), DNSRequestHandler) as server:
+    server_class = ReusePortThreadingUDPServer if reuse_port else socketserver.ThreadingUDPServer
+    register_pool_metrics(upstream_pool)
+    metrics.counter("dns_coalesced_total", "Client queries that joined a resolution already under way",
+                    lambda: in_flight.coalesced)
+    metrics.gauge("dns_threads", "Threads alive in this process (one per query being handled)",
+                  threading.active_count)
+    with server_class((host, port), DNSRequestHandler) as server:
+        if resolver_core.SERVE_TCP:
+            start_tcp_listener(host, port, reuse_port)
         server.serve_forever()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Custom iterative DNS resolver")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded: one thread per request; asyncio: single event loop")
+    parser.add_argument("--host", default="10.0.0.5", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=53, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Pre-fork this many worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument("--shared-cache-mb", type=int, default=64,
+                        help="Size of the answer cache shared between workers")
+    parser.add_argument("--serve-stale", type=float, default=SERVE_STALE_WINDOW, metavar="SECONDS",
+                        help="How long past expiry an answer may be served if upstream fails (0: never)")
+    parser.add_argument("--prefetch", type=float, default=PREFETCH_FRACTION, metavar="FRACTION",
+                        help="Refresh hot answers once this fraction of their TTL is left (0: never)")
+    parser.add_argument("--query-timeout", type=float, default=QUERY_TIME_BUDGET, metavar="SECONDS",
+                        help="Upstream time allowed for one client query, retries included")
+    parser.add_argument("--upstream-qps", type=float, default=UPSTREAM_QPS,
+                        help="Queries per second sent to any one upstream server (token bucket rate)")
+    parser.add_argument("--upstream-inflight", type=int, default=MAX_INFLIGHT_PER_SERVER,
+                        help="Queries outstanding to any one upstream server at once")
+    parser.add_argument("--no-tcp", action="store_true",
+                        help="Serve UDP only (truncated replies then cannot be retried over TCP)")
+    parser.add_argument("--no-aggressive-nsec", action="store_true",
+                        help="Do not ask upstream for NSEC/NSEC3 or synthesise NXDOMAIN from them")
+    parser.add_argument("--no-junk-filter", action="store_true",
+                        help="Send wpad., *.local and similar names upstream like any other")
+    parser.add_argument("--failure-limit", type=int, default=FAILURE_LIMIT, metavar="N",
+                        help="Times a client's identical failing query is resolved per window (0: no limit)")
+    parser.add_argument("--hosts", default=HOSTS_FILE,
+                        help="hosts-format file answered locally, reloaded on change ('' to disable)")
+    parser.add_argument("--zone", action="append", default=[], metavar="FILE",
+                        help="RFC 1035 zone file answered locally (may be repeated)")
+    parser.add_argument("--cache-snapshot", default=SNAPSHOT_FILE, metavar="FILE",
+                        help="Load the caches from this file at startup and save them to it ('' to disable)")
+    parser.add_argument("--snapshot-interval", type=float, default=CACHE_SNAPSHOT_INTERVAL, metavar="SECONDS",
+                        help="Seconds between cache snapshots (one is also written on shutdown)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve /metrics and /debug/profile on this port (0: off; workers use port+1+index)")
+    parser.add_argument("--metrics-host", default=METRICS_HOST, help="Address the metrics endpoint listens on")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Also write the metrics to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=SNAPSHOT_INTERVAL, metavar="SECONDS")
+    parser.add_argument("--log-file", default="resolver.log", help="Where to write query records")
+    parser.add_argument("--log-format", choices=["json", "repr"], default="json",
+                        help="json: one JSON object per line; repr: the original str(dict) lines")
+    parser.add_argument("--log-level", choices=list(VERBOSITY), default="hops",
+                        help="hops: every upstream hop; final: one record per query; warnings; off")
+    parser.add_argument("--log-sample", type=float, default=1.0,
+                        help="Fraction of client queries to log (0-1)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_file, args.log_format, args.log_level, args.log_sample)
+    answer_cache.stale_window = args.serve_stale
+    answer_cache.prefetch_fraction = args.prefetch
+    resolver_core.QUERY_TIME_BUDGET = args.query_timeout
+    resolver_core.SERVE_TCP = not args.no_tcp
+    resolver_core.AGGRESSIVE_NSEC = not args.no_aggressive_nsec
+    resolver_core.SUPPRESS_JUNK = not args.no_junk_filter
+    failure_limiter.limit = args.failure_limit
+    server_selector.upstream_qps = args.upstream_qps
+    server_selector.max_inflight = args.upstream_inflight
+    local_zones.load(args.hosts or None, args.zone)
+    configure_metrics(args.metrics_port, args.metrics_host, args.metrics_file, args.metrics_interval)
+    if args.cache_snapshot:
+        snapshot = load_snapshot(args.cache_snapshot, answer_cache, resolver_core.delegation_cache)
+        if snapshot is not None:
+            print(f"Loaded cache snapshot {args.cache_snapshot} ({snapshot.records} answers)")
+        configure_snapshots(args.cache_snapshot, args.snapshot_interval, answer_cache,
+                            resolver_core.delegation_cache)
+
+    if args.engine == "asyncio":
+        from async_resolver import serve_async as serve
+        engine_name = "ASYNCIO"
+    else:
+        serve = serve_threaded
+        engine_name = "MULTI-THREADED"
+
+    if args.workers > 1:
+        from prefork_server import serve_prefork
+        print(f"Starting {engine_name} DNS resolver with {args.workers} workers on {args.host}:{args.port}...")
+        serve_prefork(serve, args.host, args.port, args.workers, args.shared_cache_mb)
+    else:
+        start_metrics()
+        start_snapshots()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # Still save the caches on kill
+        print(f"Starting {engine_name} DNS resolver on {args.host}:{args.port}...")
+        try:
+            serve(args.host, args.port)
+        finally:
+            final_snapshot()
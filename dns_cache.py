@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+import threading
+import time
+from collections import OrderedDict
+from dnslib import DNSRecord, QTYPE, RCODE
+from dns_wire import count_down, ttl_fields
+
+# --- Cache Limits ---
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024   # Packed response bytes held in memory
+MAX_TTL = 7 * 86400                    # Never trust a TTL above one week
+NEGATIVE_TTL_CAP = 3 * 3600            # RFC 2308 section 5: cap at 1-3 hours
+
+# --- Serve-stale (RFC 8767) and Prefetch ---
+SERVE_STALE_WINDOW = 3600    # Seconds past expiry an answer may still be served if upstream fails
+STALE_ANSWER_TTL = 30        # TTL given to stale answers (RFC 8767 section 4)
+PREFETCH_FRACTION = 0.1      # Refresh a hot answer once this fraction of its TTL is left
+PREFETCH_MIN_HITS = 3        # Hits an answer needs before it counts as hot
+
+# --- Cache Status Values (logged in "cache_status") ---
+HIT = "HIT"
+HIT_PREFETCH = "HIT_PREFETCH"  # Hit that also started a background refresh
+HIT_STALE = "HIT_STALE"        # Expired answer served because upstream failed
+PREFETCH = "PREFETCH"          # Hops of a background refresh
+MISS = "MISS"
+STALE = "STALE"                # Expired; resolved again
+LOCAL = "LOCAL"                # Answered from hosts.conf / local zone files
+NEGATIVE = "NEGATIVE"          # NXDOMAIN synthesised from a cached NXDOMAIN / NSEC range
+JUNK = "JUNK"                  # wpad., *.local, ...: NXDOMAIN without going upstream
+LIMITED = "LIMITED"            # Client repeating a failing query: last reply sent again
+
+
+def cache_key(qname, qtype, qclass=1):
+    """Normalises a question into the key used by the caches."""
+    qname = str(qname).lower()
+    if not qname.endswith('.'):
+        qname += '.'
+    return (qname, int(qtype), int(qclass))
+
+
+def negative_ttl(response):
+    """
+    Returns the negative caching TTL of an NXDOMAIN/NODATA response:
+    the smaller of the SOA record's own TTL and its MINIMUM field
+    (RFC 2308 section 5), or None if there is no SOA to go by.
+    """
+    for rr in response.auth:
+        if rr.rtype == QTYPE.SOA:
+            return min(rr.ttl, rr.rdata.times[4], NEGATIVE_TTL_CAP)
+    return None
+
+
+def is_nodata(response):
+    """NOERROR with no answers and an SOA in the authority section (RFC 2308)."""
+    return (response.header.rcode == RCODE.NOERROR and not response.rr
+            and any(rr.rtype == QTYPE.SOA for rr in response.auth))
+
+
+def describe_response(response, qtype):
+    """Summarises a final response for the "response" log field."""
+    for rr in response.rr:
+        if rr.rtype == qtype:
+            return f"RESPONSE: {QTYPE[qtype]}={str(rr.rdata)}"
+    if is_nodata(response):
+        return "NODATA"
+    return RCODE[response.header.rcode]
+
+
+def response_ttl(response):
+    """
+    Works out how long a final response may be cached for, or None if it
+    must not be cached (SERVFAIL, negative answers without an SOA, ...).
+    """
+    rcode = response.header.rcode
+    if rcode == RCODE.NXDOMAIN or is_nodata(response):
+        return negative_ttl(response)
+    if rcode != RCODE.NOERROR or not response.rr:
+        return None
+    return min(min(rr.ttl for rr in response.rr), MAX_TTL)
+
+
+def encode_key(key):
+    """Byte form of a cache key, as used by the shared (cross-process) table."""
+    return f"{key[0]} {key[1]} {key[2]}".encode()
+
+
+class CacheEntry:
+    """
+    One cached response, kept in wire format to bound memory use, along
+    with where its TTLs sit so hits never need to parse it.
+    """
+    __slots__ = ("packed", "stored", "expires", "size", "ttl", "hits", "prefetching", "summary", "ttls")
+
+    def __init__(self, packed, stored, ttl, summary):
+        self.packed = packed
+        self.stored = stored
+        self.expires = stored + ttl
+        self.size = len(packed)
+        self.ttl = ttl
+        self.hits = 0
+        self.prefetching = False
+        self.summary = summary      # describe_response() of the answer, for the log
+        self.ttls = ttl_fields(packed)
+
+
+class AnswerCache:
+    """
+    Thread-safe cache of final answers keyed on (qname, qtype, qclass).
+
+    Positive answers live for the smallest TTL in their answer section,
+    NXDOMAIN/NODATA answers for the SOA minimum (RFC 2308). Entries are
+    evicted least-recently-used first once either the entry or byte cap
+    is exceeded.
+
+    Expired answers are kept for stale_window more seconds so they can be
+    served if upstream fails (RFC 8767), and an answer with at least
+    prefetch_min_hits hits is flagged for a background refresh once less
+    than prefetch_fraction of its TTL is left.
+
+    With a SharedTable attached (pre-fork mode) this cache acts as a fast
+    per-process front for it: local misses are looked up in the shared
+    table and every stored answer is written through to it. A loaded
+    cache snapshot (see cache_snapshot.py) is consulted the same way,
+    after the shared table.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 stale_window=SERVE_STALE_WINDOW, prefetch_fraction=PREFETCH_FRACTION,
+                 prefetch_min_hits=PREFETCH_MIN_HITS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_window = stale_window
+        self.prefetch_fraction = prefetch_fraction
+        self.prefetch_min_hits = prefetch_min_hits
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.shared = None
+        self.snapshot = None
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.stale_served = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drops every entry held by this process (a SharedTable is left alone)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def attach(self, shared):
+        """Backs this cache with a SharedTable visible to every worker process."""
+        self.shared = shared
+
+    def get(self, qname, qtype, qclass=1):
+        """
+        Looks up a question. Returns (status, response) where status is
+        HIT, HIT_PREFETCH (a hit the caller should refresh in the
+        background), STALE or MISS and response is a DNSRecord with its
+        TTLs counted down to the time remaining (None unless a hit).
+        Expired entries are reported as STALE and kept for get_stale().
+        """
+        status, packed, _ = self.get_packed(qname, qtype, qclass)
+        return status, DNSRecord.parse(packed) if packed is not None else None
+
+    def get_packed(self, qname, qtype, qclass=1):
+        """
+        Like get(), without parsing: returns (status, packed, summary) where
+        packed is the answer in wire format with its TTLs counted down and
+        summary its "response" log field (both None unless a hit).
+        """
+        key = cache_key(qname, qtype, qclass)
+        now = time.monotonic()
+        status = MISS
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                if entry.expires + self.stale_window <= now:
+                    self._remove(key)
+                entry, status = None, STALE
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                status = self._hit(entry, now)
+        if entry is None:
+            if self.shared is not None or self.snapshot is not None: # Another worker or a past run may have it
+                entry = self._from_shared(key, now)
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                    return status, None, None
+                self.hits += 1
+                status = self._hit(entry, now)
+        return status, count_down(entry.packed, entry.ttls, int(now - entry.stored)), entry.summary
+
+    def get_stale(self, qname, qtype, qclass=1):
+        """
+        Returns an expired answer (packed) still inside the stale window,
+        with its TTLs set to STALE_ANSWER_TTL, or None (also while the
+        answer is still live: a failed prefetch serves nothing). Used when
+        resolution fails.
+        """
+        key = cache_key(qname, qtype, qclass)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires > now or entry.expires + self.stale_window <= now:
+                return None
+            self.stale_served += 1
+        return count_down(entry.packed, entry.ttls, 0, STALE_ANSWER_TTL)
+
+    def refresh_failed(self, qname, qtype, qclass=1):
+        """Lets a live answer whose background refresh failed be prefetched again by a later hit."""
+        key = cache_key(qname, qtype, qclass)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.prefetching = False
+
+    def _hit(self, entry, now):
+        """Counts a hit on a live entry and decides whether it is due a refresh."""
+        entry.hits += 1
+        if (self.prefetch_fraction and not entry.prefetching
+                and entry.hits >= self.prefetch_min_hits
+                and entry.expires - now <= entry.ttl * self.prefetch_fraction):
+            entry.prefetching = True
+            self.prefetches += 1
+            return HIT_PREFETCH
+        return HIT
+
+    def put(self, qname, qtype, response, qclass=1, packed=None):
+        """
+        Caches a final response if it is cacheable (packed: response.pack(),
+        if the caller already has it). Returns True if stored.
+        """
+        ttl = response_ttl(response)
+        if not ttl:
+            return False
+        entry = CacheEntry(bytes(packed or response.pack()), time.monotonic(), ttl,
+                           describe_response(response, qtype))
+        if entry.size > self.max_bytes:
+            return False
+
+        key = cache_key(qname, qtype, qclass)
+        self._store(key, entry)
+        if self.shared is not None:
+            wall = time.time()
+            self.shared.put(encode_key(key), entry.packed, wall, wall + ttl)
+        return True
+
+    def _from_shared(self, key, now):
+        """Copies a live entry from the shared table or snapshot into this process's cache."""
+        encoded = encode_key(key)
+        found = self.shared.get(encoded) if self.shared is not None else None
+        if found is not None:
+            (packed, stored, expires), summary = found, None
+        else:
+            found = self.snapshot.get(encoded) if self.snapshot is not None else None
+            if found is None:
+                return None
+            packed, stored, expires, summary = found
+        wall = time.time()
+        if expires <= wall:
+            return None
+        if not summary:
+            summary = describe_response(DNSRecord.parse(packed), key[1])
+        entry = CacheEntry(packed, now - (wall - stored), expires - stored, summary)
+        self._store(key, entry)
+        return entry
+
+    def export(self, wall):
+        """
+        Every live answer, in this process and in the shared table, as
+        {encoded key: (packed, stored, expires, summary)} with wall-clock
+        times (wall: time.time()). Used to write cache snapshots.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._entries.items())
+        answers = {}
+        if self.shared is not None:
+            for key, packed, stored, expires in self.shared.items(wall):
+                answers[key] = (packed, stored, expires, "")
+        for key, entry in entries:
+            if entry.expires <= now:
+                continue
+            stored = wall - (now - entry.stored)
+            answers[encode_key(key)] = (entry.packed, stored, stored + entry.ttl, entry.summary)
+        return answers
+
+    def _store(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                entry.hits = self._entries[key].hits // 2 # A refreshed answer stays hot
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+
+# --- Delegation (Zone Cut) Cache ---
+DEFAULT_MAX_DELEGATIONS = 5000
+
+
+def parent_zones(qname):
+    """Yields qname and each of its ancestors, deepest first, ending at '.'."""
+    labels = cache_key(qname, 0)[0].rstrip('.').split('.')
+    for i in range(len(labels)):
+        if labels[i]:
+            yield '.'.join(labels[i:]) + '.'
+    yield '.'
+
+
+def in_bailiwick(qname, zone):
+    """True if qname is zone itself or lies underneath it."""
+    return cache_key(zone, 0)[0] in parent_zones(qname)
+
+
+def step_for_zone(zone):
+    """Maps a zone cut onto the step names used in resolver.log."""
+    depth = zone.rstrip('.').count('.') + 1 if zone != '.' else 0
+    return {0: "Root", 1: "TLD"}.get(depth, "Authoritative")
+
+
+class Delegation:
+    """The NS set of one zone cut and whatever glue addresses came with it."""
+    __slots__ = ("zone", "nameservers", "addresses", "expires")
+
+    def __init__(self, zone, nameservers, addresses, expires):
+        self.zone = zone
+        self.nameservers = nameservers   # NS names, in referral order
+        self.addresses = addresses       # NS name -> list of IPv4 addresses
+        self.expires = expires
+
+    def server_ips(self):
+        """All known nameserver addresses, in NS order."""
+        return [ip for ns in self.nameservers for ip in self.addresses.get(ns, [])]
+
+
+def referral_delegation(response, server_zone='.', now=None):
+    """
+    Builds a Delegation from the authority and additional sections of a
+    referral, or returns None if the response carries no NS records.
+    Only glue in the bailiwick of the answering server (server_zone, the
+    zone it was asked as an authority for) is kept: the root may vouch for
+    any address, com. servers only for names under com. The delegation
+    lives for the smallest TTL of its NS and glue records.
+    """
+    ns_records = [rr for rr in response.auth if rr.rtype == QTYPE.NS]
+    if not ns_records:
+        return None
+    zone = cache_key(ns_records[0].rname, 0)[0]
+    nameservers = []
+    for rr in ns_records:
+        name = cache_key(rr.rdata, 0)[0]
+        if name not in nameservers:
+            nameservers.append(name)
+
+    ttls = [rr.ttl for rr in ns_records]
+    addresses = {}
+    for rr in response.ar:
+        name = cache_key(rr.rname, 0)[0]
+        if rr.rtype == QTYPE.A and name in nameservers and in_bailiwick(name, server_zone):
+            addresses.setdefault(name, []).append(str(rr.rdata))
+            ttls.append(rr.ttl)
+
+    now = time.monotonic() if now is None else now
+    return Delegation(zone, nameservers, addresses, now + min(min(ttls), MAX_TTL))
+
+
+class DelegationCache:
+    """
+    Thread-safe cache of zone cuts (NS sets plus glue) learnt from
+    referrals, so a resolution can start at the deepest known ancestor
+    of the query name instead of at the root.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_DELEGATIONS):
+        self.max_entries = max_entries
+        self._zones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._zones)
+
+    def clear(self):
+        """Forgets every zone cut."""
+        with self._lock:
+            self._zones.clear()
+
+    def export(self):
+        """The unexpired zone cuts, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [delegation for delegation in self._zones.values() if delegation.expires > now]
+
+    def put(self, delegation):
+        """Stores (or refreshes) a zone cut."""
+        with self._lock:
+            self._zones.pop(delegation.zone, None)
+            self._zones[delegation.zone] = delegation
+            while len(self._zones) > self.max_entries:
+                self._zones.popitem(last=False)
+
+    def get(self, zone):
+        """Returns the unexpired Delegation for exactly this zone, or None."""
+        zone = cache_key(zone, 0)[0]
+        with self._lock:
+            delegation = self._zones.get(zone)
+            if delegation is None:
+                return None
+            if delegation.expires <= time.monotonic():
+                del self._zones[zone]
+                return None
+            self._zones.move_to_end(zone)
+            return delegation
+
+    def closest(self, qname):
+        """
+        Returns the deepest unexpired Delegation enclosing qname that has
+        at least one usable address, or None to start from the root hints.
+        """
+        for zone in parent_zones(qname):
+            delegation = self.get(zone)
+            if delegation and delegation.server_ips():
+                return delegation
+        return None
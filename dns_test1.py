@@ -1,36 +1,10 @@
-from mininet.topo import Topo
 from mininet.net import Mininet
 from mininet.node import OVSController
 from mininet.link import TCLink
 from mininet.log import setLogLevel, info
+from mininet_experiment import NetworkTopo
 from mininet.cli import CLI
 
-class NetworkTopo(Topo):
-    """
-    A custom topology for the assignment.
-    """
-    def build(self):
-        # (Topology definition as in Task A)
-        h1 = self.addHost('h1', ip='10.0.0.1/24')
-        h2 = self.addHost('h2', ip='10.0.0.2/24')
-        h3 = self.addHost('h3', ip='10.0.0.3/24')
-        h4 = self.addHost('h4', ip='10.0.0.4/24')
-        dns = self.addHost('dns', ip='10.0.0.5/24') 
-        s1 = self.addSwitch('s1')
-        s2 = self.addSwitch('s2')
-        s3 = self.addSwitch('s3')
-        s4 = self.addSwitch('s4')
-        link_params = {'bw': 100}
-        self.addLink(h1, s1, delay='2ms', **link_params)
-        self.addLink(h2, s2, delay='2ms', **link_params)
-        self.addLink(h3, s3, delay='2ms', **link_params)
-        self.addLink(h4, s4, delay='2ms', **link_params)
-        self.addLink(dns, s2, delay='1ms', **link_params)
-        self.addLink(s1, s2, delay='5ms', **link_params)
-        self.addLink(s2, s3, delay='8ms', **link_params)
-        self.addLink(s3, s4, delay='10ms', **link_params)
-
-
 def configure_custom_resolver():
     """
     Starts the network, configures all hosts to use 10.0.0.5
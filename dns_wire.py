@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+"""
+Wire-format helpers for the resolver's hot paths.
+
+dnslib builds a full object graph for every message it parses or packs,
+which is most of the CPU a cache hit costs. The functions here read the
+header and question straight out of the raw bytes with struct, build the
+per-hop upstream query directly, and find the TTL fields of a packed
+response once so a cached answer can be counted down and re-stamped with
+the client's transaction ID without ever being parsed again.
+
+Anything unusual (more than one question, compression pointers or odd
+characters in the question name) is left to dnslib, so both paths give
+the same names and cache keys.
+
+EDNS0 (RFC 6891): upstream queries advertise EDNS_UDP_SIZE (and may
+set the DO bit, see negative_answers.py). Cached
+answers carry no OPT record; finish_reply() adds ours for clients that
+sent one and, over UDP, truncates (TC=1) replies larger than the client
+can take so it retries over TCP.
+"""
+import struct
+from dnslib import CLASS, DNSHeader, DNSQuestion, DNSRecord, EDNS0, QTYPE, RCODE
+
+# --- Message Layout ---
+HEADER = struct.Struct("!HHHHHH")   # id, flags, qdcount, ancount, nscount, arcount
+RR_FIXED = struct.Struct("!HHIH")    # type, class, ttl, rdlength
+TTL = struct.Struct("!I")
+TXID = struct.Struct("!H")
+OPT = 41                             # EDNS0 pseudo-record; its "TTL" holds flags
+
+# --- EDNS0 ---
+EDNS_UDP_SIZE = 1232                 # DNS flag day 2020: avoids IP fragmentation
+CLASSIC_UDP_SIZE = 512               # Limit for clients without EDNS0
+_OPT_RR = b"\x00" + struct.pack("!HHIH", OPT, EDNS_UDP_SIZE, 0, 0)
+_OPT_RR_DO = b"\x00" + struct.pack("!HHIH", OPT, EDNS_UDP_SIZE, 0x8000, 0)   # DNSSEC OK (RFC 3225)
+
+_LENGTH = [bytes((n,)) for n in range(64)]
+_HOSTNAME_BYTES = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_*"
+
+
+def wire_name(name):
+    """Lowercased wire-format name, without the final zero byte (as question_key() gives it)."""
+    labels = name.lower().rstrip(b".").split(b".") if name.strip(b".") else []
+    if any(not label or len(label) > 63 for label in labels):
+        raise ValueError(f"bad domain name {name!r}")
+    return b"".join(_LENGTH[len(label)] + label for label in labels)
+
+
+def text_name(qname):
+    """Dotted form of a wire qname from wire_name()/question_key(), without the trailing dot."""
+    labels = []
+    pos = 0
+    while pos < len(qname):
+        length = qname[pos]
+        labels.append(qname[pos + 1:pos + 1 + length])
+        pos += length + 1
+    return b".".join(labels)
+
+
+class Question:
+    """
+    The parts of a client query the resolver needs. wire is the question
+    section exactly as the client sent it (None if dnslib had to parse it)
+    and edns the UDP payload size from the client's OPT record (None
+    without one).
+    """
+    __slots__ = ("txid", "flags", "name", "qtype", "qclass", "wire", "edns")
+
+    def __init__(self, txid, flags, name, qtype, qclass, wire=None, edns=None):
+        self.txid = txid
+        self.flags = flags
+        self.name = name       # As str(DNSLabel) would give it, trailing dot included
+        self.qtype = qtype
+        self.qclass = qclass
+        self.wire = wire
+        self.edns = edns
+
+
+def _fast_question(data):
+    """Question from the raw bytes, or None if this needs the full parser."""
+    if len(data) < 17:
+        return None
+    txid, flags, qdcount = struct.unpack_from("!HHH", data)
+    if qdcount != 1:
+        return None
+    labels = []
+    pos = 12
+    end = len(data) - 4
+    while pos < end:
+        length = data[pos]
+        if length == 0:
+            break
+        if length > 63: # Compression pointer (or junk)
+            return None
+        label = data[pos + 1:pos + 1 + length]
+        if label.translate(None, _HOSTNAME_BYTES):
+            return None
+        labels.append(label)
+        pos += length + 1
+    else:
+        return None
+    qtype, qclass = struct.unpack_from("!HH", data, pos + 1)
+    name = b".".join(labels).decode() + "."
+    edns = None
+    if data[11] or data[10]: # arcount: an OPT record normally comes first
+        if data[pos + 5:pos + 8] != b"\x00\x00\x29":
+            return None
+        edns = max(struct.unpack_from("!H", data, pos + 8)[0], CLASSIC_UDP_SIZE)
+    return Question(txid, flags, name, qtype, qclass, bytes(data[12:pos + 5]), edns)
+
+
+def read_question(data):
+    """
+    Returns the Question of a client query. Raises whatever dnslib raises
+    for a message it cannot parse either.
+    """
+    question = _fast_question(data)
+    if question is None:
+        query = DNSRecord.parse(data)
+        question = Question(query.header.id, query.header.bitmap, str(query.q.qname),
+                            query.q.qtype, query.q.qclass)
+        for rr in query.ar:
+            if rr.rtype == OPT:
+                question.edns = max(rr.rclass, CLASSIC_UDP_SIZE)
+    return question
+
+
+def question_packet(qname, qtype, qclass=1, dnssec_ok=False):
+    """
+    A recursion-desired query for one question, advertising EDNS_UDP_SIZE
+    and, with dnssec_ok, asking for DNSSEC records (txid 0; the upstream
+    pool sets its own).
+    """
+    if not qname.isascii() or "\\" in qname: # Escaped or IDN labels: let dnslib encode them
+        query = DNSRecord.question(qname, QTYPE[qtype], CLASS[qclass])
+        query.add_ar(EDNS0(udp_len=EDNS_UDP_SIZE, flags="do" if dnssec_ok else ""))
+        return bytes(query.pack())
+    return (HEADER.pack(0, 0x0100, 1, 0, 0, 1) + wire_name(qname.encode()) + b"\x00"
+            + struct.pack("!HH", qtype, qclass) + (_OPT_RR_DO if dnssec_ok else _OPT_RR))
+
+
+def is_truncated(message):
+    """True if the TC bit is set."""
+    return len(message) > 2 and bool(message[2] & 0x02)
+
+
+def skip_name(data, pos):
+    """Offset just past the (possibly compressed) name starting at pos."""
+    while True:
+        length = data[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xC0:
+            return pos + 2
+        pos += length + 1
+
+
+def ttl_fields(packed):
+    """
+    Returns ((offset, ttl), ...) for every resource record in a packed
+    message except OPT, or () if the message cannot be walked.
+    """
+    try:
+        _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packed)
+        pos = 12
+        for _ in range(qdcount):
+            pos = skip_name(packed, pos) + 4
+        fields = []
+        for _ in range(ancount + nscount + arcount):
+            pos = skip_name(packed, pos)
+            rtype, _, ttl, rdlength = RR_FIXED.unpack_from(packed, pos)
+            if rtype != OPT:
+                fields.append((pos + 4, ttl))
+            pos += RR_FIXED.size + rdlength
+    except (IndexError, struct.error):
+        return ()
+    return tuple(fields)
+
+
+def count_down(packed, fields, elapsed, cap=None):
+    """
+    Returns a copy of a packed message with each TTL reduced by elapsed
+    seconds (never below 0) and, if cap is given, no higher than cap.
+    """
+    reply = bytearray(packed)
+    for offset, ttl in fields:
+        ttl = max(ttl - elapsed, 0)
+        if cap is not None and ttl > cap:
+            ttl = cap
+        TTL.pack_into(reply, offset, ttl)
+    return reply
+
+
+def stamp_reply(packed, question):
+    """
+    Turns a packed response into the reply for one client: their
+    transaction ID, QR set, and their question echoed with its original
+    letter case (0x20 randomisation).
+    """
+    reply = bytearray(packed)
+    TXID.pack_into(reply, 0, question.txid)
+    reply[2] |= 0x80
+    wire = question.wire
+    if wire is not None and reply[12:12 + len(wire)].lower() == wire.lower():
+        reply[12:12 + len(wire)] = wire
+    return reply
+
+
+def finish_reply(reply, question, udp):
+    """
+    Last step before a reply goes out: adds our OPT record if the client
+    sent one and, for UDP, cuts a reply too big for the client down to
+    its header and question with TC set, so it asks again over TCP.
+    """
+    if question.edns is None:
+        if not udp or len(reply) <= CLASSIC_UDP_SIZE:
+            return reply
+    else:
+        reply = bytearray(reply)
+        reply[10:12] = struct.pack("!H", struct.unpack_from("!H", reply, 10)[0] + 1)
+        reply += _OPT_RR
+        if not udp or len(reply) <= min(question.edns, EDNS_UDP_SIZE):
+            return reply
+    end = skip_name(reply, 12) + 4 # Replies always carry exactly the one question
+    header = bytearray(reply[:12])
+    header[2] |= 0x02 # TC
+    header[6:12] = struct.pack("!HHH", 0, 0, 1 if question.edns is not None else 0)
+    return header + reply[12:end] + (_OPT_RR if question.edns is not None else b"")
+
+
+def servfail_reply(question):
+    """SERVFAIL for a query that could not be resolved (opcode and RD copied, RA set)."""
+    flags = (question.flags & 0x7900) | 0x8080 | RCODE.SERVFAIL
+    if question.wire is not None:
+        return HEADER.pack(question.txid, flags, 1, 0, 0, 0) + question.wire
+    return DNSRecord(DNSHeader(id=question.txid, bitmap=flags),
+                     q=DNSQuestion(question.name, question.qtype, question.qclass)).pack()
@@ -0,0 +1,418 @@
+#!/usr/bin/python3
+"""
+In-process DNS load generator (replaces the serial `dig` loops).
+
+Queries are replayed from a queriesN.txt file (one domain per line, with
+an optional record type after it) or from the DNS questions in a pcap,
+over a single asyncio UDP socket:
+
+  closed loop  --concurrency N   N queries always outstanding
+  open loop    --qps R           queries sent on a fixed schedule, whether
+                                 or not earlier ones have been answered
+
+Open-loop latency is measured from each query's scheduled send time, so a
+resolver that falls behind shows up in the percentiles instead of
+silently slowing the generator down (no coordinated omission).
+
+Runs on a Mininet host (`host.cmd("python3 load_generator.py ... --json")`)
+or directly against a resolver on localhost.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import time
+from collections import Counter
+from dnslib import DNSRecord, QTYPE, RCODE
+
+DEFAULT_TIMEOUT = 5.0    # Seconds before an unanswered query counts as a timeout
+DEFAULT_CONCURRENCY = 1
+MAX_OUTSTANDING = 60000  # Transaction IDs in use at once (of 65536)
+
+
+# --- Latency Histogram (HDR-style: 1 us resolution, <1% relative error) ---
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def _bucket(us):
+    """Bucket index of a latency in microseconds."""
+    if us < 2 * SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (us >> shift)
+
+
+def _bucket_value(index):
+    """Highest latency (us) that falls into a bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram in the style of HdrHistogram: exact below
+    256 us, then 128 buckets per power of two, so any percentile is within
+    1% of the true value however many samples are recorded.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        self.counts[_bucket(int(ms * 1000))] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Latency (ms) at or below which q percent of samples fall."""
+        if self.count == 0:
+            return None
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_bucket_value(index) / 1000, self.max)
+        return self.max
+
+    def summary(self, qs=(50, 90, 99, 99.9)):
+        stats = {"count": self.count,
+                 "mean": self.total / self.count if self.count else None,
+                 "max": self.max if self.count else None}
+        for q in qs:
+            stats[f"p{q:g}"] = self.percentile(q)
+        return stats
+
+
+# --- Query Sources ---
+def parse_query_line(line):
+    """Returns (domain, qtype) from one queriesN.txt line, or None for blanks and comments."""
+    fields = line.split()
+    if not fields or fields[0].startswith('#'):
+        return None
+    qtype = getattr(QTYPE, fields[1].upper(), QTYPE.A) if len(fields) > 1 else QTYPE.A
+    return fields[0], qtype
+
+
+def read_query_file(path):
+    """Returns [(domain, qtype)] from a queriesN.txt file."""
+    with open(path, 'r') as f:
+        return [query for query in map(parse_query_line, f) if query is not None]
+
+
+def read_queries(path):
+    """Reads queries from a capture (see pcap_replay.py) or a queriesN.txt file."""
+    from pcap_replay import is_capture, dns_questions # pcap_replay builds on this module
+    if is_capture(path):
+        return [(qname, qtype) for _, qname, qtype in dns_questions(path)]
+    return read_query_file(path)
+
+
+def default_server():
+    """The first nameserver in /etc/resolv.conf (what `dig` would use), else localhost."""
+    try:
+        with open('/etc/resolv.conf', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except OSError:
+        pass
+    return "127.0.0.1"
+
+
+# --- Load Generator ---
+class LoadResult:
+    """Outcome of one run: latencies of answered queries, rcodes and timeouts."""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.rcodes = Counter()
+        self.sent = 0
+        self.timeouts = 0
+        self.elapsed = 0.0
+
+    @property
+    def answered(self):
+        return sum(self.rcodes.values())
+
+    def summary(self, buckets=False):
+        """The run as a dict; buckets adds the raw histogram so runs can be combined later."""
+        stats = {
+            "sent": self.sent,
+            "answered": self.answered,
+            "noerror": self.rcodes.get("NOERROR", 0),
+            "timeouts": self.timeouts,
+            "rcodes": dict(self.rcodes),
+            "elapsed_s": self.elapsed,
+            "throughput_qps": self.answered / self.elapsed if self.elapsed > 0 else 0.0,
+            "latency_ms": self.latency.summary(),
+        }
+        if buckets:
+            stats["latency_buckets"] = {str(index): count for index, count in self.latency.counts.items()}
+        return stats
+
+
+def combine_summaries(summaries, elapsed):
+    """
+    Adds up the summaries of runs made at the same time (with buckets)
+    into one: latency percentiles over every run's samples, throughput
+    over elapsed wall-clock seconds.
+    """
+    combined = LoadResult()
+    for stats in summaries:
+        latency = stats["latency_ms"]
+        combined.sent += stats["sent"]
+        combined.timeouts += stats["timeouts"]
+        combined.rcodes.update(stats["rcodes"])
+        combined.latency.counts.update({int(index): count for index, count in stats["latency_buckets"].items()})
+        combined.latency.count += latency["count"]
+        combined.latency.total += (latency["mean"] or 0.0) * latency["count"]
+        combined.latency.max = max(combined.latency.max, latency["max"] or 0.0)
+    combined.elapsed = elapsed
+    return combined.summary()
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, generator):
+        self.generator = generator
+
+    def datagram_received(self, data, addr):
+        self.generator._received(data)
+
+    def error_received(self, exc):
+        pass # e.g. ICMP port unreachable: the query will time out
+
+
+class LoadGenerator:
+    """
+    Sends prebuilt queries to one resolver from one UDP socket, matching
+    replies by transaction ID. Each query's packet is built once; only the
+    transaction ID is rewritten per send.
+    """
+
+    def __init__(self, server, port=53, timeout=DEFAULT_TIMEOUT):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.result = LoadResult()
+        self._pending = {}  # txid -> (scheduled send time, future or None)
+        self._transport = None
+        self._drained = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(self), remote_addr=(self.server, self.port))
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+    @staticmethod
+    def build_packets(queries):
+        """Packs each (domain, qtype) once, with recursion desired (like dig)."""
+        return [DNSRecord.question(domain, QTYPE[qtype]).pack() for domain, qtype in queries]
+
+    def _send(self, packet, scheduled, future=None):
+        txid = random.getrandbits(16)
+        while txid in self._pending:
+            txid = random.getrandbits(16)
+        self._pending[txid] = (scheduled, future)
+        self.result.sent += 1
+        self._transport.sendto(struct.pack("!H", txid) + packet[2:])
+        asyncio.get_running_loop().call_later(self.timeout, self._expire, txid, scheduled)
+
+    def _expire(self, txid, scheduled):
+        entry = self._pending.get(txid)
+        if entry is None or entry[0] != scheduled:
+            return # Answered (and possibly reused) already
+        del self._pending[txid]
+        self.result.timeouts += 1
+        self._done(entry[1])
+
+    def _received(self, data):
+        if len(data) < 12:
+            return
+        txid, flags = struct.unpack_from("!HH", data)
+        entry = self._pending.pop(txid, None)
+        if entry is None:
+            return # Late reply to a query that already timed out
+        self.result.latency.record((time.monotonic() - entry[0]) * 1000)
+        self.result.rcodes[RCODE.get(flags & 0x0F, f"RCODE_{flags & 0x0F}")] += 1
+        self._done(entry[1])
+
+    def _done(self, future):
+        if future is not None and not future.done():
+            future.set_result(None)
+        if self._drained is not None and not self._pending and not self._drained.done():
+            self._drained.set_result(None)
+
+    async def _drain(self):
+        """Waits for every outstanding query to be answered or time out."""
+        if self._pending:
+            self._drained = asyncio.get_running_loop().create_future()
+            await self._drained
+
+    async def run_closed(self, packets, concurrency=DEFAULT_CONCURRENCY):
+        """Keeps `concurrency` queries outstanding until every packet is sent."""
+        loop = asyncio.get_running_loop()
+        queue = iter(packets)
+
+        async def worker():
+            for packet in queue:
+                future = loop.create_future()
+                self._send(packet, time.monotonic(), future)
+                await future
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        self.result.elapsed = time.monotonic() - start
+        return self.result
+
+    async def run_open(self, packets, qps):
+        """Sends packets at a fixed rate of qps, never waiting for replies."""
+        interval = 1.0 / qps
+        return await self.run_timed((i * interval, packet) for i, packet in enumerate(packets))
+
+    async def run_timed(self, schedule):
+        """
+        Sends each (offset, packet) from schedule `offset` seconds after the
+        start, never waiting for replies; an offset of None means "now".
+        schedule may be a generator, so a long capture is never held in memory.
+        """
+        start = time.monotonic()
+        for i, (offset, packet) in enumerate(schedule):
+            if i % 64 == 0:
+                await asyncio.sleep(0) # Let replies in even when running flat out
+            if offset is None:
+                scheduled = time.monotonic()
+            else:
+                scheduled = start + offset
+                delay = scheduled - time.monotonic()
+                if delay > 0.001:
+                    await asyncio.sleep(delay)
+            while len(self._pending) >= MAX_OUTSTANDING:
+                await asyncio.sleep(0.001)
+            self._send(packet, scheduled)
+        await self._drain()
+        self.result.elapsed = time.monotonic() - start
+        return self.result
+
+
+async def run_load(queries, server, port=53, mode="closed", concurrency=DEFAULT_CONCURRENCY,
+                   qps=None, repeat=1, timeout=DEFAULT_TIMEOUT):
+    """Replays queries (repeat times) against server:port and returns a LoadResult."""
+    generator = LoadGenerator(server, port, timeout)
+    packets = LoadGenerator.build_packets(queries) * repeat
+    await generator.open()
+    try:
+        if mode == "open":
+            return await generator.run_open(packets, qps)
+        return await generator.run_closed(packets, concurrency)
+    finally:
+        generator.close()
+
+
+def print_summary(name, stats):
+    """Prints a run summary in the format the Mininet scripts have always used."""
+    latency = stats["latency_ms"]
+    fmt = lambda v: "n/a" if v is None else f"{v:.2f}"
+    print(f"Results for {name}:")
+    print(f"  ✅ Successful Resolutions: {stats['noerror']}")
+    print(f"  ❌ Failed Resolutions....: {stats['sent'] - stats['noerror']}"
+          f" ({stats['timeouts']} timed out)")
+    print(f"  ⏱️  Average Lookup Latency: {fmt(latency['mean'])} ms")
+    print(f"  📊 Latency p50/p90/p99...: {fmt(latency['p50'])} / {fmt(latency['p90'])}"
+          f" / {fmt(latency['p99'])} ms (max {fmt(latency['max'])})")
+    print(f"  🚀 Average Throughput....: {stats['throughput_qps']:.2f} QPS\n")
+
+
+def _host_command(query_file, server, concurrency, qps, buckets=False):
+    cmd = ['python3', os.path.abspath(__file__), query_file, '--json']
+    if server:
+        cmd += ['--server', server]
+    cmd += ['--qps', str(qps)] if qps else ['--concurrency', str(concurrency)]
+    if buckets:
+        cmd.append('--buckets')
+    return cmd
+
+
+def _last_json(output):
+    for line in reversed(output.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    return None
+
+
+def run_on_host(host, query_file, server=None, concurrency=DEFAULT_CONCURRENCY, qps=None):
+    """
+    Runs the generator inside a Mininet host's network namespace (against
+    the host's default resolver unless server is given) and returns its
+    summary dict, or None if it produced no result.
+    """
+    return _last_json(host.cmd(' '.join(_host_command(query_file, server, concurrency, qps))))
+
+
+def start_on_host(host, query_file, server=None, concurrency=DEFAULT_CONCURRENCY, qps=None):
+    """
+    Like run_on_host(), but returns at once with the running process, so
+    several hosts can generate load together; finish_on_host() collects it.
+    The summary includes latency buckets (see combine_summaries()).
+    """
+    return host.popen(_host_command(query_file, server, concurrency, qps, buckets=True))
+
+
+def finish_on_host(process):
+    """Waits for a start_on_host() process and returns its summary dict, or None."""
+    output, _ = process.communicate()
+    return _last_json(output.decode() if isinstance(output, bytes) else output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay DNS queries against a resolver")
+    parser.add_argument("queries", help="queriesN.txt or a pcap to replay")
+    parser.add_argument("--server", default=None, help="Resolver address (default: /etc/resolv.conf)")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Closed loop: queries kept outstanding")
+    parser.add_argument("--qps", type=float, default=None,
+                        help="Open loop: send at this fixed rate instead")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the query list this many times")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument("--name", default=None, help="Label for the printed report")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    parser.add_argument("--buckets", action="store_true",
+                        help="Include the raw latency histogram in the JSON (for combine_summaries())")
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries)
+    server = args.server or default_server()
+    result = asyncio.run(run_load(queries, server, args.port,
+                                  mode="open" if args.qps else "closed",
+                                  concurrency=args.concurrency, qps=args.qps,
+                                  repeat=args.repeat, timeout=args.timeout))
+    if args.json:
+        print(json.dumps(result.summary(args.buckets)))
+    else:
+        print_summary(args.name or args.queries, result.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+"""
+Local authoritative data: hosts.conf and optional RFC 1035 zone files.
+
+Everything is compiled at load time into one dict keyed on the question
+as it appears on the wire (lowercased qname + qtype), whose values are
+the prepacked sections of the reply. Answering a matching query is then
+a dict lookup plus a 12-byte header, with the client's own question
+copied back in; no DNSRecord is built and resolve_iterative() is never
+entered.
+
+The files are checked for changes at most once every RELOAD_CHECK
+seconds; a changed file is reloaded on a background thread and the new
+index swapped in whole, so lookups never see a half-built table.
+"""
+import os
+import socket
+import struct
+import threading
+import time
+from dnslib import DNSBuffer, QTYPE, RCODE, RR
+from dns_wire import text_name, wire_name
+from resolver_logging import logger
+from upstream_pool import question_key
+
+# --- Local Data Settings ---
+HOSTS_FILE = 'hosts.conf'
+HOSTS_TTL = 300          # TTL of answers built from hosts.conf
+RELOAD_CHECK = 1.0       # Seconds between checks for changed files
+
+_SECTION_COUNTS = struct.Struct("!BHHH")   # rcode, answer, authority, additional
+_A_RR = b"\xc0\x0c\x00\x01\x00\x01"        # Owner = the question name, type A, class IN
+_AAAA_RR = b"\xc0\x0c\x00\x1c\x00\x01"
+_HOSTS_A = (_SECTION_COUNTS.pack(0, 1, 0, 0) + _A_RR      # Everything but the address
+            + struct.pack("!IH", HOSTS_TTL, 4))
+
+
+class _FlatBuffer(DNSBuffer):
+    """DNSBuffer without name compression, so packed records can be pasted anywhere."""
+
+    def encode_name(self, name):
+        self.encode_name_nocompress(name)
+
+
+def _pack_rrs(rrs):
+    buffer = _FlatBuffer()
+    for rr in rrs:
+        rr.pack(buffer)
+    return buffer.data
+
+
+class LocalIndex:
+    """
+    One immutable snapshot of the local data.
+
+    records: question key (wire qname + qtype) -> packed counts + sections
+    names:   every wire qname in records (other types get NODATA)
+    hosts:   dotted name -> IPv4 address, for plain one-name-per-line hosts files
+    zones:   zone apex wire name -> packed SOA, for NXDOMAIN/NODATA answers
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.names = set()
+        self.hosts = {}
+        self.zones = {}
+
+    def __len__(self):
+        return len(self.records) + len(self.hosts)
+
+    def add_hosts(self, path):
+        """Loads `address name [aliases...]` lines. Returns the number of entries."""
+        with open(path, 'rb') as f:
+            data = f.read().lower()
+        if not self.hosts and self._add_plain_hosts(data):
+            return len(self.hosts)
+        records, names = self.records, self.names
+        ttl = struct.pack("!I", HOSTS_TTL)
+        added = skipped = 0
+        for line in data.splitlines():
+            if b"#" in line:
+                line = line.split(b"#", 1)[0]
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            try:
+                if b":" in fields[0]:
+                    rr = _AAAA_RR + ttl + b"\x00\x10" + socket.inet_pton(socket.AF_INET6, fields[0].decode())
+                    qtype = b"\x00\x1c"
+                else:
+                    rr = _A_RR + ttl + b"\x00\x04" + socket.inet_pton(socket.AF_INET, fields[0].decode())
+                    qtype = b"\x00\x01"
+                for name in fields[1:]:
+                    qname = wire_name(name)
+                    key = qname + qtype
+                    old = records.get(key)
+                    if old is None:
+                        records[key] = b"\x00\x00\x01\x00\x00\x00\x00" + rr # NOERROR, 1 answer
+                    else:
+                        rcode, an, ns, ar = _SECTION_COUNTS.unpack_from(old)
+                        records[key] = _SECTION_COUNTS.pack(rcode, an + 1, ns, ar) + old[7:] + rr
+                    names.add(qname)
+                    added += 1
+            except (OSError, ValueError, UnicodeDecodeError):
+                skipped += 1
+        if skipped:
+            logger.warning(f"{path}: skipped {skipped} malformed entries")
+        return added
+
+    def _add_plain_hosts(self, data):
+        """
+        Bulk path for large generated files: one IPv4 address and one name
+        per line, no comments, no blank lines, no repeated names. The whole
+        file is split and converted with map()/dict() instead of line by
+        line, which keeps a million entries around one second. Returns False
+        (having changed nothing) for anything else.
+        """
+        if b"#" in data or b":" in data:
+            return False
+        tokens = data.split()
+        lines = data.count(b"\n") + (not data.endswith(b"\n"))
+        if not tokens or len(tokens) != 2 * lines:
+            return False
+        try:
+            addresses = map(socket.inet_aton, map(bytes.decode, tokens[0::2]))
+            hosts = dict(zip(tokens[1::2], addresses))
+        except (OSError, UnicodeDecodeError):
+            return False
+        if len(hosts) != lines or any(name.endswith(b".") for name in hosts):
+            return False
+        self.hosts = hosts
+        return True
+
+    def add_zone(self, path):
+        """Loads an RFC 1035 master file. Returns the number of records."""
+        with open(path, 'r') as f:
+            rrs = RR.fromZone(f.read())
+        grouped = {}
+        for rr in rrs:
+            if rr.rclass != 1:
+                continue
+            qname = wire_name(str(rr.rname).encode())
+            grouped.setdefault((qname, rr.rtype), []).append(rr)
+            self.names.add(qname)
+            if rr.rtype == QTYPE.SOA:
+                self.zones[qname] = _pack_rrs([rr])
+        for (qname, rtype), group in grouped.items():
+            self.records[qname + struct.pack("!H", rtype)] = (
+                _SECTION_COUNTS.pack(0, len(group), 0, 0) + _pack_rrs(group))
+        return len(rrs)
+
+    def lookup(self, qname, qtype):
+        """
+        Returns the packed counts + sections answering (qname, qtype), or
+        None if the name is not ours to answer.
+        """
+        found = self.records.get(qname + struct.pack("!H", qtype))
+        if found is not None:
+            return found
+        if self.hosts and qname:
+            address = self.hosts.get(text_name(qname))
+            if address is not None:
+                if qtype == QTYPE.A:
+                    return _HOSTS_A + address
+                return _SECTION_COUNTS.pack(RCODE.NOERROR, 0, 0, 0) # NODATA
+        if qname in self.names:
+            cname = self.records.get(qname + b"\x00\x05")
+            if cname is not None:
+                return cname # Client follows the CNAME itself
+            return self._negative(qname, RCODE.NOERROR) # NODATA
+        return self._negative(qname, RCODE.NXDOMAIN)
+
+    def _negative(self, qname, rcode):
+        """NXDOMAIN/NODATA with the enclosing zone's SOA, or None outside our zones."""
+        pos = 0
+        while True:
+            soa = self.zones.get(qname[pos:])
+            if soa is not None:
+                return _SECTION_COUNTS.pack(rcode, 0, 1, 0) + soa
+            if pos >= len(qname):
+                break
+            pos += qname[pos] + 1
+        if rcode == RCODE.NOERROR: # A hosts.conf name without this record type
+            return _SECTION_COUNTS.pack(rcode, 0, 0, 0)
+        return None
+
+
+class LocalZones:
+    """
+    The resolver's local authoritative data. answer() returns a complete
+    packed reply for queries it covers and None for everything else.
+    """
+
+    def __init__(self, hosts_path=None, zone_paths=()):
+        self.hosts_path = hosts_path
+        self.zone_paths = list(zone_paths)
+        self.index = LocalIndex()
+        self.answered = 0
+        self._mtimes = {}
+        self._next_check = 0.0
+        self._reloading = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def _paths(self):
+        return ([self.hosts_path] if self.hosts_path else []) + self.zone_paths
+
+    def _stat(self):
+        mtimes = {}
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+                mtimes[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def load(self, hosts_path=None, zone_paths=None):
+        """(Re)builds the index from the configured files and swaps it in."""
+        if hosts_path is not None:
+            self.hosts_path = hosts_path
+        if zone_paths is not None:
+            self.zone_paths = list(zone_paths)
+        mtimes = self._stat()
+        start = time.monotonic()
+        index = LocalIndex()
+        if self.hosts_path and mtimes.get(self.hosts_path):
+            index.add_hosts(self.hosts_path)
+        for path in self.zone_paths:
+            try:
+                index.add_zone(path)
+            except Exception as e:
+                logger.warning(f"Could not load zone file {path}: {e}")
+        self.index = index
+        self._mtimes = mtimes
+        self._next_check = time.monotonic() + RELOAD_CHECK
+        logger.info(f"Loaded {len(index)} local records in {time.monotonic() - start:.2f} s")
+        return len(index)
+
+    def _check_reload(self, now):
+        self._next_check = now + RELOAD_CHECK
+        if self._reloading or self._stat() == self._mtimes:
+            return
+        self._reloading = True
+        def reload():
+            try:
+                self.load()
+            finally:
+                self._reloading = False
+        threading.Thread(target=reload, name="local-zones-reload", daemon=True).start()
+
+    def answer(self, data):
+        """Returns the reply (wire format) to a client query for local data, or None."""
+        now = time.monotonic()
+        if now >= self._next_check and self._mtimes:
+            self._check_reload(now)
+        index = self.index
+        if not index or len(data) < 12 or data[2] & 0xF8: # Not a standard QUERY
+            return None
+        question = question_key(data)
+        if question is None or question[2] != 1:
+            return None
+        qname, qtype, _ = question
+        found = index.lookup(qname, qtype)
+        if found is None:
+            return None
+        self.answered += 1
+        rcode, an, ns, ar = _SECTION_COUNTS.unpack_from(found)
+        end = 12 + len(qname) + 5
+        # QR + AA, RD copied from the query, RA; the question is echoed as sent.
+        header = struct.pack("!2sBBHHHH", data[:2], 0x84 | (data[2] & 0x01), 0x80 | rcode, 1, an, ns, ar)
+        return header + data[12:end] + found[7:]
+
+
+def describe_local(reply):
+    """Summarises a LocalZones reply for the "response" log field."""
+    rcode = reply[3] & 0x0F
+    if rcode != RCODE.NOERROR:
+        return RCODE[rcode]
+    if reply[6:8] == b"\x00\x00":
+        return "NODATA"
+    pos = 12
+    while reply[pos]:
+        pos += reply[pos] + 1
+    pos += 5 # Final zero byte, qtype, qclass
+    rtype, rdlength = struct.unpack_from("!H6xH", reply, pos + 2)
+    rdata = reply[pos + 12:pos + 12 + rdlength]
+    if rtype == QTYPE.A and rdlength == 4:
+        return f"RESPONSE: A={socket.inet_ntop(socket.AF_INET, rdata)}"
+    if rtype == QTYPE.AAAA and rdlength == 16:
+        return f"RESPONSE: AAAA={socket.inet_ntop(socket.AF_INET6, rdata)}"
+    return f"RESPONSE: {QTYPE.get(rtype, rtype)} (local)"
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import numpy as np
+
+# --- Record Extraction ---
+# Query records carry their keys in the order new_log_data() creates them,
+# in both the original str(dict) format and the JSON format, so one regex
+# per quoting style pulls every field we need out of a whole block at once.
+# Groups: query key (timestamp..domain), domain, first letter of step,
+# rtt, total_time, first letter of cache_status.
+def _record_re(q):
+    field = q + r"%s" + q + r":\s?"
+    value = q + r"[^" + q + r"]*" + q
+    return re.compile((
+        r"^\{" + field % "timestamp" + q + r"([^" + q + r"]*" + q + r",\s?" + field % "domain"
+        + q + r"([^" + q + r"]*))" + q + r",\s?"
+        + field % "resolution_mode" + value + r",\s?" + field % "server_ip" + value + r",\s?"
+        + field % "step" + q + r"(\w)[^" + q + r"]*" + q + r",\s?" + field % "response" + value + r",\s?"
+        + field % "rtt" + r"([-0-9.eE+]+),\s?" + field % "total_time" + r"([-0-9.eE+]+),\s?"
+        + field % "cache_status" + q + r"(\w)"
+    ).encode(), re.MULTILINE)
+
+RECORD_RES = (_record_re('"'), _record_re("'"))   # JSON, str(dict)
+
+BLOCK_SIZE = 8 * 1024 * 1024   # Bytes of log read and parsed per chunk
+HOP_STEPS = ("Root", "TLD", "Authoritative")
+STEP_CODES = {b"R": "Root", b"T": "TLD", b"A": "Authoritative"}
+MAX_OPEN_QUERIES = 100000      # Queries whose FINAL record has not been seen yet
+
+# --- Latency Histogram (log-spaced bins, ~1% relative error) ---
+BINS = np.logspace(-3, 5, 8 * 200 + 1)   # 1 us .. 100 s, in ms
+MAX_SERVERS = 64
+
+
+def read_blocks(path, block_size=BLOCK_SIZE):
+    """Yields the log as byte blocks that always end on a line boundary."""
+    with open(path, 'rb') as f:
+        carry = b""
+        while True:
+            data = f.read(block_size)
+            if not data:
+                if carry:
+                    yield carry
+                return
+            data = carry + data
+            cut = data.rfind(b"\n") + 1
+            if cut == 0:
+                carry = data
+                continue
+            carry = data[cut:]
+            yield data[:cut]
+
+
+def percentiles(hist, qs=(50, 95, 99)):
+    """Approximate percentiles (ms) from a BINS histogram."""
+    total = hist.sum()
+    if total == 0:
+        return {f"p{q}": None for q in qs}
+    cumulative = np.cumsum(hist)
+    upper = BINS[1:]
+    return {f"p{q}": float(upper[np.searchsorted(cumulative, total * q / 100.0)]) for q in qs}
+
+
+class LogAnalyzer:
+    """
+    One-pass, bounded-memory aggregation of resolver.log. Each byte block is
+    parsed with one regex and aggregated with NumPy; only histograms,
+    per-domain totals and the queries still awaiting their FINAL record
+    are kept between blocks.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.final_count = 0
+        self.cache_hits = 0
+        self.total_hist = np.zeros(len(BINS) - 1, dtype=np.int64)
+        self.step_hist = {step: np.zeros(len(BINS) - 1, dtype=np.int64) for step in HOP_STEPS}
+        self.step_sum = dict.fromkeys(HOP_STEPS, 0.0)
+        self.servers_hist = np.zeros(MAX_SERVERS + 1, dtype=np.int64)
+        self.domain_ids = {}                 # domain -> index, in order of first appearance
+        self.domain_queries = np.zeros(1024)
+        self.domain_hops = np.zeros(1024)
+        self.domain_time = np.zeros(1024)
+        self._open_queries = {}              # timestamp+domain -> hops seen so far
+
+    def _domain_index(self, domains):
+        """Maps an array of domain names onto stable per-domain indices."""
+        uniques, inverse = np.unique(domains, return_inverse=True)
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for i, domain in enumerate(uniques.tolist()):
+            domain = domain.decode(errors="replace")
+            index = self.domain_ids.get(domain)
+            if index is None:
+                index = self.domain_ids[domain] = len(self.domain_ids)
+            ids[i] = index
+        size = len(self.domain_ids)
+        if size > len(self.domain_queries):
+            grow = max(size, 2 * len(self.domain_queries)) - len(self.domain_queries)
+            for name in ("domain_queries", "domain_hops", "domain_time"):
+                setattr(self, name, np.concatenate([getattr(self, name), np.zeros(grow)]))
+        return ids[inverse]
+
+    def feed(self, block):
+        record_re = RECORD_RES[1] if b"{'timestamp'" in block[:65536] else RECORD_RES[0]
+        rows = record_re.findall(block)
+        if not rows:
+            return
+        keys, domains, steps, rtts, totals, cache = zip(*rows)
+        steps = np.frombuffer(b"".join(steps), dtype="S1")
+        cache = np.frombuffer(b"".join(cache), dtype="S1")
+        rtts = np.array(b" ".join(rtts).split(), dtype=np.float64)
+        totals = np.array(b" ".join(totals).split(), dtype=np.float64)
+        keys = np.array(keys)
+        domains = np.array(domains)
+        self.records += len(rows)
+
+        final = steps == b"F"
+        hop = ~final  # Cache hits and coalesced answers only ever log a FINAL record
+        ids = self._domain_index(domains)
+        size = len(self.domain_queries)
+
+        # --- FINAL records: latency, cache hits, per-domain totals ---
+        self.final_count += int(final.sum())
+        self.cache_hits += int((final & (cache == b"H")).sum())
+        self.total_hist += np.histogram(totals[final], BINS)[0]
+        self.domain_queries += np.bincount(ids[final], minlength=size)
+        self.domain_time += np.bincount(ids[final], weights=totals[final], minlength=size)
+        self.domain_hops += np.bincount(ids[hop], minlength=size)
+
+        # --- Hop records: RTT per step ---
+        for code, step in STEP_CODES.items():
+            mask = hop & (steps == code)
+            self.step_hist[step] += np.histogram(rtts[mask], BINS)[0]
+            self.step_sum[step] += float(rtts[mask].sum())
+
+        # --- Servers visited per query (hops between a query's start and FINAL) ---
+        hop_keys, hop_counts = np.unique(keys[hop], return_counts=True)
+        open_queries = self._open_queries
+        for key, count in zip(hop_keys.tolist(), hop_counts.tolist()):
+            open_queries[key] = open_queries.get(key, 0) + count
+        finished = [open_queries.pop(key, 0) for key in keys[final].tolist()]
+        if finished:
+            self.servers_hist += np.bincount(np.minimum(finished, MAX_SERVERS), minlength=MAX_SERVERS + 1)
+        while len(open_queries) > MAX_OPEN_QUERIES: # Sub-resolutions never get a FINAL
+            del open_queries[next(iter(open_queries))]
+
+    def analyze(self, path):
+        for block in read_blocks(path):
+            self.feed(block)
+        return self
+
+    def report(self):
+        servers = np.arange(MAX_SERVERS + 1)
+        queries = int(self.servers_hist.sum())
+        report = {
+            "records": self.records,
+            "queries": self.final_count,
+            "cache_hit_ratio": self.cache_hits / self.final_count if self.final_count else None,
+            "total_time_ms": percentiles(self.total_hist),
+            "servers_visited": {
+                "mean": float((servers * self.servers_hist).sum() / queries) if queries else None,
+                "max": int(servers[self.servers_hist > 0].max()) if queries else None,
+            },
+            "step_rtt_ms": {},
+        }
+        for step in HOP_STEPS:
+            count = int(self.step_hist[step].sum())
+            report["step_rtt_ms"][step] = dict(
+                count=count, mean=self.step_sum[step] / count if count else None,
+                **percentiles(self.step_hist[step]))
+        return report
+
+    def first_domains(self, n):
+        """(domain, mean servers visited per query, mean latency) for the first n domains."""
+        rows = []
+        for domain, index in self.domain_ids.items():
+            queries = self.domain_queries[index]
+            if queries == 0:
+                continue # Only ever seen as a glueless sub-resolution
+            rows.append((domain, self.domain_hops[index] / queries, self.domain_time[index] / queries))
+            if len(rows) == n:
+                break
+        return rows
+
+
+def make_plots(analyzer, first, label, out_dir="."):
+    """Regenerates plot1_servers_visited.png and plot2_latency.png."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rows = analyzer.first_domains(first)
+    domains = [row[0] for row in rows]
+    plots = [
+        ("plot1_servers_visited.png", [row[1] for row in rows], "teal",
+         f"Plot 1: Total DNS Servers Visited per Query (First {first} of {label})",
+         "Number of Servers Visited"),
+        ("plot2_latency.png", [row[2] for row in rows], "coral",
+         f"Plot 2: Total Resolution Latency per Query (First {first} of {label})",
+         "Total Latency (ms)"),
+    ]
+    for filename, values, color, title, ylabel in plots:
+        fig, ax = plt.subplots(figsize=(12, 6))
+        ax.bar(domains, values, color=color, width=0.5)
+        ax.set_title(title)
+        ax.set_xlabel("Domain Name")
+        ax.set_ylabel(ylabel)
+        plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
+        fig.tight_layout()
+        fig.savefig(os.path.join(out_dir, filename))
+        plt.close(fig)
+        print(f"Wrote {os.path.join(out_dir, filename)}")
+
+
+def write_synthetic_log(path, records, log_format="json"):
+    """Writes a resolver.log-shaped file of `records` lines for benchmarking."""
+    rng = random.Random(1)
+    domains = [f"host{i}.example{i % 50}.com." for i in range(5000)]
+    with open(path, "w") as f:
+        written = 0
+        while written < records:
+            domain = rng.choice(domains)
+            timestamp = f"2025-10-29T04:01:{written % 60:02d}.{written % 1000000:06d}"
+            cached = rng.random() < 0.3
+            steps = [] if cached else ["TLD", "Authoritative", "Authoritative"]
+            total = 0.0
+            for step in steps + ["FINAL"]:
+                rtt = 0.0 if cached else rng.uniform(5, 200)
+                total += rtt
+                record = {
+                    "timestamp": timestamp, "domain": domain,
+                    "resolution_mode": "cache" if cached else "iterative",
+                    "server_ip": "198.41.0.4", "step": step, "response": "REFERRAL",
+                    "rtt": rtt, "total_time": total if step == "FINAL" else 0.0,
+                    "cache_status": "HIT" if cached else "MISS",
+                }
+                f.write((json.dumps(record) if log_format == "json" else str(record)) + "\n")
+                written += 1
+
+
+def _ms(value):
+    return "n/a" if value is None else f"{value:.2f}"
+
+
+def run_benchmark(records, log_format):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "resolver.log")
+        write_synthetic_log(path, records, log_format)
+        size_mb = os.path.getsize(path) / 1e6
+        start = time.perf_counter()
+        analyzer = LogAnalyzer().analyze(path)
+        elapsed = time.perf_counter() - start
+    print(f"Analyzed {analyzer.records:,} {log_format} records ({size_mb:.0f} MB) in {elapsed:.2f} s "
+          f"-> {analyzer.records / elapsed:,.0f} records/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise resolver.log and regenerate its plots")
+    parser.add_argument("log", nargs="?", default="resolver.log")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--plots", action="store_true", help="Regenerate plot1/plot2 PNGs")
+    parser.add_argument("--first", type=int, default=10, help="Domains shown in the plots")
+    parser.add_argument("--label", default="H1", help="Host label used in plot titles")
+    parser.add_argument("--benchmark", type=int, metavar="N",
+                        help="Time the analyzer on N synthetic records instead")
+    parser.add_argument("--benchmark-format", choices=["json", "repr"], default="json")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.benchmark, args.benchmark_format)
+        return
+
+    analyzer = LogAnalyzer().analyze(args.log)
+    report = analyzer.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Records: {report['records']:,}   Queries: {report['queries']:,}")
+        if report["cache_hit_ratio"] is not None:
+            print(f"Cache hit ratio: {report['cache_hit_ratio']:.1%}")
+        t = report["total_time_ms"]
+        print(f"Total time (ms): p50={_ms(t['p50'])}  p95={_ms(t['p95'])}  p99={_ms(t['p99'])}")
+        print(f"Servers visited per query: mean={_ms(report['servers_visited']['mean'])}  "
+              f"max={report['servers_visited']['max']}")
+        print("Per-step RTT (ms):")
+        for step, stats in report["step_rtt_ms"].items():
+            print(f"  {step:<13} n={stats['count']:<8} mean={_ms(stats['mean'])}  "
+                  f"p50={_ms(stats['p50'])}  p95={_ms(stats['p95'])}  p99={_ms(stats['p99'])}")
+    if args.plots:
+        make_plots(analyzer, args.first, args.label)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+"""
+In-process resolver metrics in the Prometheus text format.
+
+Request paths record into a few module-level histograms (no lock and no
+allocation per observation once a label set has been bound); totals
+that other objects already keep (cache hits, upstream timeouts, ...) are
+read through callbacks only when the metrics are rendered. The result is
+served on http://METRICS_HOST:port/metrics and, optionally, written to a
+snapshot file every few seconds.
+
+GET /debug/profile?seconds=N samples every thread's stack for N seconds
+and returns the samples as collapsed stacks (one "frame;frame;... count"
+line each, the input format of flamegraph.pl / speedscope).
+
+In pre-fork mode every worker serves its own numbers on port + 1 + its
+index (and writes snapshot_path.<index>).
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# --- Metrics Settings ---
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9153            # As CoreDNS's prometheus plugin; 0 disables the endpoint
+SNAPSHOT_INTERVAL = 10.0       # Seconds between snapshot file writes
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0)   # Histogram upper bounds, in seconds
+
+# --- Sampling Profiler ---
+PROFILE_INTERVAL = 0.005       # Seconds between stack samples
+MAX_PROFILE_SECONDS = 60
+
+_registry = []
+_state = {"host": METRICS_HOST, "port": 0, "snapshot_path": None, "interval": SNAPSHOT_INTERVAL,
+          "server": None, "started": False}
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class _Series:
+    """The buckets of one label set of a Histogram."""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        # No lock: under the GIL a thread switch between the read and the
+        # write of an increment is rare, and at worst loses one sample.
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram:
+    """
+    A labelled histogram with fixed buckets (seconds). Hot paths bind a
+    label set once with labels() and call observe() on the result.
+    """
+
+    def __init__(self, name, help_text, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}   # label values -> _Series
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *label_values):
+        """The _Series for one set of label values, created on first use."""
+        series = self._series.get(label_values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(label_values, _Series(self.buckets))
+        return series
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values) or self.labels(*label_values)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    def reset(self):
+        for series in list(self._series.values()):
+            series.counts = [0] * len(series.counts)
+            series.sum = 0.0
+
+    def render(self):
+        snapshot = [(labels, list(series.counts), series.sum) for labels, series in list(self._series.items())]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts, total in sorted(snapshot):
+            base = _labels(self.label_names, label_values)
+            sep = base[:-1] + "," if base else "{"
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{sep}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{base} {total:.6f}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+class Collected:
+    """
+    A counter or gauge whose value is read from elsewhere at render time.
+    read() returns a number, or a dict of label values tuple -> number.
+    """
+
+    def __init__(self, name, help_text, kind, read, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.read = read
+        self.label_names = label_names
+        _registry.append(self)
+
+    def reset(self):
+        pass
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return [] # The source is not set up (yet)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if isinstance(value, dict):
+            for label_values, number in sorted(value.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, label_values)} {number}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+def counter(name, help_text, read, label_names=()):
+    """Registers a counter read from read() when metrics are rendered."""
+    return Collected(name, help_text, "counter", read, label_names)
+
+
+def gauge(name, help_text, read, label_names=()):
+    """Registers a gauge read from read() when metrics are rendered."""
+    return Collected(name, help_text, "gauge", read, label_names)
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Hot-path Timings ---
+STAGE_SECONDS = Histogram("dns_stage_seconds", "Time spent in each stage of answering a client query",
+                          ("stage",))
+QUERY_SECONDS = Histogram("dns_query_seconds", "Client query latency by how it was answered",
+                          ("cache_status",))
+UPSTREAM_SECONDS = Histogram("dns_upstream_hop_seconds", "Upstream round trip time by step",
+                             ("step",))
+PARSE_SECONDS, LOOKUP_SECONDS, RESOLVE_SECONDS, REPLY_SECONDS = (
+    STAGE_SECONDS.labels(stage) for stage in ("parse", "lookup", "resolve", "reply"))
+
+
+# --- Sampling Profiler ---
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """
+    Samples the stack of every other thread every interval seconds and
+    returns collapsed stacks ("thread;outer;...;inner count" lines),
+    most frequent first.
+    """
+    me = threading.get_ident()
+    names = {}
+    samples = Counter()
+    deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+    while time.monotonic() < deadline:
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            body, content_type = render(), "text/plain; version=0.0.4"
+        elif url.path == "/debug/profile":
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", ["5"])[0])
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            body, content_type = sample_stacks(seconds), "text/plain"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are not worth a line each
+
+
+def _write_snapshots(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(render())
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+
+def configure_metrics(port=METRICS_PORT, host=METRICS_HOST, snapshot_path=None, interval=SNAPSHOT_INTERVAL):
+    """Sets where metrics are served/written; start_metrics() does the rest."""
+    _state.update(port=port, host=host, snapshot_path=snapshot_path, interval=interval)
+
+
+def start_metrics(worker=None):
+    """
+    Starts the /metrics endpoint and snapshot writer as configured. A
+    pre-forked worker passes its index: it starts from zero and gets a
+    port and snapshot file of its own.
+    """
+    if _state["started"]:
+        return
+    _state["started"] = True
+    port, path = _state["port"], _state["snapshot_path"]
+    if worker is not None:
+        for metric in _registry:
+            metric.reset() # Counts inherited from the parent are not ours
+        port = port + 1 + worker if port else 0
+        path = f"{path}.{worker}" if path else None
+    if port:
+        try:
+            server = ThreadingHTTPServer((_state["host"], port), _MetricsHandler)
+        except OSError as e:
+            print(f"Metrics endpoint not started on {_state['host']}:{port}: {e}", file=sys.stderr)
+        else:
+            server.daemon_threads = True
+            _state["server"] = server
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    if path:
+        threading.Thread(target=_write_snapshots, args=(path, _state["interval"]),
+                         name="metrics-snapshot", daemon=True).start()
+
+
+def _forget_in_child():
+    # Threads do not survive fork; a worker calls start_metrics(index) itself.
+    _state["started"] = False
+    _state["server"] = None
+
+
+os.register_at_fork(after_in_child=_forget_in_child)
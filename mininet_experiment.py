@@ -0,0 +1,214 @@
+#!/usr/bin/python
+"""
+One parameterised Mininet experiment for every DNS task.
+
+Builds the assignment topology once (optionally with more client hosts),
+then for each resolver mode replays the query files from every client
+host at the same time and writes one report:
+
+  default   clients ask the system resolver (DEFAULT_NAMESERVER, via NAT)
+  custom    clients ask custom_resolver_multithreaded.py on the dns host
+
+Each host runs load_generator.py in its own namespace; per-host results
+are kept and also combined into aggregate throughput and latency
+percentiles over all hosts' samples.
+
+  sudo python3 mininet_experiment.py                              # both modes, 4 clients
+  sudo python3 mininet_experiment.py --clients 32 --concurrency 8 --modes custom -- --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from mininet.topo import Topo
+from mininet.net import Mininet
+from mininet.node import OVSController
+from mininet.link import TCLink
+from mininet.log import setLogLevel, info
+from load_generator import combine_summaries, finish_on_host, print_summary, start_on_host
+
+# --- Experiment Defaults ---
+MODES = ("default", "custom")
+DEFAULT_NAMESERVER = "8.8.8.8"
+MAX_CLIENTS = 250            # Client addresses left in 10.0.0.0/24 beside dns and the NAT
+QUERY_FILES = ["queries1.txt", "queries2.txt", "queries3.txt", "queries4.txt"]
+RESOLVER_STARTUP = 2.0       # Seconds to let the custom resolver start
+REPORT_FILE = "experiment_report.json"
+
+
+class NetworkTopo(Topo):
+    """
+    The assignment topology:
+    H1-S1-S2-S3-S4-H4
+         |  |  |
+         H2 |  H3
+            |
+           DNS
+    Clients beyond h4 hang off s1..s4 in turn, like h1..h4.
+    """
+
+    def build(self, clients=4):
+        "Build the custom topology."
+        # Add switches
+        switches = [self.addSwitch(f's{i}') for i in range(1, 5)]
+
+        # Define link parameters for clarity
+        link_params = {'bw': 100} # Bandwidth is 100Mbps for all links
+
+        # Add client hosts; 10.0.0.5 belongs to the DNS host
+        for i in range(1, clients + 1):
+            host = self.addHost(f'h{i}', ip=f'10.0.0.{i if i < 5 else i + 1}/24')
+            self.addLink(host, switches[(i - 1) % 4], delay='2ms', **link_params)
+
+        dns = self.addHost('dns', ip='10.0.0.5/24') # This is the DNS Resolver
+        self.addLink(dns, switches[1], delay='1ms', **link_params)
+
+        # Add links between switches
+        self.addLink(switches[0], switches[1], delay='5ms', **link_params)
+        self.addLink(switches[1], switches[2], delay='8ms', **link_params)
+        self.addLink(switches[2], switches[3], delay='10ms', **link_params)
+
+
+def build_network(clients=4, nat=True):
+    """Creates and starts the topology (with NAT to the internet). Returns the Mininet object."""
+    if not 1 <= clients <= MAX_CLIENTS:
+        raise ValueError(f"clients must be between 1 and {MAX_CLIENTS}")
+    net = Mininet(topo=NetworkTopo(clients=clients), link=TCLink, controller=OVSController)
+    if nat:
+        net.addNAT().configDefault()
+    net.start()
+    info("✅ Network started successfully.\n")
+    return net
+
+
+def client_hosts(net):
+    """The client hosts h1..hN, in order."""
+    return sorted((host for host in net.hosts if host.name[0] == 'h' and host.name[1:].isdigit()),
+                  key=lambda host: int(host.name[1:]))
+
+
+def start_resolver(dns_host, resolver_args=()):
+    """Starts custom_resolver_multithreaded.py on the dns host and returns its process."""
+    info(f"*** Starting DNS server on {dns_host.name}...\n")
+    script = os.path.abspath('custom_resolver_multithreaded.py')
+    with open('dns_server_output.log', 'w') as output:
+        process = dns_host.popen(['python3', script, '--host', dns_host.IP(), *resolver_args],
+                                 stdout=output, stderr=output)
+    time.sleep(RESOLVER_STARTUP)
+    if process.poll() is not None:
+        raise RuntimeError("custom resolver exited at startup; see dns_server_output.log")
+    info("✅ DNS server started.\n")
+    return process
+
+
+def stop_resolver(process):
+    """Stops the custom resolver (SIGTERM, so it saves its cache snapshot)."""
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except Exception:
+        process.kill()
+
+
+def run_load(hosts, server, query_files, concurrency=1, qps=None, sequential=False):
+    """
+    Replays a query file from every host against server, all hosts at
+    once (or one after another if sequential). Returns ({host name:
+    summary}, wall-clock seconds).
+    """
+    results = {}
+    start = time.monotonic()
+    batches = [[host] for host in hosts] if sequential else [hosts]
+    for batch in batches:
+        running = {}
+        for host in batch:
+            query_file = query_files[(int(host.name[1:]) - 1) % len(query_files)]
+            if not os.path.exists(query_file):
+                info(f"⚠️  Could not find {query_file}. Skipping host {host.name}.\n")
+                continue
+            info(f"--- Running queries for {host.name} from {query_file} against {server} ---\n")
+            running[host.name] = start_on_host(host, query_file, server, concurrency, qps)
+        for name, process in running.items():
+            stats = finish_on_host(process)
+            if stats is None:
+                info(f"❌ Load generator failed on {name}.\n")
+                continue
+            results[name] = stats
+    return results, time.monotonic() - start
+
+
+def run_mode(net, mode, query_files, concurrency=1, qps=None, sequential=False, resolver_args=()):
+    """Runs one resolver mode on a started network and returns its part of the report."""
+    hosts = client_hosts(net)
+    dns_host = net.get('dns')
+    server = DEFAULT_NAMESERVER if mode == "default" else dns_host.IP()
+    hosts[0].cmd(f'echo "nameserver {server}" > /etc/resolv.conf') # Hosts share /etc
+
+    resolver = start_resolver(dns_host, resolver_args) if mode == "custom" else None
+    try:
+        per_host, elapsed = run_load(hosts, server, query_files, concurrency, qps, sequential)
+    finally:
+        if resolver is not None:
+            stop_resolver(resolver)
+
+    aggregate = combine_summaries(list(per_host.values()), elapsed) if per_host else None
+    for stats in per_host.values():
+        del stats["latency_buckets"] # Only needed for the aggregate
+    return {"server": server, "elapsed_s": elapsed, "hosts": per_host, "aggregate": aggregate}
+
+
+def print_report(report):
+    """Prints every host's and each mode's aggregate summary."""
+    for mode, result in report["modes"].items():
+        print(f"\n===== {mode} resolver ({result['server']}) =====\n")
+        for name, stats in result["hosts"].items():
+            print_summary(name, stats)
+        if result["aggregate"]:
+            print_summary(f"all {len(result['hosts'])} hosts", result["aggregate"])
+
+
+def run_experiment(modes=MODES, clients=4, query_files=QUERY_FILES, concurrency=1, qps=None,
+                   sequential=False, resolver_args=(), report_file=REPORT_FILE):
+    """Builds the network once, runs each mode on it and returns (and saves) the report."""
+    net = build_network(clients)
+    report = {"clients": clients, "concurrency": concurrency, "qps": qps,
+              "sequential": sequential, "resolver_args": list(resolver_args), "modes": {}}
+    try:
+        for mode in modes:
+            report["modes"][mode] = run_mode(net, mode, query_files, concurrency, qps, sequential, resolver_args)
+    finally:
+        net.stop()
+        info("🛑 Simulation finished.\n")
+
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    print_report(report)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mininet DNS experiment: all client hosts at once")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES),
+                        help="Resolver modes to run, in order, on the same network")
+    parser.add_argument("--clients", type=int, default=4, help=f"Client hosts (1-{MAX_CLIENTS})")
+    parser.add_argument("--queries", nargs="+", default=QUERY_FILES, metavar="FILE",
+                        help="Query files; host hN replays file N (cycling through the list)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Queries kept outstanding per host")
+    parser.add_argument("--qps", type=float, default=None, help="Per-host open-loop rate instead")
+    parser.add_argument("--sequential", action="store_true",
+                        help="One host at a time, as the old per-task scripts did")
+    parser.add_argument("--report", default=REPORT_FILE, help="Where to write the JSON report ('' to skip)")
+    parser.add_argument("resolver_args", nargs=argparse.REMAINDER,
+                        help="After '--': extra arguments for custom_resolver_multithreaded.py")
+    args = parser.parse_args()
+    if args.resolver_args[:1] == ["--"]:
+        args.resolver_args = args.resolver_args[1:]
+    return args
+
+
+if __name__ == '__main__':
+    setLogLevel('info')
+    args = parse_args()
+    run_experiment(args.modes, args.clients, args.queries, args.concurrency, args.qps,
+                   args.sequential, args.resolver_args, args.report)
@@ -0,0 +1,430 @@
+#!/usr/bin/python3
+"""
+Answers for names that do not exist, without going upstream.
+
+NegativeCache remembers what negative responses prove beyond the one
+question they answered and synthesises NXDOMAIN from it:
+
+  - an NXDOMAIN holds for every query type of the name and for every
+    name beneath it (RFC 8020);
+  - an NSEC record proves that no name sorts between its owner and its
+    next name, and NSEC3 records do the same for hashed names (RFC 8198
+    aggressive use, with the closest encloser and wildcard checks of
+    RFC 4035 section 5.4 and RFC 5155 section 8.4). One NXDOMAIN from
+    the root for wpad. thus also answers every other missing TLD that
+    falls in the same NSEC range.
+
+Signed zones only send these records when asked with the DO bit, which
+is why upstream queries set it; strip_dnssec() takes the extra records
+out again before anything is cached or sent to a client. This resolver
+does not validate signatures, so the ranges are trusted only as far as
+the server that sent them: learn() is told the zone that server was
+delegated for and ignores any SOA or NSEC/NSEC3 outside it (a server for
+evil.com. cannot speak for com.), and nothing is kept for longer than
+the negative TTL of the response's SOA.
+
+JunkFilter picks out names that should never leave the local network
+(a fixed list of probes such as wpad. and isatap., mDNS .local names
+and other special-use names) so they get NXDOMAIN at once, and FailureLimiter
+stops a client's identical failing queries from being resolved again
+and again.
+"""
+import base64
+import binascii
+import bisect
+import hashlib
+import struct
+import threading
+import time
+from collections import OrderedDict
+from dnslib import DNSHeader, DNSLabel, DNSQuestion, DNSRecord, QTYPE, RCODE, RR
+from dns_cache import cache_key, negative_ttl
+
+# --- Aggressive Negative Caching (RFC 8198, RFC 8020) ---
+MAX_NEGATIVE_NAMES = 10000     # NXDOMAIN names remembered (each also covers the names below it)
+MAX_NSEC_RANGES = 50000        # NSEC/NSEC3 ranges remembered, over all zones
+MAX_NSEC3_ITERATIONS = 100     # Zones hashing more often than this are not used (RFC 9276 section 3.2)
+DNSSEC_TYPES = (QTYPE.RRSIG, QTYPE.NSEC, QTYPE.NSEC3)
+_NSEC3_SHA1 = 1
+_NSEC3_OPT_OUT = 0x01
+
+# --- Junk Queries (NXDOMAIN at once, never sent upstream) ---
+JUNK_ZONES = ("local.", "invalid.", "onion.")   # mDNS (RFC 6762), RFC 6761, RFC 7686
+JUNK_NAMES = ("wpad.", "isatap.")               # Single-label probes from proxy and IPv6 autodiscovery
+
+# --- Repeated Failing Queries (per client) ---
+FAILURE_LIMIT = 3              # Identical failing queries from one client resolved per window (0: no limit)
+FAILURE_WINDOW = 30.0          # Seconds; further repeats get the last reply back
+MAX_FAILURE_ENTRIES = 10000    # (client, question) pairs tracked at once
+
+
+def _key(name):
+    """
+    Canonical sort key of a name (RFC 4034 section 6.1): its lowercased
+    labels, top-level first, so a zone's names are exactly the keys that
+    start with the zone's key.
+    """
+    if not isinstance(name, DNSLabel):
+        name = DNSLabel(name)
+    return tuple(label.lower() for label in reversed(name.label))
+
+
+def _common(a, b):
+    """Key of the deepest name that is an ancestor of (or equal to) both a and b."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return a[:n]
+
+
+def _nsec3_hash(key, salt, iterations):
+    """RFC 5155 section 5: iterated SHA-1 of the name in canonical wire format."""
+    digest = b"".join(bytes((len(label),)) + label for label in reversed(key)) + b"\x00"
+    for _ in range(iterations + 1):
+        digest = hashlib.sha1(digest + salt).digest()
+    return digest
+
+
+def _is_cut(bitmap):
+    """True if an NSEC3 type bitmap shows a delegation (NS without SOA) or a DNAME."""
+    pos = 0
+    while pos + 2 <= len(bitmap):
+        window, length = bitmap[pos], bitmap[pos + 1]
+        bits = bitmap[pos + 2:pos + 2 + length]
+        if window == 0:
+            def has(rtype):
+                return len(bits) > rtype // 8 and bits[rtype // 8] & (0x80 >> rtype % 8)
+            return bool(has(QTYPE.NS) and not has(QTYPE.SOA) or has(QTYPE.DNAME))
+        pos += 2 + length
+    return False
+
+
+def strip_dnssec(response, qtype):
+    """
+    Drops the RRSIG, NSEC and NSEC3 records a DO query brings in (unless
+    they are what was asked for), so the cache and clients get the same
+    answers as without it.
+    """
+    for section in ("rr", "auth", "ar"):
+        records = getattr(response, section)
+        kept = [rr for rr in records if rr.rtype not in DNSSEC_TYPES or rr.rtype == qtype]
+        if len(kept) != len(records):
+            setattr(response, section, kept)
+    return response
+
+
+def nxdomain_response(qname, qtype, qclass=1, soa=None, ttl=0):
+    """An NXDOMAIN for one question, with the zone's SOA (TTL ttl) if given."""
+    response = DNSRecord(DNSHeader(qr=1, rd=1, ra=1, rcode=RCODE.NXDOMAIN), q=DNSQuestion(qname, qtype, qclass))
+    if soa is not None:
+        response.add_auth(RR(soa.rname, QTYPE.SOA, soa.rclass, ttl, soa.rdata))
+    return response
+
+
+class _Zone:
+    """
+    What is known to be missing from one zone: its SOA and the NSEC or
+    NSEC3 ranges seen so far, each sorted by owner for bisection.
+    """
+    __slots__ = ("key", "soa", "soa_expires", "owners", "nsec", "params", "hashes", "nsec3")
+
+    def __init__(self, key):
+        self.key = key
+        self.soa = None
+        self.soa_expires = 0.0
+        self.owners = []    # NSEC owner keys
+        self.nsec = {}      # owner key -> (next key, is a zone cut, expires)
+        self.params = None  # NSEC3 (salt, iterations)
+        self.hashes = []    # NSEC3 owner hashes
+        self.nsec3 = {}     # owner hash -> (next hash, opt-out, is a zone cut, expires)
+
+    def __len__(self):
+        return len(self.nsec) + len(self.nsec3)
+
+    def add_nsec(self, owner, next_key, cut, expires):
+        if owner not in self.nsec:
+            bisect.insort(self.owners, owner)
+        self.nsec[owner] = (next_key, cut, expires)
+
+    def add_nsec3(self, owner, next_hash, opt_out, cut, expires, params):
+        if params != self.params: # New salt or iterations: the old hashes mean nothing now
+            self.params, self.hashes, self.nsec3 = params, [], {}
+        if owner not in self.nsec3:
+            bisect.insort(self.hashes, owner)
+        self.nsec3[owner] = (next_hash, opt_out, cut, expires)
+
+    def _nsec_covering(self, key, now):
+        """The live NSEC (owner, next key, expires) proving no name key exists, or None."""
+        i = bisect.bisect_right(self.owners, key) - 1
+        if i < 0:
+            return None
+        owner = self.owners[i]
+        next_key, cut, expires = self.nsec[owner]
+        if owner == key or expires <= now:
+            return None
+        if cut and key[:len(owner)] == owner: # Below a delegation: the child zone decides
+            return None
+        if key < next_key or next_key <= owner: # The last NSEC wraps round to the apex
+            return owner, next_key, expires
+        return None
+
+    def nsec_proof(self, key, now):
+        """Expiry of cached NSECs proving key is NXDOMAIN (name and wildcard both missing), or None."""
+        covering = self._nsec_covering(key, now)
+        if covering is None:
+            return None
+        owner, next_key, expires = covering
+        wildcard = max(_common(key, owner), _common(key, next_key), key=len) + (b"*",)
+        if wildcard == key:
+            return None
+        wildcard_covering = self._nsec_covering(wildcard, now)
+        if wildcard_covering is None:
+            return None
+        return min(expires, wildcard_covering[2])
+
+    def _nsec3_covering(self, digest, now):
+        """The live NSEC3 entry whose range holds digest (strictly), or None."""
+        if not self.hashes:
+            return None
+        owner = self.hashes[bisect.bisect_right(self.hashes, digest) - 1] # -1: the wrapping last one
+        entry = self.nsec3[owner]
+        next_hash, expires = entry[0], entry[3]
+        if owner == digest or expires <= now:
+            return None
+        if owner < digest < next_hash or next_hash <= owner and (digest > owner or digest < next_hash):
+            return entry
+        return None
+
+    def nsec3_proof(self, key, now):
+        """
+        Expiry of cached NSEC3s proving key is NXDOMAIN, or None: an
+        existing closest encloser, the next closer name covered by a range
+        without opt-out, and no wildcard at the closest encloser.
+        """
+        if self.params is None:
+            return None
+        salt, iterations = self.params
+        next_closer = None
+        for n in range(len(key), len(self.key) - 1, -1):
+            digest = _nsec3_hash(key[:n], salt, iterations)
+            match = self.nsec3.get(digest)
+            if match is not None and match[3] > now:
+                break
+            next_closer = digest
+        else:
+            return None
+        if next_closer is None or match[2]: # The name exists, or lies below a delegation
+            return None
+        covering = self._nsec3_covering(next_closer, now)
+        if covering is None or covering[1]:
+            return None
+        wildcard = self._nsec3_covering(_nsec3_hash(key[:n] + (b"*",), salt, iterations), now)
+        if wildcard is None:
+            return None
+        return min(match[3], covering[3], wildcard[3])
+
+
+class NegativeCache:
+    """
+    Thread-safe store of NXDOMAIN names and NSEC/NSEC3 ranges, fed every
+    negative response by learn() and asked by lookup() before a question
+    that missed the answer cache goes upstream. synthesised counts the
+    NXDOMAIN answers made up from it.
+    """
+
+    def __init__(self, max_names=MAX_NEGATIVE_NAMES, max_ranges=MAX_NSEC_RANGES):
+        self.max_names = max_names
+        self.max_ranges = max_ranges
+        self._names = OrderedDict()   # name key -> (expires, zone key)
+        self._zones = OrderedDict()   # zone key -> _Zone, least recently learnt first
+        self._ranges = 0
+        self._lock = threading.Lock()
+        self.synthesised = 0
+
+    def __len__(self):
+        return len(self._names) + self._ranges
+
+    def clear(self):
+        """Forgets everything."""
+        with self._lock:
+            self._names.clear()
+            self._zones.clear()
+            self._ranges = 0
+
+    def learn(self, qname, response, zone):
+        """
+        Remembers what an NXDOMAIN or NODATA response for qname proves about
+        other names. zone is the zone the answering server was delegated
+        for: an SOA (and so any NSEC/NSEC3) outside it is not believed.
+        """
+        soa = next((rr for rr in response.auth if rr.rtype == QTYPE.SOA), None)
+        ttl = negative_ttl(response) if soa is not None else None
+        if not ttl:
+            return
+        zone_key, name_key, server_key = _key(soa.rname), _key(qname), _key(zone)
+        if zone_key[:len(server_key)] != server_key: # Not the server's to speak for
+            return
+        if name_key[:len(zone_key)] != zone_key: # SOA of some other zone
+            return
+        now = time.monotonic()
+        expires = now + ttl
+        with self._lock:
+            zone = self._zones.pop(zone_key, None)
+            if zone is None:
+                zone = _Zone(zone_key)
+            self._zones[zone_key] = zone
+            self._ranges -= len(zone)
+            zone.soa, zone.soa_expires = soa, expires
+            if response.header.rcode == RCODE.NXDOMAIN:
+                self._names.pop(name_key, None)
+                self._names[name_key] = (expires, zone_key)
+                while len(self._names) > self.max_names:
+                    self._names.popitem(last=False)
+            for rr in response.auth:
+                if rr.rtype == QTYPE.NSEC:
+                    self._learn_nsec(zone, rr, min(now + rr.ttl, expires))
+                elif rr.rtype == QTYPE.NSEC3:
+                    self._learn_nsec3(zone, rr, min(now + rr.ttl, expires))
+            self._ranges += len(zone)
+            while self._ranges > self.max_ranges and len(self._zones) > 1:
+                _, dropped = self._zones.popitem(last=False)
+                self._ranges -= len(dropped)
+
+    def _learn_nsec(self, zone, rr, expires):
+        owner, next_key = _key(rr.rname), _key(rr.rdata.label)
+        if owner[:len(zone.key)] != zone.key or next_key[:len(zone.key)] != zone.key:
+            return
+        types = rr.rdata.rrlist
+        zone.add_nsec(owner, next_key, "NS" in types and "SOA" not in types or "DNAME" in types, expires)
+
+    def _learn_nsec3(self, zone, rr, expires):
+        owner = _key(rr.rname)
+        if len(owner) != len(zone.key) + 1 or owner[:-1] != zone.key:
+            return
+        try:
+            rdata = bytes(rr.rdata.data)
+            algorithm, flags, iterations, salt_length = struct.unpack_from("!BBHB", rdata)
+            pos = 5 + salt_length
+            salt, hash_length = rdata[5:pos], rdata[pos]
+            next_hash = rdata[pos + 1:pos + 1 + hash_length]
+            owner_hash = base64.b32hexdecode(owner[-1].upper())
+        except (AttributeError, IndexError, struct.error, binascii.Error):
+            return
+        if algorithm != _NSEC3_SHA1 or iterations > MAX_NSEC3_ITERATIONS or len(next_hash) != len(owner_hash):
+            return
+        zone.add_nsec3(owner_hash, next_hash, bool(flags & _NSEC3_OPT_OUT),
+                       _is_cut(rdata[pos + 1 + hash_length:]), expires, (salt, iterations))
+
+    def lookup(self, qname, qtype, qclass=1):
+        """
+        Returns a synthesised NXDOMAIN (DNSRecord) for a question the
+        cached negative answers already settle, or None. Its TTLs are
+        what is left of the records it was built from.
+        """
+        if qclass != 1:
+            return None
+        key = _key(qname)
+        now = time.monotonic()
+        with self._lock:
+            found = self._below_nxdomain(key, now)
+            for n in range(len(key) - 1, -1, -1):
+                if found is not None:
+                    break
+                zone = self._zones.get(key[:n])
+                if zone is not None:
+                    expires = zone.nsec_proof(key, now) or zone.nsec3_proof(key, now)
+                    found = (zone.key, expires) if expires else None
+            if found is None:
+                return None
+            zone = self._zones.get(found[0])
+            if zone is None or zone.soa_expires <= now:
+                return None
+            ttl = int(min(found[1], zone.soa_expires) - now)
+            if ttl <= 0:
+                return None
+            self.synthesised += 1
+            soa = zone.soa
+        return nxdomain_response(qname, qtype, qclass, soa, ttl)
+
+    def _below_nxdomain(self, key, now):
+        """(zone key, expires) of a live NXDOMAIN for key or one of its ancestors, or None."""
+        for n in range(len(key), 0, -1):
+            found = self._names.get(key[:n])
+            if found is not None and found[0] > now:
+                return found[1], found[0]
+        return None
+
+
+class JunkFilter:
+    """
+    Recognises questions that have no business going upstream: the names
+    in JUNK_NAMES and anything under JUNK_ZONES, whatever the query type.
+    The answer depends on the name alone, never on what is cached.
+    suppressed counts them.
+    """
+
+    def __init__(self, zones=JUNK_ZONES, names=JUNK_NAMES):
+        self.zones = tuple(cache_key(zone, 0)[0] for zone in zones)
+        self.names = frozenset(cache_key(name, 0)[0] for name in names)
+        self.suppressed = 0
+
+    def is_junk(self, qname):
+        name = cache_key(qname, 0)[0]
+        junk = name in self.names or any(name == zone or name.endswith('.' + zone) for zone in self.zones)
+        if junk:
+            self.suppressed += 1
+        return junk
+
+
+class FailureLimiter:
+    """
+    Per-client limit on repeats of a failing question (SERVFAIL, REFUSED,
+    NXDOMAIN or no answer at all). Once a client has had limit failures
+    for the same question within window seconds, its further repeats are
+    answered with the last failing reply instead of being resolved again,
+    until the window is over. limited counts the replies repeated so.
+    """
+
+    def __init__(self, limit=FAILURE_LIMIT, window=FAILURE_WINDOW, max_entries=MAX_FAILURE_ENTRIES):
+        self.limit = limit
+        self.window = window
+        self.max_entries = max_entries
+        self._failures = OrderedDict()   # (client, cache key) -> [failures, window end, last reply]
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def replay(self, client, key):
+        """
+        The reply to send again to client for this question while it is
+        over the limit (b"" if resolution gave none: answer SERVFAIL), or
+        None if the question may be resolved. client None: not limited.
+        """
+        if not self.limit or client is None:
+            return None
+        with self._lock:
+            entry = self._failures.get((client, key))
+            if entry is None or entry[0] < self.limit or entry[1] <= time.monotonic():
+                return None
+            self.limited += 1
+            return entry[2]
+
+    def record(self, client, key, packed):
+        """Notes how resolving a question for client ended (packed: the reply, or None)."""
+        if not self.limit or client is None:
+            return
+        failed = not packed or packed[3] & 0x0F != RCODE.NOERROR
+        now = time.monotonic()
+        with self._lock:
+            if not failed:
+                self._failures.pop((client, key), None)
+                return
+            entry = self._failures.pop((client, key), None)
+            if entry is None or entry[1] <= now:
+                entry = [0, now + self.window, b""]
+            entry[0] += 1
+            entry[2] = bytes(packed or b"")
+            self._failures[(client, key)] = entry
+            while len(self._failures) > self.max_entries:
+                self._failures.popitem(last=False)
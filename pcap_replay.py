@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+"""
+Streaming reader, statistics and replay for the captured client traffic
+(p1.pcap .. p4.pcap).
+
+The capture is memory-mapped and walked record by record with
+struct.unpack_from, so only the DNS questions themselves are ever copied
+out of it; a multi-hundred-megabyte capture costs no more memory than a
+small one. Classic pcap (micro- or nanosecond) and pcapng are read, over
+Ethernet (with 802.1Q tags), Linux cooked (SLL/SLL2), BSD loopback and
+raw IP link types, IPv4 or IPv6.
+
+  pcap_replay.py p2.pcap                      popularity / cache-sizing stats
+  pcap_replay.py p2.pcap --extract q.txt      write the questions as a queries file
+  pcap_replay.py p2.pcap --replay --speed 10  replay at 10x, keeping inter-arrival gaps
+  pcap_replay.py p2.pcap --replay --speed max replay back to back
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import struct
+from collections import Counter, OrderedDict
+from dnslib import QTYPE
+from load_generator import LoadGenerator, DEFAULT_TIMEOUT, default_server, print_summary
+
+# --- Capture Formats ---
+PCAP_MAGIC = {                        # magic -> (byte order, timestamp unit)
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6), b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9), b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"   # Section Header Block type
+
+LINK_NULL, LINK_ETHERNET, LINK_RAW, LINK_LOOP, LINK_SLL, LINK_SLL2 = 0, 1, 101, 108, 113, 276
+RAW_LINK_TYPES = {LINK_RAW, 12, 14}
+
+RELEASE_EVERY = 64 * 1024 * 1024   # Bytes parsed before their pages are dropped from RSS
+
+DNS_PORT = 53
+CACHE_SIZES = (100, 1000, 10000, 100000)   # Entry counts simulated for LRU hit ratios
+
+
+def is_capture(path):
+    """True if path looks like a pcap or pcapng file."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return magic in PCAP_MAGIC or magic == PCAPNG_MAGIC
+
+
+class PcapReader:
+    """
+    Memory-maps a capture and yields (timestamp, linktype, start, end) for
+    each record; the frame is buf[start:end] and is never copied.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._released = 0
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.buf.madvise(mmap.MADV_SEQUENTIAL)
+
+    def _release(self, pos):
+        """Lets the kernel drop the pages already parsed (they are re-read if touched)."""
+        end = pos - pos % mmap.PAGESIZE
+        if end - self._released >= RELEASE_EVERY and hasattr(mmap, "MADV_DONTNEED"):
+            self.buf.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        magic = self.buf[:4]
+        if magic in PCAP_MAGIC:
+            return self._pcap(*PCAP_MAGIC[magic])
+        if magic == PCAPNG_MAGIC:
+            return self._pcapng()
+        raise ValueError("not a pcap or pcapng capture")
+
+    def _pcap(self, order, unit):
+        buf, size = self.buf, len(self.buf)
+        record = struct.Struct(order + "IIII")
+        linktype = struct.unpack_from(order + "I", buf, 20)[0] & 0xFFFF
+        pos = 24
+        while pos + 16 <= size:
+            seconds, fraction, caplen, _ = record.unpack_from(buf, pos)
+            start = pos + 16
+            pos = start + caplen
+            if pos > size:
+                return # Truncated final record
+            yield seconds + fraction * unit, linktype, start, pos
+            if pos - self._released >= RELEASE_EVERY:
+                self._release(start)
+
+    def _pcapng(self):
+        buf, size = self.buf, len(self.buf)
+        order = "<"
+        interfaces = [] # (linktype, timestamp unit) per Interface Description Block
+        pos = 0
+        while pos + 12 <= size:
+            block_type = struct.unpack_from(order + "I", buf, pos)[0]
+            if block_type == 0x0A0D0D0A: # Section header: byte order may change
+                order = "<" if buf[pos + 8:pos + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+                interfaces = []
+            block_len = struct.unpack_from(order + "I", buf, pos + 4)[0]
+            if block_len < 12 or pos + block_len > size:
+                return
+            if block_type == 1: # Interface Description
+                interfaces.append((struct.unpack_from(order + "H", buf, pos + 8)[0],
+                                   self._tsresol(order, pos, block_len)))
+            elif block_type == 6: # Enhanced Packet
+                iface, high, low, caplen = struct.unpack_from(order + "IIII", buf, pos + 8)
+                linktype, unit = interfaces[iface] if iface < len(interfaces) else (LINK_ETHERNET, 1e-6)
+                yield ((high << 32) | low) * unit, linktype, pos + 28, pos + 28 + caplen
+            elif block_type == 3: # Simple Packet (no timestamp)
+                linktype = interfaces[0][0] if interfaces else LINK_ETHERNET
+                caplen = min(struct.unpack_from(order + "I", buf, pos + 8)[0], block_len - 16)
+                yield None, linktype, pos + 12, pos + 12 + caplen
+            if pos - self._released >= RELEASE_EVERY:
+                self._release(pos)
+            pos += block_len
+
+    def _tsresol(self, order, pos, block_len):
+        """Timestamp unit from an Interface Description Block's if_tsresol option."""
+        opt, end = pos + 16, pos + block_len - 4
+        while opt + 4 <= end:
+            code, length = struct.unpack_from(order + "HH", self.buf, opt)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = self.buf[opt + 4]
+                return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+            opt += 4 + (length + 3) // 4 * 4
+        return 1e-6
+
+
+# --- Frame Decoding ---
+def _network_offset(buf, start, end, linktype):
+    """Offset of the IP header in a frame, or None for anything else."""
+    if linktype == LINK_ETHERNET:
+        pos = start + 12
+        ethertype = struct.unpack_from("!H", buf, pos)[0] if pos + 2 <= end else 0
+        while ethertype in (0x8100, 0x88A8) and pos + 6 <= end: # VLAN tags
+            pos += 4
+            ethertype = struct.unpack_from("!H", buf, pos)[0]
+        return pos + 2 if ethertype in (0x0800, 0x86DD) else None
+    if linktype == LINK_SLL:
+        return start + 16
+    if linktype == LINK_SLL2:
+        return start + 20
+    if linktype in (LINK_NULL, LINK_LOOP):
+        return start + 4
+    if linktype in RAW_LINK_TYPES:
+        return start
+    return None
+
+
+def _udp_payload(buf, start, end, linktype):
+    """(payload start, destination port) of a UDP datagram in a frame, or None."""
+    ip = _network_offset(buf, start, end, linktype)
+    if ip is None or ip + 40 > end:
+        return None
+    version = buf[ip] >> 4
+    if version == 4:
+        if buf[ip + 9] != 17:
+            return None
+        udp = ip + (buf[ip] & 0x0F) * 4
+    elif version == 6:
+        if buf[ip + 6] != 17: # Extension headers are not followed
+            return None
+        udp = ip + 40
+    else:
+        return None
+    if udp + 8 > end:
+        return None
+    return udp + 8, struct.unpack_from("!H", buf, udp + 2)[0]
+
+
+def parse_question(buf, pos, end):
+    """(qname, qtype) of the DNS query at buf[pos:end], or None (responses included)."""
+    if end - pos < 17 or buf[pos + 2] & 0x80 or buf[pos + 4:pos + 6] == b"\x00\x00":
+        return None
+    # Copy out just the question name, then split it into labels.
+    zero = buf.find(b"\x00", pos + 12, end)
+    if zero < 0 or zero + 5 > end:
+        return None
+    raw = buf[pos + 12:zero]
+    labels = []
+    i, size = 0, len(raw)
+    while i < size:
+        length = raw[i]
+        if length & 0xC0:
+            return None
+        labels.append(raw[i + 1:i + 1 + length])
+        i += 1 + length
+    if i != size:
+        return None # A zero byte inside a label: not worth handling
+    qtype = struct.unpack_from("!H", buf, zero + 1)[0]
+    qname = b".".join(labels).decode("ascii", "replace").lower() or "."
+    return qname, qtype
+
+
+def dns_questions(path, port=DNS_PORT):
+    """
+    Yields (timestamp, qname, qtype) for every DNS query (UDP to `port`)
+    in a capture, in capture order. Timestamps are None for pcapng
+    Simple Packet Blocks.
+    """
+    with PcapReader(path) as reader:
+        buf = reader.buf
+        for ts, linktype, start, end in reader:
+            found = _udp_payload(buf, start, end, linktype)
+            if found is None or found[1] != port:
+                continue
+            question = parse_question(buf, found[0], end)
+            if question is not None:
+                yield ts, question[0], question[1]
+
+
+# --- Popularity and Cache-sizing Statistics ---
+class PopularityStats:
+    """
+    Counts questions as they stream past and simulates LRU caches of a few
+    sizes, to show how big the answer cache needs to be for this traffic.
+    TTLs are ignored, so the hit ratios are upper bounds.
+    """
+
+    def __init__(self, cache_sizes=CACHE_SIZES):
+        self.total = 0
+        self.questions = Counter()
+        self.qtypes = Counter()
+        self.first_ts = None
+        self.last_ts = None
+        self._lru = {size: OrderedDict() for size in cache_sizes}
+        self.lru_hits = {size: 0 for size in cache_sizes}
+
+    def add(self, ts, qname, qtype):
+        key = (qname, qtype)
+        self.total += 1
+        self.questions[key] += 1
+        self.qtypes[qtype] += 1
+        if ts is not None:
+            if self.first_ts is None:
+                self.first_ts = ts
+            self.last_ts = ts
+        for size, lru in self._lru.items():
+            if key in lru:
+                lru.move_to_end(key)
+                self.lru_hits[size] += 1
+            else:
+                lru[key] = None
+                if len(lru) > size:
+                    lru.popitem(last=False)
+
+    def feed(self, questions):
+        """Passes questions through unchanged, counting each one."""
+        for question in questions:
+            self.add(*question)
+            yield question
+
+    def report(self, top=20):
+        total = self.total or 1
+        duration = (self.last_ts - self.first_ts) if self.first_ts is not None else 0.0
+        ranked = self.questions.most_common()
+        coverage, covered, needed = {}, 0, 0
+        targets = [50, 90, 99]
+        for _, count in ranked:
+            covered += count
+            needed += 1
+            while targets and covered >= total * targets[0] / 100:
+                coverage[f"p{targets.pop(0)}"] = needed
+        return {
+            "queries": self.total,
+            "unique_questions": len(self.questions),
+            "unique_names": len({name for name, _ in self.questions}),
+            "duration_s": duration,
+            "mean_qps": self.total / duration if duration > 0 else None,
+            "qtypes": {QTYPE.get(qtype, f"TYPE{qtype}"): count for qtype, count in self.qtypes.most_common()},
+            # Best possible hit ratio: every repeat of a question is a hit
+            "infinite_cache_hit_ratio": 1 - len(self.questions) / total if self.total else 0.0,
+            "lru_hit_ratio": {str(size): hits / total for size, hits in self.lru_hits.items()},
+            # Most popular questions needed to cover 50/90/99% of queries
+            "entries_for_coverage": coverage,
+            "top": [{"name": name, "qtype": QTYPE.get(qtype, f"TYPE{qtype}"), "count": count,
+                     "share": count / total} for (name, qtype), count in ranked[:top]],
+        }
+
+
+# --- Replay ---
+def build_query(qname, qtype):
+    """A recursion-desired query packet (transaction ID 0, set when sent)."""
+    labels = b"".join(bytes([len(label)]) + label
+                      for label in qname.encode("ascii", "replace").split(b".") if label)
+    return struct.pack("!HHHHHH", 0, 0x0100, 1, 0, 0, 0) + labels + struct.pack("!BHH", 0, qtype, 1)
+
+
+def replay_schedule(questions, speed=1.0):
+    """
+    Turns (timestamp, qname, qtype) into (offset, packet) for
+    LoadGenerator.run_timed(), keeping the capture's inter-arrival gaps
+    divided by speed; speed None sends everything back to back.
+    """
+    first = None
+    for ts, qname, qtype in questions:
+        offset = None
+        if speed and ts is not None:
+            if first is None:
+                first = ts
+            offset = (ts - first) / speed
+        yield offset, build_query(qname, qtype)
+
+
+async def replay(questions, server, port=53, speed=1.0, timeout=DEFAULT_TIMEOUT):
+    """Replays questions against server:port open-loop. Returns a LoadResult."""
+    generator = LoadGenerator(server, port, timeout)
+    await generator.open()
+    try:
+        return await generator.run_timed(replay_schedule(questions, speed))
+    finally:
+        generator.close()
+
+
+def _limited(questions, limit):
+    for i, question in enumerate(questions):
+        if limit is not None and i >= limit:
+            return
+        yield question
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse or replay the DNS queries in a capture")
+    parser.add_argument("capture", help="pcap or pcapng file")
+    parser.add_argument("--limit", type=int, default=None, help="Use only the first N queries")
+    parser.add_argument("--top", type=int, default=20, help="Most popular questions listed")
+    parser.add_argument("--extract", metavar="FILE", help="Write the questions as a queriesN.txt-style file")
+    parser.add_argument("--replay", action="store_true", help="Replay the queries to a resolver")
+    parser.add_argument("--server", default=None, help="Resolver address (default: /etc/resolv.conf)")
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--speed", default="1", help="Replay speed: 1, N (times faster) or max")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    stats = PopularityStats()
+    questions = stats.feed(_limited(dns_questions(args.capture), args.limit))
+    output = {}
+    if args.replay:
+        speed = None if args.speed == "max" else float(args.speed)
+        result = asyncio.run(replay(questions, args.server or default_server(), args.port,
+                                    speed, args.timeout))
+        output["replay"] = result.summary()
+    elif args.extract:
+        with open(args.extract, 'w') as f:
+            for _, qname, qtype in questions:
+                f.write(f"{qname}\n" if qtype == QTYPE.A else f"{qname} {QTYPE.get(qtype, qtype)}\n")
+    else:
+        for _ in questions:
+            pass
+    output["stats"] = stats.report(args.top)
+
+    if args.json:
+        print(json.dumps(output))
+        return
+    report = output["stats"]
+    print(f"Queries: {report['queries']:,}   Unique questions: {report['unique_questions']:,}"
+          f"   Unique names: {report['unique_names']:,}")
+    if report["mean_qps"]:
+        print(f"Duration: {report['duration_s']:.1f} s   Mean rate: {report['mean_qps']:.1f} QPS")
+    print(f"Hit ratio with an unbounded cache: {report['infinite_cache_hit_ratio']:.1%}")
+    print("LRU hit ratio by size: " + ", ".join(f"{size}={ratio:.1%}"
+                                              for size, ratio in report["lru_hit_ratio"].items()))
+    print("Entries covering 50/90/99% of queries: " + " / ".join(
+        str(report["entries_for_coverage"].get(p, "n/a")) for p in ("p50", "p90", "p99")))
+    for entry in report["top"]:
+        print(f"  {entry['count']:>9,}  {entry['share']:6.2%}  {entry['name']} {entry['qtype']}")
+    if "replay" in output:
+        print()
+        print_summary(f"replay of {args.capture}", output["replay"])
+
+
+if __name__ == '__main__':
+    main()
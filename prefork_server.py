@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+import os
+import signal
+import sys
+import time
+from resolver_core import answer_cache
+from metrics import start_metrics
+from cache_snapshot import final_snapshot, start_snapshots
+from resolver_logging import flush_logs
+from shared_cache import SharedTable, DEFAULT_SIZE_MB
+
+# --- Worker Restarts ---
+MIN_WORKER_UPTIME = 5.0      # Seconds; a worker dying sooner counts as a failed start
+RESTART_BACKOFF = 0.5        # Seconds before restarting after a failed start; doubles each time
+MAX_FAILED_STARTS = 5        # Consecutive failed starts of one worker before giving up
+
+
+def _exit_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def serve_prefork(serve_worker, host, port, workers, shared_cache_mb=DEFAULT_SIZE_MB):
+    """
+    Forks `workers` processes that each run serve_worker(host, port,
+    reuse_port=True) on the same address. SO_REUSEPORT lets the kernel
+    spread incoming queries across them, so dnslib parsing is no longer
+    limited to one core by the GIL. The answer cache is backed by a shared
+    mmap table created before the fork, so every worker sees every
+    answer. The parent only supervises: it restarts workers that die
+    (backing off, and giving up if one keeps dying right after it starts)
+    and stops them all on SIGINT/SIGTERM.
+    """
+    answer_cache.attach(SharedTable(shared_cache_mb))
+
+    children = {}
+    started = {}       # index -> when its current worker was forked
+    failed_starts = {} # index -> consecutive deaths within MIN_WORKER_UPTIME
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, _exit_worker)
+            code = 0
+            try:
+                start_metrics(index) # This worker's own /metrics port and snapshot file
+                start_snapshots(index) # Worker 0 saves the caches for the next start
+                serve_worker(host, port, reuse_port=True)
+            except SystemExit:
+                pass
+            except BaseException as e:
+                print(f"Worker {index} exited: {e!r}", file=sys.stderr)
+                code = 1
+            finally:
+                final_snapshot()
+                flush_logs()
+                os._exit(code)
+        children[pid] = index
+        started[index] = time.monotonic()
+
+    def stop_all():
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        stop_all()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(workers):
+        spawn(index)
+    print(f"Started {workers} resolver workers (SO_REUSEPORT) on {host}:{port}")
+
+    while children:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        if time.monotonic() - started[index] >= MIN_WORKER_UPTIME:
+            failed_starts[index] = 0
+            print(f"Worker {index} (pid {pid}) died with status {status}; restarting")
+            spawn(index)
+            continue
+        failed_starts[index] = failures = failed_starts.get(index, 0) + 1
+        if failures >= MAX_FAILED_STARTS:
+            print(f"Worker {index} died {failures} times right after starting; giving up", file=sys.stderr)
+            stop_all()
+            raise SystemExit(1)
+        delay = RESTART_BACKOFF * 2 ** (failures - 1)
+        print(f"Worker {index} (pid {pid}) died with status {status} right after starting; "
+              f"restarting in {delay:g}s")
+        time.sleep(delay)
+        spawn(index)
@@ -0,0 +1,458 @@
+#!/usr/bin/python3
+"""
+Transport-independent parts of the custom resolver: root hints, logging,
+the shared caches, the steps of answering a client query (ClientQuery)
+and the iterative resolution state machine.
+
+iterative_walk() never touches a socket. For every hop it yields
+(server_ips, packet, time_left) and is sent back (server_ip,
+response_data, rtt_ms) from whichever server answered first within
+time_left seconds, or has socket.timeout / OSError thrown into it. When a referral comes without glue it yields an NSLookup
+instead and is sent back the nameservers' addresses. Either way the
+work is done by whichever engine drives the walk:
+blocking sockets in custom_resolver_multithreaded.py or asyncio in
+async_resolver.py. Both engines therefore give the same answers and
+write the same log records.
+"""
+import socket
+import threading
+import time
+from datetime import datetime
+from dnslib import DNSRecord, QTYPE, RCODE
+from dns_cache import (AnswerCache, DelegationCache, Delegation, HIT, HIT_PREFETCH, HIT_STALE, JUNK, LIMITED,
+                       LOCAL, NEGATIVE, PREFETCH, cache_key, describe_response, in_bailiwick, is_nodata,
+                       referral_delegation, step_for_zone)
+from dns_wire import finish_reply, question_packet, read_question, servfail_reply, stamp_reply
+from server_selection import ServerSelector
+from local_zones import LocalZones, describe_local
+from negative_answers import FailureLimiter, JunkFilter, NegativeCache, nxdomain_response, strip_dnssec
+from resolver_logging import logger, log_hop, log_final, dropped_records # Logging is set up by the entry point (Task D)
+import metrics
+
+# --- Root DNS Servers ---
+ROOT_SERVERS = [
+    '198.41.0.4',     # a.root-servers.net
+    '170.247.170.2',  # b.root-servers.net
+    '192.33.4.12',    # c.root-servers.net
+    '199.7.91.13',    # d.root-servers.net
+    '192.203.230.10', # e.root-servers.net
+    '192.5.5.241',    # f.root-servers.net
+    '192.112.36.4',   # g.root-servers.net
+    '198.97.190.53',  # h.root-servers.net
+    '192.36.148.17',  # i.root-servers.net
+    '192.58.128.30',  # j.root-servers.net
+    '193.0.14.129',   # k.root-servers.net
+    '199.7.83.42',    # l.root-servers.net
+    '202.12.27.33',   # m.root-servers.net
+]
+
+# --- Upstream Query Limits ---
+QUERY_TIME_BUDGET = 4.0  # Seconds one client query may spend upstream, retries and sub-resolutions included
+MAX_HOPS = 10
+
+# --- Client TCP (RFC 7766) ---
+SERVE_TCP = True                 # Also listen on TCP, for truncated replies and TCP-only clients
+CLIENT_TCP_IDLE_TIMEOUT = 10.0   # Seconds a client connection may sit with no query outstanding
+MAX_PIPELINED = 32               # Queries answered at once per client connection; reading pauses beyond
+
+# --- Negative Answers (see negative_answers.py) ---
+AGGRESSIVE_NSEC = True           # Ask upstream for NSEC/NSEC3 (DO bit) and answer from their ranges (RFC 8198)
+SUPPRESS_JUNK = True             # NXDOMAIN for wpad., *.local and the like without going upstream
+
+# --- Glueless Referral Limits ---
+MAX_QUERIES_PER_RESOLUTION = 48  # Upstream queries for one client query, sub-resolutions included
+MAX_GLUELESS_DEPTH = 3           # Nested "resolve the nameserver's name" levels
+MAX_GLUELESS_NS = 3              # NS names resolved in parallel for one referral
+
+# --- Answer and Delegation Caches (shared by every request) ---
+answer_cache = AnswerCache()
+delegation_cache = DelegationCache()
+
+# --- NXDOMAIN Knowledge, Junk Names and Failing Repeats ---
+negative_cache = NegativeCache()
+junk_filter = JunkFilter()
+failure_limiter = FailureLimiter()
+
+# --- Local Authoritative Data (hosts.conf, zone files; loaded by the entry point) ---
+local_zones = LocalZones()
+
+# --- Per-server Smoothed RTTs (used to pick and race upstream servers) ---
+server_selector = ServerSelector()
+
+# --- Metrics (read from the objects above whenever /metrics is rendered) ---
+metrics.counter("dns_cache_hits_total", "Answer cache hits", lambda: answer_cache.hits)
+metrics.counter("dns_cache_misses_total", "Answer cache misses", lambda: answer_cache.misses)
+metrics.counter("dns_cache_prefetches_total", "Background refreshes of hot answers", lambda: answer_cache.prefetches)
+metrics.counter("dns_cache_stale_served_total", "Expired answers served because upstream failed",
+                lambda: answer_cache.stale_served)
+metrics.gauge("dns_cache_entries", "Answers held in this process's cache", lambda: len(answer_cache))
+metrics.gauge("dns_delegations", "Zone cuts held in the delegation cache", lambda: len(delegation_cache))
+metrics.counter("dns_negative_synthesised_total", "NXDOMAIN answers synthesised from cached NXDOMAIN/NSEC/NSEC3",
+                lambda: negative_cache.synthesised)
+metrics.counter("dns_junk_suppressed_total", "Junk queries (wpad., *.local, ...) answered without going upstream",
+                lambda: junk_filter.suppressed)
+metrics.counter("dns_failing_repeats_limited_total", "Repeated failing client queries answered without resolving",
+                lambda: failure_limiter.limited)
+metrics.counter("dns_local_answers_total", "Queries answered from hosts.conf / local zones",
+                lambda: local_zones.answered)
+metrics.counter("dns_upstream_queries_total", "Queries sent upstream", lambda: server_selector.sent)
+metrics.counter("dns_upstream_timeouts_total", "Upstream queries that timed out", lambda: server_selector.timeouts)
+metrics.counter("dns_upstream_retries_total", "Upstream queries re-sent to a server that timed out",
+                lambda: server_selector.retries)
+metrics.counter("dns_upstream_throttled_total", "Upstream sends refused by the per-server rate limit",
+                lambda: server_selector.throttled)
+metrics.counter("dns_log_records_dropped_total", "Log records dropped because the writer fell behind",
+                dropped_records)
+
+
+def new_log_data(query_domain):
+    """Returns a fresh log record for one client query."""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "domain": query_domain,
+        "resolution_mode": "N/A", "server_ip": "N/A", "step": "N/A",
+        "response": "N/A", "rtt": 0.0, "total_time": 0.0,
+        "cache_status": "MISS"
+    }
+
+
+def cache_or_stale(query_domain, qtype, qclass, response, log_data):
+    """
+    Caches a freshly resolved response and returns it in wire format. If
+    resolution failed (no response, SERVFAIL or REFUSED) an expired answer
+    still inside the cache's stale window is returned instead (RFC 8767)
+    and the query is logged as HIT_STALE.
+    """
+    if response is not None:
+        response.ar = [rr for rr in response.ar if rr.rtype != QTYPE.OPT] # finish_reply() adds ours
+    if response is not None and response.header.rcode not in (RCODE.SERVFAIL, RCODE.REFUSED):
+        packed = bytes(response.pack())
+        answer_cache.put(query_domain, qtype, response, qclass, packed)
+        return packed
+    if log_data["cache_status"] == PREFETCH:
+        answer_cache.refresh_failed(query_domain, qtype, qclass)
+    stale = answer_cache.get_stale(query_domain, qtype, qclass)
+    if stale is None:
+        return bytes(response.pack()) if response is not None else None
+    log_data["cache_status"] = HIT_STALE
+    log_data["resolution_mode"] = "stale"
+    log_data["response"] = describe_response(DNSRecord.parse(stale), qtype)
+    return bytes(stale)
+
+
+def negative_answer(query_domain, qtype, qclass=1):
+    """
+    Answers a question that missed the cache without going upstream, if it
+    can: junk names get an NXDOMAIN at once (JUNK) and names a cached
+    NXDOMAIN or NSEC/NSEC3 range proves missing a synthesised one
+    (NEGATIVE), which is cached like any other answer. Returns
+    (cache_status, packed response) or None.
+    """
+    if SUPPRESS_JUNK and junk_filter.is_junk(query_domain):
+        return JUNK, bytes(nxdomain_response(query_domain, qtype, qclass).pack())
+    response = negative_cache.lookup(query_domain, qtype, qclass)
+    if response is None:
+        return None
+    packed = bytes(response.pack())
+    answer_cache.put(query_domain, qtype, response, qclass, packed)
+    return NEGATIVE, packed
+
+
+def build_reply(question, response_packet, udp=True):
+    """
+    Returns the reply to send back to a client (wire format): the packed
+    response stamped with the client's transaction ID, or a SERVFAIL if
+    resolution failed, with EDNS0 and UDP truncation applied.
+    """
+    if response_packet:
+        return finish_reply(stamp_reply(response_packet, question), question, udp)
+    return finish_reply(servfail_reply(question), question, udp)
+
+
+class ClientQuery:
+    """
+    One client query, taken through every step both engines share. The
+    constructor answers it from local data, the answer cache, negative
+    answers or the failure limiter if it can; otherwise key is set and the
+    engine resolves it through its single-flight group (the one step that
+    blocks or awaits) and hands the result to resolved(). prefetch asks
+    the engine to refresh the cached answer in the background. finish()
+    sends the reply, then records timings and writes the log record.
+    """
+    __slots__ = ("question", "udp", "client", "log_data", "local_reply", "response_packet", "key", "prefetch",
+                 "received", "looked_up", "start_total_time")
+
+    def __init__(self, client_data, udp=True, client=None):
+        self.received = time.perf_counter()
+        self.question = question = read_question(client_data) # Header and question only; no DNSRecord
+        query_domain = question.name
+        metrics.PARSE_SECONDS.observe(time.perf_counter() - self.received)
+        self.udp = udp
+        self.client = client
+        self.log_data = log_data = new_log_data(query_domain)
+        self.response_packet = None
+        self.key = None
+        self.prefetch = False
+
+        self.start_total_time = time.time()
+        lookup_start = time.perf_counter()
+        self.local_reply = local_zones.answer(client_data)
+        if self.local_reply is not None: # hosts.conf / local zone: prepacked answer
+            log_data["resolution_mode"] = "local"
+            log_data["cache_status"] = LOCAL
+            log_data["response"] = describe_local(self.local_reply)
+            self.looked_up = time.perf_counter()
+            metrics.LOOKUP_SECONDS.observe(self.looked_up - lookup_start)
+            return
+        cache_status, self.response_packet, summary = answer_cache.get_packed(query_domain, question.qtype,
+                                                                             question.qclass)
+        log_data["cache_status"] = cache_status
+        self.looked_up = time.perf_counter()
+        metrics.LOOKUP_SECONDS.observe(self.looked_up - lookup_start)
+        if cache_status in (HIT, HIT_PREFETCH):
+            log_data["resolution_mode"] = "cache"
+            log_data["response"] = summary
+            self.prefetch = cache_status == HIT_PREFETCH
+            return
+
+        key = cache_key(query_domain, question.qtype, question.qclass)
+        negative = negative_answer(query_domain, question.qtype, question.qclass)
+        replayed = failure_limiter.replay(client, key) if negative is None else None
+        if negative is not None: # Junk name, or known not to exist
+            log_data["cache_status"], self.response_packet = negative
+            log_data["resolution_mode"] = "negative"
+            log_data["response"] = "NXDOMAIN"
+        elif replayed is not None: # This client keeps asking a failing question
+            self.response_packet = replayed or None
+            log_data["cache_status"] = LIMITED
+            log_data["resolution_mode"] = "limited"
+            log_data["response"] = (describe_response(DNSRecord.parse(replayed), question.qtype)
+                                    if replayed else "SERVFAIL")
+        else:
+            self.key = key # Resolve it
+
+    def resolved(self, response_packet, shared):
+        """Takes the (response in wire format, shared) pair returned by the engine's single-flight do()."""
+        metrics.RESOLVE_SECONDS.observe(time.perf_counter() - self.looked_up)
+        failure_limiter.record(self.client, self.key, response_packet)
+        self.response_packet = response_packet
+        if shared:
+            self.log_data["resolution_mode"] = "coalesced"
+            if response_packet:
+                self.log_data["response"] = describe_response(DNSRecord.parse(response_packet),
+                                                              self.question.qtype)
+
+    def finish(self, send):
+        """Passes the reply to send(), then records the query's timings and log record."""
+        log_data = self.log_data
+        log_data["total_time"] = (time.time() - self.start_total_time) * 1000 # Total ms
+
+        answered = time.perf_counter()
+        if self.local_reply is not None:
+            send(finish_reply(self.local_reply, self.question, self.udp))
+        else:
+            send(build_reply(self.question, self.response_packet, self.udp))
+        sent = time.perf_counter()
+        metrics.REPLY_SECONDS.observe(sent - answered)
+        metrics.QUERY_SECONDS.observe(sent - self.received, log_data["cache_status"])
+
+        log_data["step"] = "FINAL"
+        log_final(log_data)
+
+
+class WalkBudget:
+    """
+    The upstream work one client query may cause. Glueless sub-resolutions
+    share their parent's query allowance and deadline, may only nest
+    MAX_GLUELESS_DEPTH deep and may not resolve a name that is already
+    being resolved further up the chain, so a delegation loop cannot run
+    forever.
+    """
+
+    def __init__(self, max_queries=MAX_QUERIES_PER_RESOLUTION, time_budget=None, depth=0,
+                 chain=frozenset(), shared=None):
+        self.depth = depth
+        self.chain = chain
+        if shared is None:
+            shared = _Allowance(max_queries, time.monotonic() + (time_budget or QUERY_TIME_BUDGET))
+        self._shared = shared
+
+    def spend(self):
+        """Uses up one upstream query. Returns False once the allowance is gone."""
+        return self._shared.take()
+
+    def time_left(self):
+        """Seconds left before the client query's deadline."""
+        return self._shared.deadline - time.monotonic()
+
+    def child(self, name):
+        """Budget for resolving name on behalf of this walk, or None if not allowed."""
+        name = name.lower()
+        if self.depth >= MAX_GLUELESS_DEPTH or name in self.chain:
+            return None
+        return WalkBudget(depth=self.depth + 1, chain=self.chain | {name}, shared=self._shared)
+
+
+class _Allowance:
+    """Query counter and deadline shared (across threads) by a walk and its sub-walks."""
+
+    def __init__(self, queries, deadline):
+        self.left = queries
+        self.deadline = deadline
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class NSLookup:
+    """
+    Yielded by iterative_walk() for a referral without glue: the engine
+    resolves the A records of each (ns_name, budget) pair, in parallel, and
+    sends back {ns_name: [addresses]}.
+    """
+
+    def __init__(self, lookups):
+        self.lookups = lookups
+
+
+def glueless_addresses(delegation, budget):
+    """
+    Generator (used with "yield from" inside iterative_walk) that resolves
+    the nameserver names of a delegation that came without glue, caches
+    the addresses on the delegation and returns them.
+    """
+    lookups = []
+    for ns_name in delegation.nameservers:
+        if in_bailiwick(ns_name, delegation.zone):
+            continue # Needs glue by definition; resolving it would loop
+        child = budget.child(ns_name)
+        if child is not None:
+            lookups.append((ns_name, child))
+        if len(lookups) == MAX_GLUELESS_NS:
+            break
+    if not lookups:
+        return []
+
+    found = yield NSLookup(lookups)
+    addresses = dict(delegation.addresses)
+    for ns_name, ips in found.items():
+        if ips:
+            addresses[ns_name] = ips
+    resolved = Delegation(delegation.zone, delegation.nameservers, addresses, delegation.expires)
+    delegation_cache.put(resolved)
+    return resolved.server_ips()
+
+
+def iterative_walk(query_domain, log_data, qtype=QTYPE.A, budget=None):
+    """
+    Performs iterative DNS resolution as a generator (see module docstring).
+    Returns the final DNSRecord, or None if resolution failed.
+    """
+    if budget is None:
+        budget = WalkBudget()
+    log_data["resolution_mode"] = "iterative" if budget.depth == 0 else "glueless"
+
+    # Start at the deepest zone cut we already know about.
+    delegation = delegation_cache.closest(query_domain)
+    if delegation:
+        current_servers = delegation.server_ips()
+        current_zone = delegation.zone # The zone the servers being asked are authoritative for
+        log_data["step"] = step_for_zone(delegation.zone)
+    else:
+        current_servers = list(ROOT_SERVERS)
+        current_zone = '.'
+        log_data["step"] = "Root"
+
+    packet = question_packet(query_domain, qtype, dnssec_ok=AGGRESSIVE_NSEC) # The same for every hop
+
+    for i in range(MAX_HOPS):
+        if not current_servers:
+            logger.warning(f"Resolution failed for {query_domain}: No server to query.")
+            return None
+
+        time_left = budget.time_left()
+        if time_left <= 0:
+            logger.warning(f"Resolution failed for {query_domain}: Time budget exhausted.")
+            return None
+
+        if not budget.spend():
+            logger.warning(f"Resolution failed for {query_domain}: Query budget exhausted.")
+            return None
+
+        log_data["server_ip"] = current_servers[0]
+
+        try:
+            # The engine races the query across current_servers, fastest first.
+            server_ip, response_data, rtt = yield current_servers, packet, time_left
+            log_data["server_ip"] = server_ip
+            log_data["rtt"] = rtt # RTT in ms
+            metrics.UPSTREAM_SECONDS.observe(rtt / 1000, log_data["step"])
+            response = DNSRecord.parse(response_data)
+
+        except socket.timeout:
+            # Every candidate server for this hop has already been tried.
+            log_data["response"] = "TIMEOUT"
+            log_hop(log_data)
+            current_servers = []
+            continue
+        except Exception as e:
+            logger.error(f"Error querying {log_data['server_ip']}: {e}")
+            current_servers = []
+            continue
+
+        # --- Process Response ---
+        if response.header.rcode == RCODE.NOERROR:
+            if response.rr: # Answer section
+                for rr in response.rr:
+                    if rr.rtype == qtype:
+                        log_data["step"] = "Authoritative"
+                        log_data["response"] = f"RESPONSE: {QTYPE[qtype]}={str(rr.rdata)}"
+                        log_hop(log_data)
+                        return strip_dnssec(response, qtype) # Found it!
+
+            if is_nodata(response): # Name exists, but has no records of this type
+                log_data["response"] = "NODATA"
+                log_hop(log_data)
+                negative_cache.learn(query_domain, response, current_zone)
+                return strip_dnssec(response, qtype)
+
+            if response.auth: # Authority section (Referral)
+                log_data["response"] = "REFERRAL"
+                new_ns_domain = str(response.auth[0].rdata)
+                new_servers = []
+
+                # A server may only delegate part of its own zone that holds the query name.
+                referral = referral_delegation(response, current_zone)
+                if (referral and referral.zone != current_zone and in_bailiwick(referral.zone, current_zone)
+                        and in_bailiwick(query_domain, referral.zone)):
+                    delegation_cache.put(referral)
+                    new_servers = referral.server_ips() # Glue for every NS
+                    if not new_servers:
+                        logger.info(f"Got referral to {new_ns_domain} but no IP (Glue); resolving NS names.")
+                        new_servers = yield from glueless_addresses(referral, budget)
+                    if new_servers:
+                        current_zone = referral.zone
+                        log_data["step"] = step_for_zone(referral.zone)
+
+                if not new_servers:
+                    logger.warning(f"Got referral to {new_ns_domain} but no IP (Glue).")
+                current_servers = new_servers # Empty: no way forward
+
+            log_hop(log_data)
+
+        elif response.header.rcode == RCODE.NXDOMAIN:
+            log_data["response"] = "NXDOMAIN"
+            log_hop(log_data)
+            negative_cache.learn(query_domain, response, current_zone)
+            return strip_dnssec(response, qtype) # Domain doesn't exist
+        else:
+            log_data["response"] = f"RCODE_{response.header.rcode}"
+            log_hop(log_data)
+            return strip_dnssec(response, qtype) # Other error
+
+    return None # Failed to resolve
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import zlib
+from datetime import datetime
+
+# --- Verbosity Levels (--log-level) ---
+VERBOSITY = {
+    "off": 0,        # Nothing at all
+    "warnings": 1,   # Warnings and errors only
+    "final": 2,      # Plus one FINAL record per client query
+    "hops": 3,       # Plus a record for every upstream hop (Task D default)
+}
+
+# --- Writer Settings ---
+QUEUE_SIZE = 100000       # Records waiting for the writer; beyond this they are dropped
+BATCH_SIZE = 512          # Records written per flush
+FLUSH_INTERVAL = 0.5      # Seconds before a partial batch is flushed
+
+logger = logging.getLogger('DNSResolver')            # Warnings, errors, hop notes
+query_logger = logging.getLogger('DNSResolver.query') # Per-hop and FINAL records
+
+_state = {"verbosity": VERBOSITY["hops"], "sample_rate": 1.0, "writer": None}
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line: query records as-is, anything else as a message."""
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, separators=(',', ':'))
+        return json.dumps({
+            "timestamp": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }, separators=(',', ':'))
+
+
+class ReprFormatter(logging.Formatter):
+    """The original resolver.log format: str(dict) for query records."""
+
+    def format(self, record):
+        return str(record.msg) if isinstance(record.msg, dict) else record.getMessage()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks or formats on the calling thread:
+    records go onto the queue untouched (formatting happens on the writer
+    thread) and are counted and dropped if the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchWriter:
+    """
+    Background thread that drains the log queue and appends formatted lines
+    to the log file, flushing every BATCH_SIZE records or FLUSH_INTERVAL
+    seconds, whichever comes first.
+    """
+
+    def __init__(self, log_queue, path, formatter):
+        self.queue = log_queue
+        self.path = path
+        self.formatter = formatter
+        self.written = 0
+        self._start()
+
+    def _start(self):
+        # O_APPEND keeps lines whole when pre-forked workers share the file.
+        self._file = open(self.path, 'a', buffering=1 << 16)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def restart_in_child(self):
+        """Called after fork: the parent's writer thread does not exist here."""
+        # Keep the inherited file object alive: closing it here would flush
+        # the parent's unwritten buffer a second time.
+        self._inherited = self._file
+        self.queue = queue.Queue(QUEUE_SIZE)
+        _state["handler"].queue = self.queue
+        self._start()
+
+    def _run(self):
+        pending = 0
+        while True:
+            try:
+                record = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                try:
+                    self._file.write(self.formatter.format(record) + "\n")
+                    pending += 1
+                    self.written += 1
+                except Exception:
+                    pass # A bad record must never kill the writer
+                self.queue.task_done()
+            if pending and (record is None or pending >= BATCH_SIZE):
+                self._file.flush()
+                pending = 0
+
+    def flush(self):
+        """Blocks until everything queued so far is on disk (used at shutdown)."""
+        self.queue.join()
+        self._file.flush()
+
+
+def setup_logging(path='resolver.log', log_format='json', verbosity='hops', sample_rate=1.0):
+    """
+    Configures the resolver's logging pipeline. Request threads only put
+    records on a queue; a writer thread formats them (newline-delimited
+    JSON, or the original repr format) and writes them to `path` in
+    batches. `verbosity` picks what gets recorded (see VERBOSITY) and
+    `sample_rate` keeps that fraction of client queries (all of a query's
+    records are kept or dropped together).
+    """
+    open(path, 'w').close() # Overwrite log
+    log_queue = queue.Queue(QUEUE_SIZE)
+    formatter = JsonLineFormatter() if log_format == 'json' else ReprFormatter()
+    handler = NonBlockingQueueHandler(log_queue)
+    writer = BatchWriter(log_queue, path, formatter)
+
+    level = VERBOSITY[verbosity]
+    for handler_ in list(logger.handlers):
+        logger.removeHandler(handler_)
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO if level >= VERBOSITY["hops"] else
+                    logging.WARNING if level >= VERBOSITY["warnings"] else logging.CRITICAL + 1)
+    query_logger.setLevel(logging.INFO if level >= VERBOSITY["final"] else logging.CRITICAL + 1)
+
+    if _state["writer"] is None:
+        os.register_at_fork(after_in_child=lambda: _state["writer"] and _state["writer"].restart_in_child())
+        atexit.register(flush_logs)
+    _state.update(verbosity=level, sample_rate=sample_rate, writer=writer, handler=handler)
+    return logger
+
+
+def flush_logs():
+    """Waits for queued records to reach the log file."""
+    if _state["writer"] is not None:
+        _state["writer"].flush()
+
+
+def dropped_records():
+    """Records thrown away because the writer fell behind."""
+    handler = _state.get("handler")
+    return handler.dropped if handler is not None else 0
+
+
+def _sampled(log_data):
+    rate = _state["sample_rate"]
+    if rate >= 1.0:
+        return True
+    key = f"{log_data['timestamp']}{log_data['domain']}".encode()
+    return zlib.crc32(key) < rate * 0xFFFFFFFF
+
+
+def log_hop(log_data):
+    """Records one upstream hop of a query (only at the "hops" verbosity)."""
+    if _state["verbosity"] >= VERBOSITY["hops"] and _sampled(log_data):
+        query_logger.info(dict(log_data))
+
+
+def log_final(log_data):
+    """Records the FINAL outcome of a client query."""
+    if _state["verbosity"] >= VERBOSITY["final"] and _sampled(log_data):
+        query_logger.info(dict(log_data))
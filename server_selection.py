@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+import random
+import threading
+import time
+
+# --- Smoothed RTT Settings (in the spirit of BIND/Unbound SRTT) ---
+SRTT_ALPHA = 0.3              # Weight of the newest sample
+UNKNOWN_SRTT_MAX = 30.0       # ms; untried servers get a random low SRTT so they get probed
+TIMEOUT_PENALTY = 2.0         # SRTT multiplier applied on every timeout
+MAX_SRTT = 5000.0             # ms
+
+# --- Staggered (Happy Eyeballs) Querying ---
+MIN_STAGGER = 0.05            # Seconds before asking the next server
+MAX_STAGGER = 0.4
+MAX_PARALLEL = 3              # Queries for one hop in flight at once
+MAX_SERVERS_PER_HOP = 6       # Servers tried for one hop before giving up
+
+# --- Retransmission Timeouts (Jacobson/Karels, as in RFC 6298) ---
+INITIAL_RTO = 0.4             # Seconds; servers without an RTT sample yet
+MIN_RTO = 0.05
+MAX_RTO = 2.0                 # The old fixed per-hop timeout
+RTO_K = 4                     # RTO = SRTT + RTO_K * RTTVAR
+MAX_BACKOFF = 5               # Consecutive timeouts after which the RTO stops doubling
+MAX_RETRIES = 2               # Times one server is re-asked within a hop after timing out
+
+# --- Per-server Rate Limits ---
+MAX_INFLIGHT_PER_SERVER = 100 # Queries outstanding to one server at once
+UPSTREAM_QPS = 1000           # Token bucket refill rate per server
+UPSTREAM_BURST = 200          # Token bucket size
+THROTTLE_WAIT = 0.01          # Seconds before trying a rate-limited server again
+
+
+class ServerStats:
+    __slots__ = ("srtt", "rttvar", "samples", "timeouts", "rto", "backoff", "inflight", "tokens", "refilled")
+
+    def __init__(self, srtt, tokens):
+        self.srtt = srtt
+        self.rttvar = srtt / 2
+        self.samples = 0
+        self.timeouts = 0
+        self.rto = INITIAL_RTO   # Seconds, before backoff
+        self.backoff = 0         # Consecutive timeouts
+        self.inflight = 0
+        self.tokens = tokens
+        self.refilled = time.monotonic()
+
+
+class ServerSelector:
+    """
+    Keeps a smoothed RTT per upstream server address and uses it to order
+    the candidates for each hop, to decide how long to wait before racing
+    the next one and how long to wait for each (the RTO, doubled on every
+    consecutive timeout). Also rate-limits each server: a query may only
+    be sent once acquire() grants a token and an in-flight slot.
+
+    sent, timeouts, retries and throttled count upstream queries across
+    all servers (throttled: sends refused by the rate limit).
+    """
+
+    def __init__(self, max_inflight=MAX_INFLIGHT_PER_SERVER, upstream_qps=UPSTREAM_QPS,
+                 upstream_burst=UPSTREAM_BURST):
+        self.max_inflight = max_inflight
+        self.upstream_qps = upstream_qps
+        self.upstream_burst = upstream_burst
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def _get(self, server_ip):
+        stats = self._stats.get(server_ip)
+        if stats is None:
+            stats = self._stats[server_ip] = ServerStats(random.uniform(1.0, UNKNOWN_SRTT_MAX),
+                                                         self.upstream_burst)
+        return stats
+
+    def clear(self):
+        """Forgets every server's RTT history."""
+        with self._lock:
+            self._stats.clear()
+
+    def srtt(self, server_ip):
+        with self._lock:
+            return self._get(server_ip).srtt
+
+    def order(self, servers):
+        """Returns the servers fastest first, capped at MAX_SERVERS_PER_HOP."""
+        with self._lock:
+            ranked = sorted(set(servers), key=lambda ip: self._get(ip).srtt)
+        return ranked[:MAX_SERVERS_PER_HOP]
+
+    def stagger_delay(self, server_ip):
+        """Seconds to give server_ip before also querying the next candidate."""
+        with self._lock:
+            stats = self._get(server_ip)
+            delay = (stats.srtt + 2 * stats.rttvar) / 1000
+        return min(max(delay, MIN_STAGGER), MAX_STAGGER)
+
+    def rto(self, server_ip):
+        """Seconds to wait for server_ip to answer one query."""
+        with self._lock:
+            stats = self._get(server_ip)
+            return min(stats.rto * 2 ** stats.backoff, MAX_RTO)
+
+    def acquire(self, server_ip, retry=False):
+        """
+        Takes a token and an in-flight slot for one query to server_ip.
+        Returns False (and sends nothing) if the server is at its limit;
+        otherwise release() must be called once the query is over.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stats = self._get(server_ip)
+            stats.tokens = min(stats.tokens + (now - stats.refilled) * self.upstream_qps, self.upstream_burst)
+            stats.refilled = now
+            if stats.inflight >= self.max_inflight or stats.tokens < 1:
+                self.throttled += 1
+                return False
+            stats.tokens -= 1
+            stats.inflight += 1
+            self.sent += 1
+            if retry:
+                self.retries += 1
+            return True
+
+    def release(self, server_ip):
+        """Gives back the in-flight slot taken by acquire()."""
+        with self._lock:
+            stats = self._get(server_ip)
+            stats.inflight = max(stats.inflight - 1, 0)
+
+    def record_rtt(self, server_ip, rtt):
+        """Folds a measured RTT (ms) into the server's SRTT/RTTVAR and RTO."""
+        with self._lock:
+            stats = self._get(server_ip)
+            if stats.samples == 0:
+                stats.srtt, stats.rttvar = rtt, rtt / 2
+            else:
+                stats.rttvar = (1 - SRTT_ALPHA) * stats.rttvar + SRTT_ALPHA * abs(stats.srtt - rtt)
+                stats.srtt = (1 - SRTT_ALPHA) * stats.srtt + SRTT_ALPHA * rtt
+            stats.samples += 1
+            # The timeout penalty below only reorders servers; the RTO is
+            # recomputed from real samples alone (Karn's algorithm).
+            stats.rto = min(max((stats.srtt + RTO_K * stats.rttvar) / 1000, MIN_RTO), MAX_RTO)
+            stats.backoff = 0
+
+    def record_unanswered(self, server_ip, waited):
+        """
+        Folds in how long (ms) a server left a raced query unanswered before
+        another server won, if longer than its SRTT: a lower bound on its RTT,
+        so a silent server cannot keep a low SRTT by never timing out.
+        """
+        with self._lock:
+            stats = self._get(server_ip)
+            if waited > stats.srtt:
+                stats.srtt = min((1 - SRTT_ALPHA) * stats.srtt + SRTT_ALPHA * waited, MAX_SRTT)
+
+    def record_timeout(self, server_ip):
+        """Pushes a server that did not answer to the back of the queue and backs off its RTO."""
+        with self._lock:
+            stats = self._get(server_ip)
+            stats.srtt = min(stats.srtt * TIMEOUT_PENALTY + 100.0, MAX_SRTT)
+            stats.backoff = min(stats.backoff + 1, MAX_BACKOFF)
+            stats.timeouts += 1
+            self.timeouts += 1
+
+    def counters(self):
+        """Upstream query counters, for reports and metrics."""
+        return {"sent": self.sent, "timeouts": self.timeouts, "retries": self.retries,
+                "throttled": self.throttled}
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+import hashlib
+import mmap
+import struct
+import time
+import zlib
+
+# --- Table Layout ---
+SLOT_SIZE = 1024          # Bytes per slot; larger responses stay in the per-process cache
+WAYS = 4                  # Slots per bucket (set-associative)
+DEFAULT_SIZE_MB = 64
+
+# version, crc32(body), key hash, stored, expires, key length, data length
+SLOT_HEADER = struct.Struct("<IIQddHH")
+MAX_BODY = SLOT_SIZE - SLOT_HEADER.size
+
+
+def key_hash(key):
+    """64-bit hash of an encoded cache key (never 0, which marks an empty slot)."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+class SharedTable:
+    """
+    A fixed-size, set-associative hash table of packed DNS responses kept
+    in an anonymous shared mmap, so every worker forked after it is created
+    reads and writes the same entries.
+
+    Each slot is guarded by a seqlock (an even/odd version counter) plus a
+    CRC of its body; a reader that races a writer simply sees a miss.
+    Times are wall-clock so they mean the same thing in every process.
+    """
+
+    def __init__(self, size_mb=DEFAULT_SIZE_MB):
+        self.slots = max(WAYS, (size_mb * 1024 * 1024 // SLOT_SIZE) // WAYS * WAYS)
+        self.buckets = self.slots // WAYS
+        self._mm = mmap.mmap(-1, self.slots * SLOT_SIZE) # MAP_SHARED | MAP_ANONYMOUS
+
+    def _bucket(self, h):
+        first = (h % self.buckets) * WAYS
+        return range(first, first + WAYS)
+
+    def _read(self, slot):
+        """Returns (hash, stored, expires, key, data) for a consistent slot, else None."""
+        offset = slot * SLOT_SIZE
+        header = SLOT_HEADER.unpack_from(self._mm, offset)
+        version, crc, h, stored, expires, key_len, data_len = header
+        if version & 1 or h == 0 or key_len + data_len > MAX_BODY:
+            return None
+        start = offset + SLOT_HEADER.size
+        body = self._mm[start:start + key_len + data_len]
+        if struct.unpack_from("<I", self._mm, offset)[0] != version or zlib.crc32(body) != crc:
+            return None # Torn by a concurrent writer
+        return h, stored, expires, body[:key_len], body[key_len:]
+
+    def get(self, key):
+        """Returns (packed, stored, expires) for an encoded key, or None."""
+        h = key_hash(key)
+        for slot in self._bucket(h):
+            entry = self._read(slot)
+            if entry and entry[0] == h and entry[3] == key:
+                return entry[4], entry[1], entry[2]
+        return None
+
+    def items(self, now):
+        """Yields (key, packed, stored, expires) for every consistent slot still live at now."""
+        for slot in range(self.slots):
+            entry = self._read(slot)
+            if entry and entry[2] > now:
+                yield entry[3], entry[4], entry[1], entry[2]
+
+    def put(self, key, packed, stored, expires):
+        """Stores an entry, replacing the same key, an expired slot or the oldest one."""
+        if len(key) + len(packed) > MAX_BODY:
+            return False
+        h = key_hash(key)
+        now = time.time()
+        victim, victim_stored = None, None
+        for slot in self._bucket(h):
+            entry = self._read(slot)
+            if entry is None or entry[0] == h or entry[2] <= now:
+                victim = slot
+                break
+            if victim is None or entry[1] < victim_stored:
+                victim, victim_stored = slot, entry[1]
+
+        offset = victim * SLOT_SIZE
+        version = struct.unpack_from("<I", self._mm, offset)[0]
+        version = (version | 1) + 1 # Next even version, via an odd "writing" one
+        body = key + packed
+        struct.pack_into("<I", self._mm, offset, version - 1)
+        self._mm[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(body)] = body
+        SLOT_HEADER.pack_into(self._mm, offset, version - 1, zlib.crc32(body), h,
+                              stored, expires, len(key), len(packed))
+        struct.pack_into("<I", self._mm, offset, version & 0xFFFFFFFF)
+        return True
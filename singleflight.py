@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import asyncio
+import threading
+
+
+class _Call:
+    """One in-progress call that later callers can wait on."""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, everyone who arrives while it is running waits for it and
+    gets the same result. `coalesced` counts the calls that were saved.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, fn, *args):
+        """
+        Runs fn(*args) unless a call for key is already running.
+        Returns (result, shared) where shared is True for waiters.
+        Exceptions raised by the running call are re-raised in every waiter.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one asyncio event loop."""
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, fn, *args):
+        """
+        Awaits fn(*args) unless a call for key is already running. If the
+        running call is cancelled, its waiters get CancelledError too.
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return await asyncio.shield(call), True
+
+        call = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn(*args)
+            call.set_result(result)
+        except Exception as e:
+            call.set_exception(e)
+            call.exception() # Waiters re-raise it; don't warn if there are none
+            raise
+        finally:
+            del self._calls[key]
+            if not call.done(): # The leader was cancelled: so are its waiters, rather than hang
+                call.cancel()
+        return result, False
@@ -0,0 +1,599 @@
+#!/usr/bin/python3
+import asyncio
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import metrics
+from dns_wire import is_truncated
+from server_selection import MAX_PARALLEL, MAX_RETRIES, THROTTLE_WAIT
+
+# --- Pool Settings ---
+POOL_SIZE = 8           # Long-lived upstream sockets (= source ports) in use at once
+ROTATE_AFTER = 500      # Queries sent from a socket before its port is retired
+UPSTREAM_PORT = 53      # Port upstream servers are queried on unless a query says otherwise
+MAX_RESPONSE_SIZE = 65535  # Largest UDP payload; what we advertise (EDNS_UDP_SIZE) is the real limit
+
+# --- TCP Fallback (truncated UDP replies) ---
+TCP_IDLE_TIMEOUT = 10.0    # Seconds an unused upstream TCP connection is kept for reuse
+TCP_MAX_IDLE = 2           # Idle connections kept per server
+
+_random = random.SystemRandom()
+
+
+def question_key(data):
+    """
+    Returns the question section of a DNS message as (lowercased qname in
+    wire format, qtype, qclass), or None if the message is too short or
+    malformed. Used to check that a reply answers the question we asked.
+    """
+    pos = 12
+    labels = []
+    try:
+        while True:
+            length = data[pos]
+            if length == 0:
+                break
+            if length & 0xC0: # Compression pointers never appear in a question we sent
+                return None
+            labels.append(bytes(data[pos:pos + length + 1]).lower())
+            pos += length + 1
+        qtype, qclass = struct.unpack_from("!HH", data, pos + 1)
+    except (IndexError, struct.error):
+        return None
+    return b"".join(labels), qtype, qclass
+
+
+def with_txid(packet, txid):
+    """Returns packet with its transaction ID replaced."""
+    return struct.pack("!H", txid) + packet[2:]
+
+
+def register_pool_metrics(pool):
+    """Exposes a pool's counters on /metrics (called once by the engine that uses it)."""
+    metrics.counter("dns_upstream_unmatched_total", "Upstream replies that matched no outstanding query",
+                    lambda: pool.unmatched)
+    metrics.counter("dns_upstream_port_rotations_total", "Upstream sockets retired for a fresh source port",
+                    lambda: pool.rotations)
+    metrics.counter("dns_upstream_tcp_fallbacks_total", "Truncated UDP replies re-queried over TCP",
+                    lambda: pool.tcp_fallbacks)
+    metrics.counter("dns_upstream_tcp_connections_total", "Upstream TCP connections opened",
+                    lambda: pool.tcp.opened)
+    metrics.counter("dns_upstream_tcp_reused_total", "Upstream TCP queries sent on an already open connection",
+                    lambda: pool.tcp.reused)
+
+
+def _next_server(remaining, selector, tries):
+    """
+    Pops the first server in remaining that selector's rate limit lets
+    us query now (taking its slot), or returns None if none of them can
+    be asked yet. tries counts the queries sent to each server.
+    """
+    for i, server_ip in enumerate(remaining):
+        if selector is None or selector.acquire(server_ip, retry=server_ip in tries):
+            del remaining[i]
+            tries[server_ip] = tries.get(server_ip, 0) + 1
+            return server_ip
+    return None
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    """Reads one length-prefixed DNS message from a TCP socket (RFC 1035 4.2.2)."""
+    return _recv_exactly(sock, struct.unpack("!H", _recv_exactly(sock, 2))[0])
+
+
+def _matches(response, txid, question):
+    return len(response) >= 12 and struct.unpack_from("!H", response)[0] == txid \
+        and question_key(response) == question
+
+
+class TCPConnections:
+    """
+    Persistent TCP connections to upstream servers (RFC 7766), used when
+    a UDP reply comes back truncated. A connection carries one query at a
+    time and then goes back on a short per-server idle list, so repeated
+    large answers from the same server skip the handshake.
+    """
+
+    def __init__(self, max_idle=TCP_MAX_IDLE, idle_timeout=TCP_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._idle = {}   # (server_ip, port) -> [(sock, idle since)]
+        os.register_at_fork(after_in_child=self._forget_in_child)
+
+    def _forget_in_child(self):
+        for idle in self._idle.values():
+            for sock, _ in idle:
+                sock.close()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, address):
+        """An idle connection to address, or None. Closes connections idle for too long."""
+        now = time.monotonic()
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    idle.pop(0)[0].close()
+            idle = self._idle.get(address)
+            return idle.pop()[0] if idle else None
+
+    def _checkin(self, address, sock):
+        with self._lock:
+            idle = self._idle.setdefault(address, [])
+            if len(idle) < self.max_idle:
+                idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def query(self, server_ip, packet, timeout, port=UPSTREAM_PORT):
+        """
+        Sends packet to server_ip:port over TCP and returns (response_data,
+        rtt_ms). A reused connection the server has closed in the meantime
+        is replaced by a new one. Raises socket.timeout or OSError.
+        """
+        address = (server_ip, port)
+        question = question_key(packet)
+        deadline = time.monotonic() + timeout
+        sock = self._checkout(address)
+        while True:
+            reused = sock is not None
+            if reused:
+                self.reused += 1
+            else:
+                sock = socket.create_connection(address, timeout=max(deadline - time.monotonic(), 0.001))
+                self.opened += 1
+            txid = _random.getrandbits(16)
+            start = time.monotonic()
+            try:
+                sock.settimeout(max(deadline - start, 0.001))
+                sock.sendall(struct.pack("!H", len(packet)) + with_txid(packet, txid))
+                response = recv_message(sock)
+                if not _matches(response, txid, question):
+                    raise ConnectionError("reply does not match the query")
+            except socket.timeout:
+                sock.close()
+                raise
+            except OSError:
+                sock.close()
+                if reused and time.monotonic() < deadline:
+                    sock = None
+                    continue
+                raise
+            self._checkin(address, sock)
+            return response, (time.monotonic() - start) * 1000
+
+
+class AsyncTCPConnections:
+    """TCPConnections for the asyncio engine."""
+
+    def __init__(self, max_idle=TCP_MAX_IDLE, idle_timeout=TCP_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self._idle = {}   # (server_ip, port) -> [(reader, writer, idle since)]
+
+    def _checkout(self, address):
+        now = time.monotonic()
+        for idle in self._idle.values():
+            while idle and now - idle[0][2] >= self.idle_timeout:
+                idle.pop(0)[1].close()
+        idle = self._idle.get(address)
+        return idle.pop()[:2] if idle else None
+
+    def _checkin(self, address, reader, writer):
+        idle = self._idle.setdefault(address, [])
+        if len(idle) < self.max_idle:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _exchange(self, reader, writer, packet, txid, question):
+        writer.write(struct.pack("!H", len(packet)) + with_txid(packet, txid))
+        await writer.drain()
+        size = struct.unpack("!H", await reader.readexactly(2))[0]
+        response = await reader.readexactly(size)
+        if not _matches(response, txid, question):
+            raise ConnectionError("reply does not match the query")
+        return response
+
+    async def query(self, server_ip, packet, timeout, port=UPSTREAM_PORT):
+        """Asyncio counterpart of TCPConnections.query()."""
+        loop = asyncio.get_running_loop()
+        address = (server_ip, port)
+        question = question_key(packet)
+        deadline = loop.time() + timeout
+        connection = self._checkout(address)
+        while True:
+            reused = connection is not None
+            try:
+                if reused:
+                    self.reused += 1
+                else:
+                    connection = await asyncio.wait_for(asyncio.open_connection(server_ip, port),
+                                                        max(deadline - loop.time(), 0.001))
+                    self.opened += 1
+                reader, writer = connection
+                start = loop.time()
+                txid = _random.getrandbits(16)
+                response = await asyncio.wait_for(self._exchange(reader, writer, packet, txid, question),
+                                                  max(deadline - start, 0.001))
+            except asyncio.TimeoutError:
+                if connection is not None:
+                    connection[1].close()
+                raise socket.timeout("timed out")
+            except (OSError, asyncio.IncompleteReadError):
+                if connection is not None:
+                    connection[1].close()
+                if reused and loop.time() < deadline:
+                    connection = None
+                    continue
+                raise ConnectionError(f"TCP query to {server_ip} failed")
+            self._checkin(address, reader, writer)
+            return response, (loop.time() - start) * 1000
+
+
+class _Waiter:
+    """One query sent by UpstreamPool, waiting for its reply."""
+    __slots__ = ("event", "response", "server_ip", "key", "sent", "expires", "received", "live")
+
+    def __init__(self, event, server_ip, key):
+        self.event = event     # Shared by every query racing for the same hop
+        self.response = None
+        self.server_ip = server_ip
+        self.key = key
+        self.sent = None
+        self.expires = None
+        self.received = None
+        self.live = True
+
+
+class _PooledSocket:
+    __slots__ = ("sock", "uses", "retire_at")
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(("0.0.0.0", 0)) # Kernel picks a random ephemeral port
+        self.uses = 0
+        self.retire_at = None
+
+
+class UpstreamPool:
+    """
+    A small set of long-lived UDP sockets shared by every resolver thread.
+
+    Each query gets a fresh random transaction ID and a randomly chosen
+    socket; a dispatcher thread reads all sockets and hands every reply to
+    the thread waiting on its (server, port, txid, question). Sockets are
+    replaced after ROTATE_AFTER queries so source ports keep changing.
+    A truncated reply is asked again over TCP (see TCPConnections).
+    """
+
+    def __init__(self, size=POOL_SIZE, rotate_after=ROTATE_AFTER, port=UPSTREAM_PORT):
+        self.size = size
+        self.rotate_after = rotate_after
+        self.port = port
+        self.unmatched = 0
+        self.rotations = 0
+        self.tcp_fallbacks = 0
+        self.tcp = TCPConnections()
+        self._start()
+        # A forked worker must not share source ports (or a dead dispatcher
+        # thread) with its parent, so it gets a pool of its own.
+        os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def _restart_in_child(self):
+        for pooled in self._sockets + self._retired:
+            pooled.sock.close() # Only this process's copy; the parent keeps its own
+        self._selector.close()
+        self._start()
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        self._retired = []
+        for _ in range(self.size):
+            self._add_socket()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="upstream-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _add_socket(self):
+        pooled = _PooledSocket()
+        self._selector.register(pooled.sock, selectors.EVENT_READ)
+        self._sockets.append(pooled)
+
+    def _send(self, server_ip, packet, question, port, event, timeout):
+        """Registers a waiter under a fresh txid and sends the query."""
+        with self._lock:
+            while True:
+                txid = _random.getrandbits(16)
+                key = (server_ip, port, txid, question)
+                if key not in self._pending:
+                    break
+            waiter = self._pending[key] = _Waiter(event, server_ip, key)
+            pooled = _random.choice(self._sockets)
+            pooled.uses += 1
+        waiter.sent = time.monotonic()
+        waiter.expires = waiter.sent + timeout
+        try:
+            pooled.sock.sendto(with_txid(packet, txid), (server_ip, port))
+        except OSError:
+            waiter.expires = float("-inf") # Unreachable: treat as timed out at once
+        return waiter
+
+    def query(self, server_ip, packet, timeout, port=None):
+        """
+        Sends packet to server_ip:port (default: the pool's port) and blocks until the matching reply
+        arrives. Returns (response_data, rtt_ms); raises socket.timeout.
+        """
+        _, response_data, rtt = self.query_any([server_ip], packet, timeout, port=port)
+        return response_data, rtt
+
+    def query_any(self, servers, packet, timeout, selector=None, port=None):
+        """
+        Races one query across servers, tried in the given order, for at
+        most timeout seconds in all. The next server is added after
+        selector.stagger_delay() of silence (or at once when a query times
+        out), with at most MAX_PARALLEL in flight. Each query waits
+        selector.rto() for its server, and a server that times out is asked
+        again (with its RTO backed off) up to MAX_RETRIES times. A server
+        at its rate limit is skipped until it has room again.
+        Returns (server_ip, response_data, rtt_ms) from the first reply and
+        feeds every RTT and timeout to the selector, and how long each losing
+        server had kept silent (record_unanswered()); a truncated reply is
+        replaced by the same server's answer over TCP. Raises socket.timeout
+        if no server answers in time.
+        """
+        port = port or self.port
+        question = question_key(packet)
+        event = threading.Event()
+        deadline = time.monotonic() + timeout
+        remaining = list(servers)
+        tries = {}
+        attempts = []
+        next_send = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                for waiter in attempts:
+                    if waiter.response is not None:
+                        rtt = (waiter.received - waiter.sent) * 1000
+                        if selector:
+                            selector.record_rtt(waiter.server_ip, rtt)
+                        if is_truncated(waiter.response):
+                            self.tcp_fallbacks += 1
+                            response_data, rtt = self.tcp.query(waiter.server_ip, packet, deadline - now, port)
+                            return waiter.server_ip, response_data, rtt
+                        return waiter.server_ip, waiter.response, rtt
+                    if waiter.live and now >= waiter.expires:
+                        waiter.live = False
+                        if selector:
+                            selector.release(waiter.server_ip)
+                            selector.record_timeout(waiter.server_ip)
+                        if tries[waiter.server_ip] <= MAX_RETRIES:
+                            remaining.append(waiter.server_ip) # Retry after the others
+                        next_send = now
+
+                live = [waiter for waiter in attempts if waiter.live]
+                wake = [waiter.expires for waiter in live]
+                if remaining and len(live) < MAX_PARALLEL and now < deadline:
+                    if now >= next_send or not live:
+                        server_ip = _next_server(remaining, selector, tries)
+                        if server_ip is not None:
+                            attempt_timeout = min(selector.rto(server_ip) if selector else timeout, deadline - now)
+                            attempts.append(self._send(server_ip, packet, question, port, event, attempt_timeout))
+                            next_send = now + (selector.stagger_delay(server_ip) if selector else timeout)
+                            continue
+                        wake.append(now + THROTTLE_WAIT)
+                    else:
+                        wake.append(next_send)
+                if not wake:
+                    raise socket.timeout("timed out")
+
+                event.wait(max(min(wake) - now, 0))
+                event.clear()
+        finally:
+            with self._lock:
+                for waiter in attempts:
+                    self._pending.pop(waiter.key, None)
+            if selector:
+                now = time.monotonic()
+                for waiter in attempts:
+                    if waiter.live:
+                        selector.release(waiter.server_ip)
+                        if waiter.response is None: # Lost the race
+                            selector.record_unanswered(waiter.server_ip, (now - waiter.sent) * 1000)
+
+    def _dispatch(self):
+        while True:
+            for selector_key, _ in self._selector.select(timeout=0.5):
+                self._read(selector_key.fileobj)
+            self._rotate()
+
+    def _read(self, sock):
+        while True:
+            try:
+                data, (server_ip, port) = sock.recvfrom(MAX_RESPONSE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError: # e.g. ICMP port unreachable; the query will time out
+                return
+            if len(data) < 12:
+                self.unmatched += 1
+                continue
+            key = (server_ip, port, struct.unpack_from("!H", data)[0], question_key(data))
+            with self._lock:
+                waiter = self._pending.pop(key, None)
+            if waiter is None:
+                self.unmatched += 1 # Late, duplicate or spoofed
+                continue
+            waiter.received = time.monotonic()
+            waiter.response = data
+            waiter.event.set()
+
+    def _rotate(self):
+        """Swaps out over-used sockets and closes retired ones once drained."""
+        now = time.monotonic()
+        with self._lock:
+            for pooled in list(self._sockets):
+                if pooled.uses >= self.rotate_after:
+                    self._sockets.remove(pooled)
+                    pooled.retire_at = now + 5.0 # Let in-flight replies arrive
+                    self._retired.append(pooled)
+                    self._add_socket()
+                    self.rotations += 1
+            for pooled in list(self._retired):
+                if pooled.retire_at <= now:
+                    self._retired.remove(pooled)
+                    self._selector.unregister(pooled.sock)
+                    pooled.sock.close()
+
+
+class _AsyncPooledProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.uses = 0
+
+    def datagram_received(self, data, addr):
+        self.pool._received(data, addr)
+
+
+class AsyncUpstreamPool:
+    """UpstreamPool for the asyncio engine: same matching and rotation, no threads."""
+
+    def __init__(self, size=POOL_SIZE, rotate_after=ROTATE_AFTER, port=UPSTREAM_PORT):
+        self.size = size
+        self.rotate_after = rotate_after
+        self.port = port
+        self._pending = {}
+        self._endpoints = []
+        self.unmatched = 0
+        self.rotations = 0
+        self.tcp_fallbacks = 0
+        self.tcp = AsyncTCPConnections()
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _AsyncPooledProtocol(self), local_addr=("0.0.0.0", 0))
+        self._endpoints.append((transport, protocol))
+
+    async def query(self, server_ip, packet, timeout, port=None):
+        """Sends packet and awaits the matching reply. Returns (response_data, rtt_ms)."""
+        port = port or self.port
+        while len(self._endpoints) < self.size:
+            await self._open()
+        question = question_key(packet)
+        while True:
+            txid = _random.getrandbits(16)
+            key = (server_ip, port, txid, question)
+            if key not in self._pending:
+                break
+
+        index = _random.randrange(len(self._endpoints))
+        transport, protocol = self._endpoints[index]
+        protocol.uses += 1
+        if protocol.uses >= self.rotate_after:
+            # Retire this port: new queries use a fresh socket, and the old one
+            # stays open just long enough for this query's reply.
+            del self._endpoints[index]
+            self.rotations += 1
+            asyncio.get_running_loop().call_later(timeout + 1.0, transport.close)
+
+        reply = self._pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            start_rtt = time.time()
+            transport.sendto(with_txid(packet, txid), (server_ip, port))
+            response_data = await asyncio.wait_for(reply, timeout)
+            return response_data, (time.time() - start_rtt) * 1000
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+        finally:
+            self._pending.pop(key, None)
+
+    async def query_any(self, servers, packet, timeout, selector=None, port=None):
+        """Asyncio counterpart of UpstreamPool.query_any()."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        remaining = list(servers)
+        tries = {}
+        attempts = {}
+        sent = {} # task -> loop.time() it was started
+        try:
+            while True:
+                now = loop.time()
+                stagger = None
+                if remaining and len(attempts) < MAX_PARALLEL and now < deadline:
+                    server_ip = _next_server(remaining, selector, tries)
+                    if server_ip is not None:
+                        attempt_timeout = min(selector.rto(server_ip) if selector else timeout, deadline - now)
+                        task = asyncio.ensure_future(self.query(server_ip, packet, attempt_timeout, port))
+                        attempts[task] = server_ip
+                        sent[task] = now
+                        stagger = selector.stagger_delay(server_ip) if selector else timeout
+                    else:
+                        stagger = THROTTLE_WAIT
+                if not attempts:
+                    if stagger is None:
+                        raise socket.timeout("timed out")
+                    await asyncio.sleep(stagger)
+                    continue
+                done, _ = await asyncio.wait(attempts, timeout=stagger,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    server_ip = attempts.pop(task)
+                    if selector:
+                        selector.release(server_ip)
+                    try:
+                        response_data, rtt = task.result()
+                    except OSError:
+                        if selector:
+                            selector.record_timeout(server_ip)
+                        if tries[server_ip] <= MAX_RETRIES:
+                            remaining.append(server_ip) # Retry after the others
+                        continue
+                    if selector:
+                        selector.record_rtt(server_ip, rtt)
+                    if is_truncated(response_data):
+                        self.tcp_fallbacks += 1
+                        response_data, rtt = await self.tcp.query(server_ip, packet, deadline - loop.time(),
+                                                                  port or self.port)
+                    return server_ip, response_data, rtt
+        finally:
+            now = loop.time()
+            for task, server_ip in attempts.items():
+                task.cancel()
+                if selector:
+                    selector.release(server_ip)
+                    selector.record_unanswered(server_ip, (now - sent[task]) * 1000)
+
+    def _received(self, data, addr):
+        if len(data) < 12:
+            self.unmatched += 1
+            return
+        key = (addr[0], addr[1], struct.unpack_from("!H", data)[0], question_key(data))
+        reply = self._pending.pop(key, None)
+        if reply is None or reply.done():
+            self.unmatched += 1
+            return
+        reply.set_result(data)